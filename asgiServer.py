@@ -0,0 +1,28 @@
+
+# Runs the hat game as an ASGI app. The mutation routes are the same Flask views as
+# flaskServer.py, but /api/stream/... connections are asyncio coroutines instead of threads.
+#
+#   uvicorn asgiServer:asgiApp --port 5000
+#   python asgiServer.py
+
+import os
+
+from flaskServer import app, activeGames, enablePersistence, compressStreams
+from python.asyncStream import AsyncStreamApp
+from python import notificationBus
+
+# Set HATGAME_BUS_SOCKET to share game notifications with other processes through a
+# NotificationBroker (shardedServer.py runs one)
+if 'HATGAME_BUS_SOCKET' in os.environ:
+    notificationBus.useBus(notificationBus.SocketNotificationBus(os.environ['HATGAME_BUS_SOCKET']))
+
+# Set HATGAME_DATA_DIR to keep games across restarts
+if 'HATGAME_DATA_DIR' in os.environ:
+    enablePersistence(os.environ['HATGAME_DATA_DIR'])
+
+asgiApp = AsyncStreamApp(app, activeGames, compressStreams)
+
+if __name__ == '__main__':
+    import uvicorn
+    print('running with asyncio event streams')
+    uvicorn.run(asgiApp, host='127.0.0.1', port=5000, log_level='warning')
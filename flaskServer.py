@@ -1,23 +1,46 @@
 
-import traceback
 import sys
 import os
+import time
+import threading
 import string
 import random
 from flask import Flask, request, Response, send_from_directory, render_template, jsonify, json
 from werkzeug.exceptions import BadRequestKeyError
-from collections import Iterable
 from markupsafe import escape
 import logging
 
-from python.gameSession import GameSession, GameError
+from python.gameSession import GameSession, GameError, BatchError, closedEvent
+from python.gameRegistry import GameRegistry
+from python.gameJournal import GameJournal
+from python.refreshCoalescer import refreshCoalescer
+from python import gameLog
+from python import metrics
+from python.wordBank import wordBank
+from python.fastJson import FastJSONProvider
+from python import compression
+from python.subscriptions import subscriptions, heartbeatComment, parseLastEventId, startEvents, joinEvents
+from python.spectators import getSpectatorFeed
+from python.assetPipeline import AssetPipeline, immutableCacheControl
+
+# Dev mode (HATGAME_DEV=1, or running this file directly) reloads templates and static files
+# when they change; otherwise both are loaded once and assets are served hashed and compressed
+devMode = os.environ.get('HATGAME_DEV') == '1' or __name__ == '__main__'
 
 app = Flask(__name__)
 app.config.update(
-    TEMPLATES_AUTO_RELOAD = True
+    TEMPLATES_AUTO_RELOAD = devMode
 )
+app.json = FastJSONProvider(app)
+assets = AssetPipeline(os.path.join(app.root_path, 'static'), devMode)
+app.jinja_env.globals['asset_url'] = assets.url
+if not devMode:
+    # Compile every template now rather than on the first request for it
+    for templateName in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(templateName)
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.WARNING) # suppress the INFO messages flask logs on every request
+gameLog.configure() # game events as JSON lines on stdout, see python/gameLog.py
 
 class ParamError(Exception):
     pass
@@ -29,14 +52,106 @@ def ErrorResponse(obj):
     #return Response(jsonify(result), status=200, mimetype='application/json')
     #return Response(str(obj), status=400, mimetype='application/text')
 
-activeGames = {}
-
-def eventStream(game, player):
-    event = player.refreshEvent
-    while True:
-        event.wait()
-        event.clear()
-        yield 'data: refresh\n\n'
+def reportRequestError(err):
+    # Bad parameters, unknown IDs and moves the rules do not allow are the client's mistake
+    # and are logged without a traceback
+    gameId = request.view_args.get('gameId') if request.view_args else None
+    gameLog.reportError(request.endpoint, err, gameId,
+                        expected=isinstance(err, (GameError, ParamError, KeyError)))
+
+activeGames = GameRegistry()
+
+# Responses are compressed when the client accepts gzip (or zstd, with the zstandard
+# module); event streams too unless HATGAME_COMPRESS_STREAMS=0
+compressStreams = os.environ.get('HATGAME_COMPRESS_STREAMS', '1') != '0'
+
+def chooseResponseEncoding(body):
+    if len(body) < compression.minCompressBytes:
+        return None
+    return compression.chooseEncoding(request.headers.get('Accept-Encoding', ''))
+
+def chooseStreamEncoding():
+    if not compressStreams:
+        return None
+    return compression.chooseEncoding(request.headers.get('Accept-Encoding', ''))
+
+def setContentEncoding(response, encoding):
+    response.vary.add('Accept-Encoding')
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+
+@app.after_request
+def compressResponse(response):
+    # Compresses other JSON responses, such as the game list; the routes above cache theirs
+    if response.mimetype != 'application/json' or response.status_code != 200 or response.is_streamed \
+            or response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return response
+    # Vary goes on every response that got this far, compressed or not, so a cache does not
+    # hand an uncompressed copy to clients that accept compression or the other way round
+    body = response.get_data()
+    encoding = chooseResponseEncoding(body)
+    if encoding is not None:
+        response.set_data(compression.compress(body, encoding))
+    setContentEncoding(response, encoding)
+    return response
+
+# Refreshes of one game within this many milliseconds are sent to its streams together
+if 'HATGAME_REFRESH_WINDOW_MS' in os.environ:
+    refreshCoalescer.windowSeconds = float(os.environ['HATGAME_REFRESH_WINDOW_MS']) / 1000.0
+gameJournal = None # set by enablePersistence
+
+# Word lists for /api/randomwords, loaded now so no request has to wait for them. The first
+# one is the default.
+for wordListPath in os.environ.get('HATGAME_WORD_LISTS', 'wordListA.txt').split(os.pathsep):
+    wordList = wordBank.load(wordListPath)
+    gameLog.logEvent('wordListLoaded', name=wordList.name, wordCount=len(wordList))
+
+def registerGame(gameId, game):
+    if gameJournal is not None:
+        gameJournal.register(activeGames, gameId, game)
+    else:
+        activeGames[gameId] = game
+
+def enablePersistence(dataDir):
+    # Restores the games saved in dataDir and journals every change from now on
+    global gameJournal
+    gameJournal = GameJournal(dataDir)
+    for gameId, game in gameJournal.recover().items():
+        activeGames[gameId] = game
+    for game in activeGames.values():
+        if game.journal is None:
+            gameJournal.attach(game)
+    gameJournal.start()
+    gameJournal.startSnapshots(activeGames)
+
+def eventStream(game, playerId, lastEventId):
+    # Send the full state once, or only what was missed when a client reconnects with
+    # Last-Event-ID, then the deltas between state versions. An idle stream gets a heartbeat
+    # comment, so a client that has gone away fails the write and ends the generator.
+    # For a spectator, game is the game's SpectatorFeed and playerId is None.
+    event = threading.Event()
+    subscription = subscriptions.subscribe(game, playerId, event.set)
+    reason = 'reaped'
+    try:
+        version, events = startEvents(game, lastEventId, playerId)
+        yield joinEvents(events) if len(events) > 0 else heartbeatComment
+        subscription.markSent()
+        while True:
+            if not event.wait(subscriptions.heartbeatSeconds):
+                yield heartbeatComment
+                subscription.markSent()
+                continue
+            event.clear()
+            if game.closed:
+                reason = 'closed'
+                yield closedEvent
+                return
+            version, events = game.getCatchUpEvents(version, playerId)
+            if len(events) > 0:
+                yield joinEvents(events)
+                subscription.markSent()
+    finally:
+        subscriptions.unsubscribe(game, subscription, reason)
 
 @app.route('/')
 def homePageURL():
@@ -61,11 +176,34 @@ def stream(gameId, playerId):
         player = game.playersByID[playerId]
     except KeyError as err:
         return ErrorResponse(err)
-    print('registering for stream', gameId, playerId)
-    return Response(eventStream(game, player),
-                    mimetype="text/event-stream")
+    gameLog.logGameEvent(gameId, 'streamOpened', logging.DEBUG, player=playerId)
+    lastEventId = parseLastEventId(request.headers.get('Last-Event-ID'))
+    encoding = chooseStreamEncoding()
+    if encoding is None:
+        return Response(eventStream(game, player.id, lastEventId),
+                        mimetype="text/event-stream",
+                        headers={'Vary': 'Accept-Encoding'} if compressStreams else None)
+    return Response(compression.compressStream(eventStream(game, player.id, lastEventId), encoding),
+                    mimetype="text/event-stream",
+                    headers={'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'})
     """var source = new EventSource('/api/stream/<gameId>/<playerId>/events');
-       source.onmessage = function (event) { alert(event.data); };"""
+       source.addEventListener('snapshot', function (event) { alert(event.data); });
+       source.addEventListener('delta', function (event) { alert(event.data); });"""
+
+@app.route('/api/spectate/<gameId>/events', methods=['GET'])
+def spectate(gameId):
+    # Read-only event stream for watchers who are not playing. Spectators see the state
+    # without the hat contents (see python/spectators.py) and share one copy of every event.
+    # Their streams are not compressed: that would take a compressor, and a copy of each
+    # event, per spectator.
+    try:
+        game = activeGames[gameId]
+    except KeyError as err:
+        return ErrorResponse(err)
+    gameLog.logGameEvent(gameId, 'spectatorStreamOpened', logging.DEBUG)
+    lastEventId = parseLastEventId(request.headers.get('Last-Event-ID'))
+    return Response(eventStream(getSpectatorFeed(game), None, lastEventId),
+                    mimetype="text/event-stream")
 
 @app.route('/api/refresh/<gameId>/', methods=['GET'])
 def signalGameRefresh(gameId):
@@ -74,20 +212,37 @@ def signalGameRefresh(gameId):
     except KeyError as err:
         return ErrorResponse(err)
     game.signalRefresh()
-    print('signaled refresh for', gameId)
+    gameLog.logGameEvent(gameId, 'refreshRequested', logging.DEBUG)
     return 'success'
 
-randomWordList = []
+maxRandomWords = 100
 @app.route('/api/randomwords', methods=['GET'])
 def getRandomWords():
-    if len(randomWordList) == 0:
-        with open('wordListA.txt') as file:
-            localRandomWordList = [line.strip() for line in file]
-        randomWordList.extend(localRandomWordList)
-        print('loaded random word list:', len(randomWordList))
+    # query params:
+    #  count: number of distinct words, 5 by default, so a player's whole quota can be
+    #         filled with one request
+    #  list: word list name, see /api/wordlists; the default list if not given
+    #  category: category within the list; the whole list if not given
+    try:
+        try:
+            count = int(request.args.get('count', 5))
+        except ValueError as err:
+            raise ParamError('count must be an integer')
+        if count < 1 or count > maxRandomWords:
+            raise ParamError('count must be between 1 and {}'.format(maxRandomWords))
+        words = wordBank.sample(count, request.args.get('list'), request.args.get('category'))
+    except (ParamError, KeyError) as err:
+        reportRequestError(err)
+        return ErrorResponse(err)
+
+    result = {}
+    result['words'] = words
+    return jsonify(result)
 
+@app.route('/api/wordlists', methods=['GET'])
+def getWordLists():
     result = {}
-    result['words'] = random.choices(randomWordList, k=5)
+    result['wordLists'] = wordBank.describe()
     return jsonify(result)
 
 @app.route('/games/<gameId>/', methods=['GET'])
@@ -101,22 +256,17 @@ def gamePortal(gameId):
         return ErrorResponse(err)
 
     playerList = []
-    for team in game.teams:
-        for player in team.players:
+    for team in game.getPublishedState().state['teams']:
+        for playerId in team:
             d = {}
-            d['href'] = player.id + '/'
-            d['caption'] = player.id
+            d['href'] = playerId + '/'
+            d['caption'] = playerId
             playerList.append(d)
     return render_template("game-portal.html", \
                            game_name=gameId, playerlist=playerList, video_url=game.videoURL)
 
 @app.route('/games/<gameId>/<playerId>/', methods=['GET'])
 def gamePlayerView(gameId, playerId):
-    # As a hack to get the browser to reaload the js on changes, append the last
-    # update time to requests
-    # See https://stackoverflow.com/a/54164514/537390
-    last_updated = str(os.path.getmtime('static/game.js'))
-    
     try:
         game = activeGames[gameId]
     except KeyError as err:
@@ -126,8 +276,21 @@ def gamePlayerView(gameId, playerId):
         "game.html", 
         video_url=game.videoURL,
         gameId=gameId, 
-        playerId=playerId, 
-        last_updated=last_updated)
+        playerId=playerId)
+
+@app.route('/assets/<hashedName>', methods=['GET'])
+def staticAsset(hashedName):
+    # Static files under content-hashed names, see python/assetPipeline.py
+    asset = assets.assetsByHashedName.get(hashedName)
+    if asset is None:
+        return Response('not found', status=404, mimetype='text/plain')
+    headers = {'Cache-Control': immutableCacheControl, 'ETag': asset.etag, 'Vary': 'Accept-Encoding'}
+    if request.headers.get('If-None-Match') == asset.etag:
+        return Response(status=304, headers=headers)
+    encoding, body = asset.choose(request.headers.get('Accept-Encoding', ''))
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(body, content_type=asset.contentType, headers=headers)
 
 #@app.route('/newGame<command>')
 #def show_user_profile(command):
@@ -135,7 +298,7 @@ def gamePlayerView(gameId, playerId):
 #    return 'User %s' % escape(username)
 #https://www.w3schools.com/python/ref_requests_response.asp
 
-def getParam(requestJSON, param, isList=False, isInt=False, isString=False):
+def getParam(requestJSON, param, isList=False, isInt=False, isString=False, isIntList=False):
     try:
         result = requestJSON[param]
     except BadRequestKeyError as err:
@@ -148,25 +311,103 @@ def getParam(requestJSON, param, isList=False, isInt=False, isString=False):
         raise ParamError('parameters not JSON')
 
     if isList:
-        if not isinstance(result, Iterable):
-            raise ParamError('list is not iterable')
+        # A string is iterable too, but is never what was meant
+        if not isinstance(result, list):
+            raise ParamError('param must be a list: ' + param)
 
     if isInt:
         result = int(result)
 
+    if isIntList:
+        # Only JSON integers: int() would also take true, 1.5 and "12", and iterating a
+        # string would turn "12" into [1, 2]
+        if not isinstance(result, list) or not all(isinstance(value, int) and not isinstance(value, bool) for value in result):
+            raise ParamError('list must contain only integers: ' + param)
+
     return result
 
 @app.route('/api/gamelist', methods=['GET'])
 def retrieveGameList():
     return jsonify({'games' : list(activeGames.keys())})
 
+@app.route('/api/loglevel/<gameId>', methods=['POST'])
+def setGameLogLevel(gameId):
+    # params:
+    #  level: DEBUG, INFO, WARNING, ERROR or OFF for this game only, or null for the default
+    # For local operators only, as /metrics. The override goes when the registry drops the game.
+    if request.remote_addr not in (None, '127.0.0.1', '::1'):
+        return Response('forbidden', status=403, mimetype='text/plain')
+    if gameId not in activeGames:
+        err = KeyError(gameId)
+        reportRequestError(err)
+        return ErrorResponse(err)
+
+    requestJSON = request.get_json()
+    try:
+        levelName = getParam(requestJSON, 'level')
+        level = None if levelName is None else gameLog.parseLevel(levelName)
+    except (ParamError, KeyError, AttributeError) as err:
+        return ErrorResponse(err)
+    gameLog.setGameLevel(gameId, level)
+    return 'log level set'
+
+@app.route('/api/stats', methods=['GET'])
+def retrieveStats():
+    refreshStats = refreshCoalescer.getStats()
+    subscriptionStats = subscriptions.getStats()
+    return jsonify({'activeGames': len(activeGames),
+                    'evictedGames': activeGames.evictedCount,
+                    'expiredGames': activeGames.expiredCount,
+                    'refreshesSent': refreshStats['sent'],
+                    'refreshesSuppressed': refreshStats['suppressed'],
+                    'liveStreams': subscriptionStats['live'],
+                    'spectatorStreams': subscriptionStats['spectators'],
+                    'closedStreams': subscriptionStats['closed'],
+                    'reapedStreams': subscriptionStats['reaped'],
+                    'leakedStreams': subscriptionStats['leaked']})
+
 @app.route('/api/gamestate/<gameId>', methods=['GET'])
 def retrieveGameState(gameId):
+    # params:
+    #  player: (query string) the requesting player. Only the player whose turn it is is
+    #   sent the contents of the hat; anyone else, or no player, gets the public state.
     try:
         game = activeGames[gameId];
     except KeyError as err:
         return ErrorResponse(err)
-    return jsonify(game.getStateDict())
+    # The JSON is only rebuilt when the state version changes, and clients holding the
+    # current version get a 304 instead of the body
+    playerId = request.args.get('player')
+    version, etag, serializedState = game.getSerializedStateFor(playerId)
+    encoding = chooseResponseEncoding(serializedState)
+    if encoding is not None:
+        version, etag, serializedState = game.getSerializedStateFor(playerId, encoding)
+        etag += '-' + encoding
+    response = Response(serializedState, mimetype='application/json')
+    setContentEncoding(response, encoding)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Server-Time'] = str(time.time())
+    return response.make_conditional(request)
+
+@app.route('/api/phrases/<gameId>', methods=['GET'])
+def retrievePhraseTexts(gameId):
+    # The table of phrase text indexed by phrase ID. Everything else refers to phrases by
+    # ID, so clients fetch this once after the writing phase.
+    try:
+        game = activeGames[gameId]
+    except KeyError as err:
+        return ErrorResponse(err)
+    etag, serializedPhrases = game.getSerializedPhraseTexts()
+    encoding = chooseResponseEncoding(serializedPhrases)
+    if encoding is not None:
+        etag, serializedPhrases = game.getSerializedPhraseTexts(encoding)
+        etag += '-' + encoding
+    response = Response(serializedPhrases, mimetype='application/json')
+    setContentEncoding(response, encoding)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 @app.route('/api/newgame', methods=['POST'])
 def startNewGame():
@@ -178,8 +419,8 @@ def startNewGame():
     
     try:
         requestJSON = request.get_json()
-    except Exception as ex:
-        traceback.print_exc(file=sys.stdout)
+    except Exception as err:
+        reportRequestError(err)
 
     def randomID():
         letters = string.ascii_lowercase
@@ -188,7 +429,7 @@ def startNewGame():
     try:
         id = getParam(requestJSON, 'id')
         if id in activeGames:
-            print('game ID already exists:', id)
+            gameLog.logGameEvent(id, 'duplicateGameId', logging.WARNING)
             return ErrorResponse('game ID already exists: ' + id)
     except ParamError as err:
         id = randomID()
@@ -203,7 +444,7 @@ def startNewGame():
         secondsPerTurn = getParam(requestJSON, 'secondsPerTurn', isInt=True)
         videoURL = getParam(requestJSON, 'videoURL', isString=True)
     except ParamError as err:
-        traceback.print_exc(file=sys.stdout)
+        reportRequestError(err)
         return ErrorResponse(err)
 
     #print('teams:', teams)
@@ -212,9 +453,8 @@ def startNewGame():
     #    teams[playerIdx % 2].append(playerId)
 
 
-    print(f' game_log {id}: new game with teams: {teams}')
     newSession = GameSession(id, teams, phrasesPerPlayer, secondsPerTurn, videoURL)
-    activeGames[id] = newSession
+    registerGame(id, newSession)
     return jsonify({'id' : id, 'gameURL' : '/games/' + id + '/'})
 
 @app.route('/games/<gameId>/<playerId>/recordphrases', methods=['POST'])
@@ -225,7 +465,7 @@ def recordPhrases(gameId, playerId):
     try:
         game = activeGames[gameId]
     except KeyError as err:
-        traceback.print_exc()
+        reportRequestError(err)
         return ErrorResponse(err)
 
     requestJSON = request.get_json()
@@ -235,10 +475,9 @@ def recordPhrases(gameId, playerId):
         return ErrorResponse(err)
 
     try:
-        print(f"game_log {gameId}: Got phrases from player '{playerId}'': {phrases}")
         game.recordPlayerPhrases(playerId, phrases)
     except GameError as err:
-        traceback.print_exc()
+        reportRequestError(err)
         return ErrorResponse(err)
     game.signalRefresh()
     return 'phrases recorded'
@@ -253,7 +492,7 @@ def addPlayerToTeam(gameId, playerId):
     try:
         game = activeGames[gameId]
     except KeyError as err:
-        traceback.print_exc()
+        reportRequestError(err)
         return ErrorResponse(err)
 
     requestJSON = request.get_json()
@@ -264,10 +503,9 @@ def addPlayerToTeam(gameId, playerId):
         return ErrorResponse(err)
 
     try:
-        print(f"game_log {gameId}: Adding '{newPlayerName}' to team {teamIndex}")
         game.addPlayerToTeam(teamIndex, newPlayerName)
     except GameError as err:
-        traceback.print_exc()
+        reportRequestError(err)
         return ErrorResponse(err)
     game.signalRefresh()
     return 'new player added'
@@ -280,7 +518,7 @@ def removePlayer(gameId, playerId):
     try:
         game = activeGames[gameId]
     except KeyError as err:
-        traceback.print_exc()
+        reportRequestError(err)
         return ErrorResponse(err)
 
     requestJSON = request.get_json()
@@ -290,10 +528,9 @@ def removePlayer(gameId, playerId):
         return ErrorResponse(err)
 
     try:
-        print(f"game_log {gameId}: Removing player '{playerName}'")
         game.removePlayer(playerName)
     except GameError as err:
-        traceback.print_exc()
+        reportRequestError(err)
         return ErrorResponse(err)
     game.signalRefresh()
     return 'player removed'
@@ -306,14 +543,13 @@ def startTurn(gameId, playerId):
     try:
         game = activeGames[gameId]
     except KeyError as err:
-        traceback.print_exc()
+        reportRequestError(err)
         return ErrorResponse(err)
 
     try:
-       print(f"game_log {gameId}: Starting turn: '{playerId}'")
-       game.startPlayerTurn(playerId)
+        game.startPlayerTurn(playerId)
     except GameError as err:
-        traceback.print_exc()
+        reportRequestError(err)
         return ErrorResponse(err)
     game.signalRefresh()
     return 'turn started'
@@ -326,57 +562,167 @@ def endTurn(gameId, playerId):
     try:
         game = activeGames[gameId]
     except KeyError as err:
-        traceback.print_exc()
+        reportRequestError(err)
         return ErrorResponse(err)
 
     try:
-        print(f"game_log {gameId}: Ending turn: '{playerId}'")
         game.endPlayerTurn(playerId)
     except GameError as err:
-        traceback.print_exc()
+        reportRequestError(err)
         return ErrorResponse(err)
     game.signalRefresh()
     return 'turn ended'
 
-@app.route('/games/<gameId>/prevphrase/<prevPhrase>', methods=['POST'])
-def prevPhrase(gameId, prevPhrase):
+@app.route('/games/<gameId>/prevphrase/<int:phraseId>', methods=['POST'])
+def prevPhrase(gameId, phraseId):
     try:
         game = activeGames[gameId]
-        print(f"  game_log {gameId}: Got phrase '{prevPhrase}'")
-        game.recordPrevPhrase(prevPhrase)
-        game.signalRefresh()
-    except err:
-        traceback.print_exc()
+    except KeyError as err:
+        reportRequestError(err)
         return ErrorResponse(err)
+
+    try:
+        game.recordPrevPhrase(phraseId)
+    except GameError as err:
+        reportRequestError(err)
+        return ErrorResponse(err)
+    game.signalRefresh()
     return 'phrase received'
 
 @app.route('/games/<gameId>/<playerId>/confirmphrases', methods=['POST'])
 def confirmPhrases(gameId, playerId):
     # params:
-    #  acceptedPhrases: comma-separated phrases to confirm as 'accepted'.
+    #  acceptedPhrases: list of phrase IDs to confirm as 'accepted'.
     
     try:
         game = activeGames[gameId]
     except KeyError as err:
-        traceback.print_exc()
+        reportRequestError(err)
         return ErrorResponse(err)
 
     requestJSON = request.get_json()
     try:
-        acceptedPhrases = getParam(requestJSON, 'acceptedPhrases', isList=True)
+        acceptedPhrases = getParam(requestJSON, 'acceptedPhrases', isList=True, isIntList=True)
     except ParamError as err:
-        traceback.print_exc()
+        reportRequestError(err)
         return ErrorResponse(err)
 
     try:
-        print(f"game_log {gameId}: player '{playerId}' confirmed phrases {acceptedPhrases}")
         game.confirmPhrases(playerId, acceptedPhrases)
     except GameError as err:
-        traceback.print_exc()
+        reportRequestError(err)
         return ErrorResponse(err)
     game.signalRefresh()
     return 'phrases recorded'
 
+maxBatchOperations = 100
+batchReplies = {
+    'recordphrases': 'phrases recorded',
+    'addplayertoteam': 'new player added',
+    'removeplayer': 'player removed',
+    'startturn': 'turn started',
+    'endturn': 'turn ended',
+    'prevphrase': 'phrase received',
+    'confirmphrases': 'phrases recorded',
+}
+
+def getStringParam(requestJSON, param):
+    result = getParam(requestJSON, param)
+    if not isinstance(result, str):
+        raise ParamError('param must be a string: ' + param)
+    return result
+
+def batchOperation(playerId, operation):
+    # The [GameSession method, args] that do one operation of a batch. Arguments are checked
+    # here, so that an operation can only fail in the game with a GameError.
+    op = getParam(operation, 'op')
+    if op == 'recordphrases':
+        phrases = getParam(operation, 'phrases', isList=True)
+        if not all(isinstance(phrase, str) for phrase in phrases):
+            raise ParamError('phrases must be a list of strings')
+        return ['recordPlayerPhrases', [playerId, phrases]]
+    if op == 'addplayertoteam':
+        return ['addPlayerToTeam', [getParam(operation, 'teamIndex', isInt=True), getStringParam(operation, 'newPlayerName')]]
+    if op == 'removeplayer':
+        return ['removePlayer', [getStringParam(operation, 'playerName')]]
+    if op == 'startturn':
+        return ['startPlayerTurn', [playerId]]
+    if op == 'endturn':
+        return ['endPlayerTurn', [playerId]]
+    if op == 'prevphrase':
+        return ['recordPrevPhrase', [getParam(operation, 'phraseId', isInt=True)]]
+    if op == 'confirmphrases':
+        return ['confirmPhrases', [playerId, getParam(operation, 'acceptedPhrases', isList=True, isIntList=True)]]
+    raise ParamError('unknown op: ' + str(op))
+
+@app.route('/games/<gameId>/<playerId>/batch', methods=['POST'])
+def applyBatch(gameId, playerId):
+    # params:
+    #  operations: list of operations to apply in order, each the params of the route that
+    #    does it alone plus op, that route's name (recordphrases, addplayertoteam,
+    #    removeplayer, startturn, endturn, prevphrase with phraseId, confirmphrases).
+    # The game lock is taken once for the whole list and either every operation is applied,
+    # as one state version and one refresh, or none is and the error gives the index of the
+    # operation that failed. Returns the reply each route would have given.
+
+    try:
+        game = activeGames[gameId]
+    except KeyError as err:
+        reportRequestError(err)
+        return ErrorResponse(err)
+
+    requestJSON = request.get_json()
+    try:
+        operations = getParam(requestJSON, 'operations', isList=True)
+        if len(operations) < 1 or len(operations) > maxBatchOperations:
+            raise ParamError('operations must be a list of 1 to {} entries'.format(maxBatchOperations))
+    except ParamError as err:
+        reportRequestError(err)
+        return ErrorResponse(err)
+    methodCalls = []
+    for idx, operation in enumerate(operations):
+        try:
+            methodCalls.append(batchOperation(playerId, operation))
+        except (ParamError, ValueError, TypeError) as err:
+            reportRequestError(err)
+            return jsonify({'error': 'operation {}: {}'.format(idx, err), 'index': idx})
+
+    try:
+        game.applyBatch(methodCalls)
+    except BatchError as err:
+        reportRequestError(err)
+        return jsonify({'error': str(err), 'index': err.index})
+    game.signalRefresh()
+    return jsonify({'results': [batchReplies[operation['op']] for operation in operations]})
+
+@app.route('/metrics', methods=['GET'])
+def retrieveMetrics():
+    # Prometheus text format, for local scrapers only
+    if request.remote_addr not in (None, '127.0.0.1', '::1'):
+        return Response('forbidden', status=403, mimetype='text/plain')
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+metrics.registry.addCallback('hatgame_active_games', 'Games in the registry', 'gauge', lambda: len(activeGames))
+metrics.registry.addCallback('hatgame_stream_subscribers', 'Open event streams', 'gauge',
+                             lambda: subscriptions.getStats()['live'])
+metrics.registry.addCallback('hatgame_spectator_streams', 'Open spectator event streams', 'gauge',
+                             lambda: subscriptions.getStats()['spectators'])
+metrics.registry.addCallback('hatgame_streams_ended_total', 'Event streams ended, by why', 'counter',
+                             lambda: subscriptions.getStats()['closed'], {'reason': 'closed'})
+metrics.registry.addCallback('hatgame_streams_ended_total', 'Event streams ended, by why', 'counter',
+                             lambda: subscriptions.getStats()['reaped'], {'reason': 'reaped'})
+metrics.registry.addCallback('hatgame_streams_leaked', 'Open event streams that have sent nothing for three heartbeats', 'gauge',
+                             lambda: subscriptions.getStats()['leaked'])
+metrics.registry.addCallback('hatgame_games_evicted_total', 'Games evicted to stay under the size limits', 'counter',
+                             lambda: activeGames.evictedCount)
+metrics.registry.addCallback('hatgame_games_expired_total', 'Games dropped after sitting idle', 'counter',
+                             lambda: activeGames.expiredCount)
+metrics.registry.addCallback('hatgame_refreshes_total', 'Refresh notifications by outcome', 'counter',
+                             lambda: refreshCoalescer.getStats()['sent'], {'result': 'sent'})
+metrics.registry.addCallback('hatgame_refreshes_total', 'Refresh notifications by outcome', 'counter',
+                             lambda: refreshCoalescer.getStats()['suppressed'], {'result': 'suppressed'})
+metrics.instrumentFlaskApp(app) # after every route is defined
+
 # Create a few small deterministic games for UI testing
 example_game_messages = []
 def createDebugWriteGame():
@@ -392,8 +738,8 @@ def createDebugWriteGame():
     
     game.recordPlayerPhrases('graham', ['The Axiom of Choice', 'Uncountable', 'Ripple Shuffle'])
     game.recordPlayerPhrases('nik', ['Volcano', 'Google', 'Mitch McConnell'])
-    activeGames[game_id] = game
-    print('created game ' + game_id)
+    registerGame(game_id, game)
+    gameLog.logGameEvent(game_id, 'debugGameCreated')
     example_game_messages.append('Example page writing words: http://127.0.0.1:5000/games/{}/peter'.format(game_id))
 
 def createDebugMultiWordGame():
@@ -421,8 +767,9 @@ def createDebugMultiWordGame():
     game.activeTeamIdx = 1
     game.teams[0].activePlayerIdx = 2
     game.teams[1].activePlayerIdx = 1
-    activeGames[game_id] = game
-    print('created game ' + game_id)
+    game.markChanged()
+    registerGame(game_id, game)
+    gameLog.logGameEvent(game_id, 'debugGameCreated')
     example_game_messages.append('Example page to start a turn: http://127.0.0.1:5000/games/{}/peter'.format(game_id))
 # TODO: Shold this be inside main?
 createDebugWriteGame()
@@ -431,7 +778,13 @@ print('')
 for m in example_game_messages:
     print(m)
 
+activeGames.startSweeper()
+
 if __name__ == '__main__':
     print('running with multithreading')
+    # Set HATGAME_DATA_DIR to keep games across restarts. With the reloader on, only its
+    # child process serves requests, so only that one opens the journal.
+    if 'HATGAME_DATA_DIR' in os.environ and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        enablePersistence(os.environ['HATGAME_DATA_DIR'])
     app.debug = True
     app.run(threaded=True)
@@ -0,0 +1,72 @@
+
+# Measures the player page in dev mode (templates and static files checked on every request,
+# as before) and production mode (hashed, precompressed, immutable assets): time to the
+# first render in a fresh process, the render time after that, and the requests and bytes a
+# browser needs for a first and a repeat visit.
+#
+#   python python/assetBenchmark.py
+
+import os
+import re
+import subprocess
+import sys
+import time
+
+rootDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+pagePath = '/games/debug_multi_word_phase/peter/'
+renderCount = 1000
+
+def visit(client, page, cachedEtags):
+    # Fetches the page's local assets as a browser would. cachedEtags maps url -> ETag for
+    # files in the browser cache, which are revalidated unless they are immutable.
+    requestCount = 1
+    byteCount = len(page)
+    for url in re.findall(r'(?:src|href)="(/(?:static|assets)/[^"]+)"', page.decode('utf-8')):
+        cached = cachedEtags.get(url)
+        if cached is not None and cached[1]:
+            continue
+        headers = {'Accept-Encoding': 'gzip, deflate, br'}
+        if cached is not None:
+            headers['If-None-Match'] = cached[0]
+        response = client.get(url, headers=headers)
+        requestCount += 1
+        byteCount += len(response.get_data())
+        if response.status_code == 200:
+            cachedEtags[url] = (response.headers.get('ETag'), 'immutable' in response.headers.get('Cache-Control', ''))
+        response.close()
+    return requestCount, byteCount
+
+def measureMode():
+    # Runs in a child process, so the first render includes compiling the templates
+    startTime = time.perf_counter()
+    from flaskServer import app
+    client = app.test_client()
+    importSeconds = time.perf_counter() - startTime
+    startTime = time.perf_counter()
+    page = client.get(pagePath).get_data()
+    firstSeconds = time.perf_counter() - startTime
+
+    startTime = time.perf_counter()
+    for i in range(renderCount):
+        client.get(pagePath).get_data()
+    renderSeconds = (time.perf_counter() - startTime) / renderCount
+
+    cachedEtags = {}
+    firstVisit = visit(client, page, cachedEtags)
+    repeatVisit = visit(client, client.get(pagePath).get_data(), cachedEtags)
+    print('{:>10}: startup {:.0f} ms, first render {:.2f} ms, then {:.3f} ms; first visit {} requests {} bytes; '
+          'repeat visit {} requests {} bytes'.format(
+              os.environ['HATGAME_DEV'] == '1' and 'dev' or 'production', importSeconds * 1000.0,
+              firstSeconds * 1000.0, renderSeconds * 1000.0, firstVisit[0], firstVisit[1], repeatVisit[0], repeatVisit[1]))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        sys.path.insert(0, rootDir)
+        os.chdir(rootDir)
+        measureMode()
+    else:
+        for dev in ('1', '0'):
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child'], cwd=rootDir,
+                                    env=dict(os.environ, HATGAME_DEV=dev, HATGAME_LOG_LEVEL='OFF'),
+                                    capture_output=True, text=True, check=True).stdout
+            print(output.strip().splitlines()[-1])
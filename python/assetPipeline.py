@@ -0,0 +1,78 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from python import compression
+
+try:
+    import brotli
+except ImportError:
+    brotli = None # only gzip variants are made
+
+# Files in static/ are read once at startup and served from /assets/ under names that
+# include a hash of their content, e.g. game.3f2a9c1e07bd.js, so browsers can cache them
+# for good: a changed file gets a new name. Compressed variants are made at the same time.
+
+immutableCacheControl = 'public, max-age=31536000, immutable'
+
+class Asset:
+    def __init__(self, filename, body):
+        self.filename = filename
+        digest = hashlib.sha256(body).hexdigest()[:12]
+        stem, extension = os.path.splitext(filename)
+        self.hashedName = '{}.{}{}'.format(stem, digest, extension)
+        self.etag = '"{}"'.format(digest)
+        self.contentType = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        if self.contentType.startswith('text/') or self.contentType == 'application/javascript':
+            self.contentType += '; charset=utf-8'
+        self.bodies = {'identity': body}
+        # Variants that do not save anything, as for images, are not kept
+        gzipped = gzip.compress(body, compresslevel=9, mtime=0)
+        if len(gzipped) < len(body):
+            self.bodies['gzip'] = gzipped
+        if brotli is not None:
+            compressed = brotli.compress(body, quality=11)
+            if len(compressed) < len(body):
+                self.bodies['br'] = compressed
+
+    def choose(self, acceptEncoding):
+        # Returns the encoding and body to send for an Accept-Encoding header, read as the
+        # other responses read it (see compression.acceptedEncodings); br is preferred
+        # whenever it is accepted.
+        accepted = compression.acceptedEncodings(acceptEncoding)
+        for encoding in ('br', 'gzip'):
+            if encoding in accepted and encoding in self.bodies:
+                return encoding, self.bodies[encoding]
+        return 'identity', self.bodies['identity']
+
+class AssetPipeline:
+    """The static files with their hashed names and compressed bodies. In dev mode nothing
+    is cached: urls point at Flask's /static/ route with the file's modification time
+    appended, so edits show up on the next page load."""
+    def __init__(self, staticDir, devMode=False):
+        self.staticDir = staticDir
+        self.devMode = devMode
+        self.assetsByFilename = {}
+        self.assetsByHashedName = {}
+        if not devMode:
+            self.load()
+
+    def load(self):
+        for filename in sorted(os.listdir(self.staticDir)):
+            path = os.path.join(self.staticDir, filename)
+            if filename.endswith('~') or filename.startswith('.') or not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as file:
+                asset = Asset(filename, file.read())
+            self.assetsByFilename[filename] = asset
+            self.assetsByHashedName[asset.hashedName] = asset
+
+    def url(self, filename):
+        asset = self.assetsByFilename.get(filename)
+        if asset is not None:
+            return '/assets/' + asset.hashedName
+        path = os.path.join(self.staticDir, filename)
+        if self.devMode and os.path.isfile(path):
+            return '/static/{}?u={}'.format(filename, os.path.getmtime(path))
+        return '/static/' + filename
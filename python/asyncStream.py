@@ -0,0 +1,298 @@
+import asyncio
+import contextvars
+import json
+import logging
+import re
+import time
+import urllib.parse
+
+from asgiref.wsgi import WsgiToAsgi
+
+from python.gameSession import GameError, closedEvent
+from python import gameLog
+from python import metrics
+from python import compression
+from python import fastJson
+from python.subscriptions import subscriptions, heartbeatComment, parseLastEventId, startEvents, joinEvents
+from python.spectators import getSpectatorFeed
+
+streamPathRegex = re.compile(r'^/api/stream/([^/]+)/([^/]+)/events$')
+spectatePathRegex = re.compile(r'^/api/spectate/([^/]+)/events$')
+socketPathRegex = re.compile(r'^/api/socket/([^/]+)/([^/]+)$')
+
+def runSocketAction(game, playerId, message):
+    # Runs one action sent over a game socket, as the HTTP route of the same name would, and
+    # returns the route's reply. Called on an executor thread: the game methods take the
+    # game lock, and the journal may write.
+    action = message.get('action')
+    if action == 'startturn':
+        game.startPlayerTurn(playerId)
+        result = 'turn started'
+    elif action == 'prevphrase':
+        game.recordPrevPhrase(int(message['phraseId']))
+        result = 'phrase received'
+    elif action == 'endturn':
+        game.endPlayerTurn(playerId)
+        result = 'turn ended'
+    elif action == 'confirmphrases':
+        acceptedPhrases = message['acceptedPhrases']
+        # Checked as the confirmphrases route checks it: a list of JSON integers
+        if not isinstance(acceptedPhrases, list) or \
+           not all(isinstance(phraseId, int) and not isinstance(phraseId, bool) for phraseId in acceptedPhrases):
+            raise ValueError('acceptedPhrases must be a list of integers')
+        game.confirmPhrases(playerId, acceptedPhrases)
+        result = 'phrases recorded'
+    else:
+        raise ValueError('unknown action: {}'.format(action))
+    game.signalRefresh()
+    return result
+
+class AsyncStreamApp:
+    """ASGI front end for the Flask app. Event streams are served as coroutines so an idle
+    subscriber costs one task and a one-slot queue instead of a parked server thread; every
+    other route is handed unchanged to the Flask app."""
+    def __init__(self, flaskApp, activeGames, compressStreams=True):
+        self.wsgiApp = WsgiToAsgi(flaskApp)
+        self.activeGames = activeGames
+        self.compressStreams = compressStreams # when the client accepts it, see python/compression.py
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        if scope['type'] == 'http':
+            match = streamPathRegex.match(scope['path'])
+            if match is not None:
+                await self.stream(match.group(1), match.group(2), scope, receive, send)
+                return
+            match = spectatePathRegex.match(scope['path'])
+            if match is not None:
+                await self.stream(match.group(1), None, scope, receive, send)
+                return
+
+        if scope['type'] == 'websocket':
+            match = socketPathRegex.match(scope['path'])
+            if match is not None:
+                await self.socket(match.group(1), match.group(2), scope, receive, send)
+            else:
+                await receive()
+                await send({'type': 'websocket.close'})
+            return
+
+        # In a fresh context: asgiref leaves its finished thread executor in the context of
+        # the send calls, and uvicorn starts the next request on a keep-alive connection from
+        # there, which then fails with "CurrentThreadExecutor already quit or is broken"
+        await asyncio.create_task(self.wsgiApp(scope, receive, send), context=contextvars.Context())
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def stream(self, gameId, playerId, scope, receive, send):
+        # A playerId of None is a spectator, served from the game's SpectatorFeed without
+        # compression, as in flaskServer.spectate
+        try:
+            game = self.activeGames[gameId]
+            if playerId is None:
+                game = getSpectatorFeed(game)
+            else:
+                game.playersByID[playerId]
+        except KeyError as err:
+            # Same shape as flaskServer.ErrorResponse
+            body = json.dumps({'error': str(err)}).encode('utf-8')
+            await send({'type': 'http.response.start',
+                        'status': 200,
+                        'headers': [(b'content-type', b'application/json')]})
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        # The events themselves are read from the game, so one pending wakeup is as good as many
+        queue = asyncio.Queue(maxsize=1)
+        loop = asyncio.get_running_loop()
+
+        def putRefresh():
+            if not queue.full():
+                queue.put_nowait('refresh')
+
+        def listener():
+            # Called from whichever Flask worker thread ran the mutation
+            loop.call_soon_threadsafe(putRefresh)
+
+        headers = [(b'content-type', b'text/event-stream'),
+                   (b'cache-control', b'no-cache')]
+        encoding = None
+        if self.compressStreams and playerId is not None:
+            headers.append((b'vary', b'Accept-Encoding')) # whichever encoding is chosen
+            acceptEncoding = b', '.join(value for name, value in scope['headers'] if name == b'accept-encoding')
+            encoding = compression.chooseEncoding(acceptEncoding.decode('latin-1'))
+        if encoding is not None:
+            compressor = compression.StreamCompressor(encoding)
+            encode = lambda text: compressor.compress(text.encode('utf-8'))
+            headers.append((b'content-encoding', encoding.encode('ascii')))
+        else:
+            encode = lambda text: text if isinstance(text, bytes) else text.encode('utf-8')
+
+        lastEventId = None
+        for name, value in scope['headers']:
+            if name == b'last-event-id':
+                lastEventId = parseLastEventId(value.decode('latin-1'))
+
+        subscription = subscriptions.subscribe(game, playerId, listener)
+        reason = 'reaped'
+        disconnectTask = None
+        getTask = None # set before the try, so the finally can always clean up
+        if playerId is None:
+            gameLog.logGameEvent(gameId, 'spectatorStreamOpened', logging.DEBUG)
+        else:
+            gameLog.logGameEvent(gameId, 'streamOpened', logging.DEBUG, player=playerId)
+        try:
+            await send({'type': 'http.response.start',
+                        'status': 200,
+                        'headers': headers})
+            version, events = startEvents(game, lastEventId, playerId)
+            await send({'type': 'http.response.body',
+                        'body': encode(joinEvents(events) if len(events) > 0 else heartbeatComment),
+                        'more_body': True})
+            subscription.markSent()
+            disconnectTask = asyncio.ensure_future(self.waitForDisconnect(receive))
+            while True:
+                if getTask is None:
+                    getTask = asyncio.ensure_future(queue.get())
+                done, pending = await asyncio.wait([getTask, disconnectTask], timeout=subscriptions.heartbeatSeconds,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if disconnectTask in done:
+                    break
+                if len(done) == 0:
+                    await send({'type': 'http.response.body',
+                                'body': encode(heartbeatComment),
+                                'more_body': True})
+                    subscription.markSent()
+                    continue
+                getTask = None
+                if game.closed:
+                    reason = 'closed'
+                    body = encode(closedEvent)
+                    if encoding is not None:
+                        body += compressor.finish()
+                    await send({'type': 'http.response.body',
+                                'body': body,
+                                'more_body': False})
+                    break
+                version, events = game.getCatchUpEvents(version, playerId)
+                if len(events) > 0:
+                    await send({'type': 'http.response.body',
+                                'body': encode(joinEvents(events)),
+                                'more_body': True})
+                    subscription.markSent()
+        except OSError:
+            pass
+        finally:
+            for task in (disconnectTask, getTask):
+                if task is not None:
+                    task.cancel()
+            subscriptions.unsubscribe(game, subscription, reason)
+
+    async def socket(self, gameId, playerId, scope, receive, send):
+        # A player's game socket carries the same events as their event stream, each as a text
+        # message in event stream format, and takes the in-turn actions the other way:
+        #   {"id": 1, "action": "startturn" | "prevphrase" | "endturn" | "confirmphrases",
+        #    "phraseId": ..., "acceptedPhrases": [...]}
+        # Each action is answered with a "reply" event holding its id and the result or error
+        # of the HTTP route of the same name. A reconnecting client passes the version it has
+        # as ?lastEventId=, since browsers cannot set headers on a WebSocket.
+        await receive() # websocket.connect
+        try:
+            game = self.activeGames[gameId]
+            game.playersByID[playerId]
+        except KeyError:
+            await send({'type': 'websocket.close', 'code': 4404})
+            return
+
+        queue = asyncio.Queue(maxsize=1)
+        loop = asyncio.get_running_loop()
+
+        def putRefresh():
+            if not queue.full():
+                queue.put_nowait('refresh')
+
+        def listener():
+            loop.call_soon_threadsafe(putRefresh)
+
+        query = urllib.parse.parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        lastEventId = parseLastEventId(query['lastEventId'][0]) if 'lastEventId' in query else None
+
+        subscription = subscriptions.subscribe(game, playerId, listener)
+        reason = 'reaped'
+        getTask = None # set before the try, so the finally can always clean up
+        receiveTask = None
+        gameLog.logGameEvent(gameId, 'socketOpened', logging.DEBUG, player=playerId)
+        try:
+            await send({'type': 'websocket.accept'})
+            version, events = startEvents(game, lastEventId, playerId)
+            await send({'type': 'websocket.send', 'text': joinEvents(events) if len(events) > 0 else heartbeatComment})
+            subscription.markSent()
+            while True:
+                if getTask is None:
+                    getTask = asyncio.ensure_future(queue.get())
+                if receiveTask is None:
+                    receiveTask = asyncio.ensure_future(receive())
+                done, pending = await asyncio.wait([getTask, receiveTask], timeout=subscriptions.heartbeatSeconds,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if len(done) == 0:
+                    await send({'type': 'websocket.send', 'text': heartbeatComment})
+                    subscription.markSent()
+                    continue
+                if receiveTask in done:
+                    message = receiveTask.result()
+                    receiveTask = None
+                    if message['type'] == 'websocket.disconnect':
+                        break
+                    # Actions run one at a time, in the order they were sent
+                    await send({'type': 'websocket.send', 'text': await self.runAction(game, playerId, message.get('text'))})
+                if getTask in done:
+                    getTask = None
+                    if game.closed:
+                        reason = 'closed'
+                        await send({'type': 'websocket.send', 'text': closedEvent})
+                        await send({'type': 'websocket.close'})
+                        break
+                    version, events = game.getCatchUpEvents(version, playerId)
+                    if len(events) > 0:
+                        await send({'type': 'websocket.send', 'text': joinEvents(events)})
+                        subscription.markSent()
+        except OSError:
+            pass
+        finally:
+            for task in (getTask, receiveTask):
+                if task is not None:
+                    task.cancel()
+            subscriptions.unsubscribe(game, subscription, reason)
+
+    async def runAction(self, game, playerId, text):
+        # Returns the reply event for one action message
+        startTime = time.perf_counter()
+        route = 'socket:error'
+        reply = {}
+        try:
+            message = json.loads(text)
+            reply['id'] = message.get('id')
+            reply['result'] = await asyncio.get_running_loop().run_in_executor(None, runSocketAction, game, playerId, message)
+            route = 'socket:' + message['action']
+        except (GameError, KeyError, ValueError, TypeError, AttributeError) as err:
+            gameLog.reportError('socket', err, game.id, expected=True)
+            reply['error'] = str(err)
+        metrics.requestDurations.labels(route).observe(time.perf_counter() - startTime)
+        # No id: a reply is not a state version
+        return 'event: reply\ndata: {}\n\n'.format(fastJson.dumpsText(reply))
+
+    async def waitForDisconnect(self, receive):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
@@ -0,0 +1,139 @@
+
+# Measures publish-to-deliver latency of the notification buses. Subscribers are asyncio
+# tasks woken the way python/asyncStream.py wakes an event stream. With the local bus the
+# publisher is a thread in the subscribers' process, as a Flask request thread would be;
+# with the socket bus the subscribers are spread over several processes and the publisher
+# is another process, all connected through a NotificationBroker.
+#
+#   python python/busBenchmark.py --subscribers 1000 10000
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import queue
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from python.notificationBus import LocalNotificationBus, SocketNotificationBus, NotificationBroker
+
+gameId = 'bench'
+
+async def runSubscribers(bus, subscriberCount, rounds, report):
+    # Calls report(firstWakeTime, lastWakeTime) once every subscriber has woken for a round
+    loop = asyncio.get_running_loop()
+    wakeTimes = []
+    subscribed = []
+
+    async def subscriber():
+        wakeups = asyncio.Queue(maxsize=1)
+
+        def putRefresh():
+            if not wakeups.full():
+                wakeups.put_nowait('refresh')
+
+        def listener():
+            loop.call_soon_threadsafe(putRefresh)
+
+        bus.subscribe(gameId, listener)
+        subscribed.append(listener)
+        for roundIdx in range(rounds):
+            await wakeups.get()
+            wakeTimes.append(time.monotonic())
+            if len(wakeTimes) == subscriberCount:
+                report(min(wakeTimes), max(wakeTimes))
+                wakeTimes.clear()
+
+    tasks = [asyncio.ensure_future(subscriber()) for i in range(subscriberCount)]
+    while len(subscribed) < subscriberCount:
+        await asyncio.sleep(0.01)
+    report(None, None) # ready
+    await asyncio.gather(*tasks)
+
+def subscriberProcess(busSocketPath, subscriberCount, rounds, connection):
+    bus = SocketNotificationBus(busSocketPath)
+    while bus.connection is None:
+        time.sleep(0.01)
+    asyncio.run(runSubscribers(bus, subscriberCount, rounds, lambda first, last: connection.send((first, last))))
+
+def summarize(name, subscriberCount, latencies):
+    firstLatencies = sorted(first for first, last in latencies)
+    lastLatencies = sorted(last for first, last in latencies)
+    print('{}, {} subscribers: first delivery median {:.2f} ms, all delivered median {:.2f} ms, p99 {:.2f} ms'.format(
+        name, subscriberCount,
+        statistics.median(firstLatencies) * 1000.0,
+        statistics.median(lastLatencies) * 1000.0,
+        lastLatencies[int(len(lastLatencies) * 0.99)] * 1000.0))
+
+def measureLocal(subscriberCount, rounds):
+    bus = LocalNotificationBus()
+    reports = queue.Queue()
+    thread = threading.Thread(target=lambda: asyncio.run(runSubscribers(bus, subscriberCount, rounds,
+                                                                          lambda first, last: reports.put((first, last)))),
+                              daemon=True)
+    thread.start()
+    reports.get()
+    latencies = []
+    for roundIdx in range(rounds):
+        publishTime = time.monotonic()
+        bus.publish(gameId)
+        first, last = reports.get()
+        latencies.append((first - publishTime, last - publishTime))
+    thread.join()
+    summarize('local bus', subscriberCount, latencies)
+
+def measureSocket(subscriberCount, rounds, processCount):
+    socketDir = tempfile.mkdtemp(prefix='hatgame-bus-')
+    busSocketPath = os.path.join(socketDir, 'bus.sock')
+
+    # The broker gets its own thread and loop in this process
+    brokerStarted = threading.Event()
+    def runBroker():
+        async def main():
+            await NotificationBroker(busSocketPath).start()
+            brokerStarted.set()
+            await asyncio.Event().wait()
+        asyncio.run(main())
+    threading.Thread(target=runBroker, daemon=True).start()
+    brokerStarted.wait()
+
+    connections = []
+    processes = []
+    for processIdx in range(processCount):
+        parentConnection, childConnection = multiprocessing.Pipe()
+        count = subscriberCount // processCount + (1 if processIdx < subscriberCount % processCount else 0)
+        process = multiprocessing.Process(target=subscriberProcess, args=(busSocketPath, count, rounds, childConnection))
+        process.start()
+        connections.append(parentConnection)
+        processes.append(process)
+    for connection in connections:
+        connection.recv()
+    time.sleep(0.5) # lets the broker read every subscription
+
+    publisher = SocketNotificationBus(busSocketPath)
+    while publisher.connection is None:
+        time.sleep(0.01)
+    latencies = []
+    for roundIdx in range(rounds):
+        publishTime = time.monotonic()
+        publisher.publish(gameId)
+        results = [connection.recv() for connection in connections]
+        latencies.append((min(first for first, last in results) - publishTime,
+                          max(last for first, last in results) - publishTime))
+    for process in processes:
+        process.join()
+    summarize('socket bus over {} processes'.format(processCount), subscriberCount, latencies)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--subscribers', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--rounds', type=int, default=100)
+    parser.add_argument('--processes', type=int, default=4, help='subscriber processes for the socket bus')
+    args = parser.parse_args()
+    for subscriberCount in args.subscribers:
+        measureLocal(subscriberCount, args.rounds)
+        measureSocket(subscriberCount, args.rounds, args.processes)
@@ -0,0 +1,105 @@
+
+# Measures /api/gamestate bodies at several game sizes: bytes with each encoding, and the
+# CPU to build one with the json module and with orjson, to compress it, and to serve it
+# again from the per-version cache. Also reports the size of the public state that every
+# player but the hat holder is sent, and the average size of a stream delta with and
+# without stream compression.
+#
+#   python python/compressionBenchmark.py
+
+import json
+import os
+import random
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from python import gameLog
+from python import compression
+from python import fastJson
+from python.gameSession import GameSession, PublishedState
+
+# (teams, players per team, phrases per player)
+gameSizes = [(2, 3, 5), (4, 5, 10), (10, 10, 20), (30, 20, 30)]
+
+def newGame(teamCount, playersPerTeam, phrasesPerPlayer):
+    teams = [['player{}-{}'.format(teamIdx, playerIdx) for playerIdx in range(playersPerTeam)] for teamIdx in range(teamCount)]
+    game = GameSession('bench', teams, phrasesPerPlayer, 60, 'https://meet.example.com/abc-defg-hij')
+    game.showLog = False
+    for team in teams:
+        for playerId in team:
+            game.recordPlayerPhrases(playerId, ['{} phrase {}'.format(playerId, i) for i in range(phrasesPerPlayer)])
+    game.startPlayerTurn(game.activePlayer().id)
+    for phraseId in game.phrasesInHat.toList()[:3]:
+        game.recordPrevPhrase(phraseId)
+    return game
+
+def timePerCall(function, minSeconds=0.2):
+    count = 0
+    startTime = time.perf_counter()
+    while True:
+        function()
+        count += 1
+        seconds = time.perf_counter() - startTime
+        if seconds >= minSeconds:
+            return seconds / count
+
+def freshState(published):
+    # A copy without the cached forms, so every call builds them again
+    return PublishedState(published.version, published.state, published.events, published.etag, published.hatHolderId)
+
+def serializeWith(useOrjson, published):
+    fastJson.useOrjson = useOrjson
+    return freshState(published).getSerialized()
+
+def deltaSizes(game):
+    # Plays the rest of a turn and a few more, sending each delta through one stream compressor
+    compressor = compression.StreamCompressor('gzip')
+    version = game.stateVersion
+    rawBytes = 0
+    compressedBytes = 0
+    deltaCount = 0
+    rng = random.Random(1)
+    for turn in range(5):
+        if game.subPhase.name == 'WaitForStart':
+            game.startPlayerTurn(game.activePlayer().id)
+        for phraseId in rng.sample(game.phrasesInHat.toList(), min(5, len(game.phrasesInHat))):
+            game.recordPrevPhrase(phraseId)
+        if game.subPhase.name == 'Started':
+            game.endPlayerTurn(game.activePlayer().id)
+        game.confirmPhrases(game.activePlayer().id, game.clickedPhrases.toList())
+        version, events = game.getCatchUpEvents(version)
+        for text in events:
+            body = text.encode('utf-8')
+            rawBytes += len(body)
+            compressedBytes += len(compressor.compress(body))
+            deltaCount += 1
+    return rawBytes / deltaCount, compressedBytes / deltaCount
+
+if __name__ == '__main__':
+    gameLog.configure(level=gameLog.parseLevel('OFF'))
+    encodings = ['gzip'] + (['zstd'] if compression.zstandard is not None else [])
+    print('orjson installed: {}, zstandard installed: {}'.format(fastJson.orjson is not None, compression.zstandard is not None))
+    for teamCount, playersPerTeam, phrasesPerPlayer in gameSizes:
+        game = newGame(teamCount, playersPerTeam, phrasesPerPlayer)
+        published = game.getPublishedState()
+        body = published.getSerialized()
+        assert json.loads(serializeWith(False, published)) == json.loads(serializeWith(fastJson.orjson is not None, published))
+
+        print('{} players, {} phrases:'.format(teamCount * playersPerTeam, teamCount * playersPerTeam * phrasesPerPlayer))
+        print('  identity {:>7} bytes'.format(len(body)))
+        publicBody = published.getSerialized('public')
+        print('  public   {:>7} bytes, {:>7} with gzip'.format(len(publicBody), len(compression.compress(publicBody, 'gzip'))))
+        for encoding in encodings:
+            compressed = compression.compress(body, encoding)
+            print('  {:<8} {:>7} bytes, compress {:.1f} us'.format(
+                encoding, len(compressed), timePerCall(lambda: compression.compress(body, encoding)) * 1e6))
+        print('  serialize: json {:.1f} us, orjson {}'.format(
+            timePerCall(lambda: serializeWith(False, published)) * 1e6,
+            'not installed' if fastJson.orjson is None else '{:.1f} us'.format(timePerCall(lambda: serializeWith(True, published)) * 1e6)))
+        fastJson.useOrjson = fastJson.orjson is not None
+        game.getSerializedState('gzip')
+        print('  cached gzip fetch: {:.2f} us'.format(timePerCall(lambda: game.getSerializedState('gzip')) * 1e6))
+        rawDelta, compressedDelta = deltaSizes(game)
+        print('  stream delta: {:.0f} bytes, {:.0f} bytes with stream gzip'.format(rawDelta, compressedDelta))
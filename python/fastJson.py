@@ -0,0 +1,34 @@
+import json
+import os
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None # falls back to the json module
+
+# Compact JSON for API responses and stream events. orjson is used when it is installed,
+# unless HATGAME_FAST_JSON=0. Both produce the same documents for the plain dicts, lists,
+# tuples, strings and numbers in game states.
+useOrjson = orjson is not None and os.environ.get('HATGAME_FAST_JSON', '1') != '0'
+
+def dumps(value):
+    # Returns UTF-8 bytes
+    if useOrjson:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+def dumpsText(value):
+    if useOrjson:
+        return orjson.dumps(value).decode('utf-8')
+    return json.dumps(value, separators=(',', ':'))
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider for jsonify that writes compact JSON with dumps above."""
+    compact = True
+
+    def dumps(self, obj, **kwargs):
+        if useOrjson and len(kwargs) == 0:
+            return orjson.dumps(obj).decode('utf-8')
+        return super().dumps(obj, **kwargs)
@@ -182,10 +182,11 @@ def simulateValidPlayerTurn(gameID):
     gameURLBase = URLBase + 'games/' + gameID + '/'
     teams = gameState['teams']
     players = [player for team in teams for player in team]
-    hat = gameState['hat']
     activeTeamIdx = gameState['activeTeamIndex']
     activePlayerIndex = gameState['activePlayerIndexPerTeam'][activeTeamIdx]
     activePlayer = gameState['teams'][activeTeamIdx][activePlayerIndex]
+    # Only the active player is sent the hat
+    hat = processGetRequest(URLBase + 'api/gamestate/' + gameID + '?player=' + activePlayer)['hat']
 
     verifyPhase(newGameID, None, 'GameSubPhase.WaitForStart')
     processPostRequest(gameURLBase + activePlayer + '/startturn', json=None)
@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import threading
+
+from python.gameSession import GameSession, GameError
+from python import gameLog
+
+# Operations a GameSession journals, and the method that replays each one
+replayMethods = {
+    'recordPlayerPhrases': GameSession.recordPlayerPhrases,
+    'startPlayerTurn': GameSession.startPlayerTurn,
+    'endPlayerTurn': GameSession.endPlayerTurn,
+    'recordPrevPhrase': GameSession.recordPrevPhrase,
+    'confirmPhrases': GameSession.confirmPhrases,
+    'addPlayerToTeam': GameSession.addPlayerToTeam,
+    'removePlayer': GameSession.removePlayer,
+    'applyBatch': GameSession.applyBatch,
+}
+
+defaultFlushIntervalSeconds = 0.005
+defaultSnapshotIntervalSeconds = 300.0
+
+class GameJournal:
+    """Write-ahead log of GameSession mutations plus periodic snapshots, so games survive a
+    restart. Records are JSON lines numbered by a global sequence. append() only queues the
+    line; a writer thread group-commits everything queued in one write and one fsync per
+    flush interval, without holding the lock append() takes, so a click pays for a
+    json.dumps, not a disk sync.
+
+    Files in dataDir:
+      journal-<first seq>.log    log segments, a new one is started by each snapshot
+      snapshot-<seq>.json        every game, each tagged with its last applied seq
+    Recovery loads the newest snapshot and replays the log records after each game's seq."""
+    def __init__(self, dataDir, flushIntervalSeconds=defaultFlushIntervalSeconds, syncToDisk=True):
+        self.dataDir = dataDir
+        self.flushIntervalSeconds = flushIntervalSeconds
+        self.syncToDisk = syncToDisk
+        os.makedirs(dataDir, exist_ok=True)
+
+        # lock guards the queue and is all append() takes; writerLock is held by whoever
+        # writes to the segment file, so the disk write and sync happen outside lock and a
+        # mutation never waits for them. Take writerLock first when both are needed.
+        self.lock = threading.Lock()
+        self.writerLock = threading.Lock()
+        # Held while a new game is attached and registered, and while a snapshot cuts the log
+        # and lists the games, so every game's create record is in the snapshot or after it.
+        # Taken before writerLock.
+        self.registerLock = threading.Lock()
+        self.flushCondition = threading.Condition(self.lock)
+        self.pendingLines = []
+        self.seq = 0
+        self.flushedSeq = 0
+        self.segmentFile = None
+        self.writerThread = None
+        self.snapshotThread = None
+
+    def segmentPaths(self):
+        names = [name for name in os.listdir(self.dataDir) if name.startswith('journal-') and name.endswith('.log')]
+        names.sort(key=lambda name: int(name[len('journal-'):-len('.log')]))
+        return [os.path.join(self.dataDir, name) for name in names]
+
+    def latestSnapshotPath(self):
+        names = [name for name in os.listdir(self.dataDir) if name.startswith('snapshot-') and name.endswith('.json')]
+        if len(names) == 0:
+            return None
+        names.sort(key=lambda name: int(name[len('snapshot-'):-len('.json')]))
+        return os.path.join(self.dataDir, names[-1])
+
+    #
+    # Writing
+    #
+    def append(self, gameId, op, args, t):
+        # Called with the game's lock held; returns the record's sequence number
+        with self.lock:
+            self.seq += 1
+            self.pendingLines.append(json.dumps({'seq': self.seq, 'game': gameId, 'op': op, 'args': args, 't': t},
+                                                separators=(',', ':')))
+            return self.seq
+
+    def attach(self, game):
+        # Starts journaling a game that was created outside the journal. The whole new game
+        # is the first record, which also covers the random team order.
+        with game.lock:
+            game.journal = self
+            game.journalWithoutLock('create', [game.toSnapshotDict()])
+
+    def register(self, registry, gameId, game):
+        # Attaches a new game and adds it to the registry as one step, see registerLock
+        with self.registerLock:
+            self.attach(game)
+            registry[gameId] = game
+
+    def start(self):
+        # Opens a fresh log segment and starts the group-commit writer
+        with self.writerLock:
+            with self.lock:
+                firstSeq = self.seq + 1
+            self.openSegmentWithoutLock(firstSeq)
+        self.writerThread = threading.Thread(target=self.writeLoop, name='game-journal-writer', daemon=True)
+        self.writerThread.start()
+
+    def openSegmentWithoutLock(self, firstSeq):
+        # Call with writerLock held
+        if self.segmentFile is not None:
+            self.segmentFile.close()
+        path = os.path.join(self.dataDir, 'journal-{}.log'.format(firstSeq))
+        self.segmentFile = open(path, 'a', encoding='utf-8')
+
+    def writeLoop(self):
+        while True:
+            time.sleep(self.flushIntervalSeconds)
+            self.flush()
+
+    def flush(self):
+        with self.writerLock:
+            with self.lock:
+                lines, seq = self.takePendingWithoutLock()
+            self.writeWithoutLock(lines, seq)
+
+    def takePendingWithoutLock(self):
+        # Hands the queued lines to the writer and starts a new queue
+        lines = self.pendingLines
+        self.pendingLines = []
+        return lines, self.seq
+
+    def writeWithoutLock(self, lines, seq):
+        # Call with writerLock held, not lock: appends keep queueing during the sync
+        if len(lines) == 0:
+            return
+        self.segmentFile.write('\n'.join(lines) + '\n')
+        self.segmentFile.flush()
+        if self.syncToDisk:
+            os.fsync(self.segmentFile.fileno())
+        with self.lock:
+            self.flushedSeq = seq
+            self.flushCondition.notify_all()
+
+    def waitForFlush(self, seq, timeoutSeconds=1.0):
+        # For callers that must not reply before their record is durable
+        with self.lock:
+            return self.flushCondition.wait_for(lambda: self.flushedSeq >= seq, timeoutSeconds)
+
+    #
+    # Snapshots
+    #
+    def writeSnapshot(self, listGames):
+        # Starts a new log segment, then writes every game that listGames returns. The games
+        # are listed after the cut, so none whose create record is in an old segment is
+        # missed. Each game is copied under its own lock and carries the seq of its last
+        # record, so mutations can continue meanwhile. Older segments are deleted once the
+        # snapshot is safely on disk.
+        with self.registerLock:
+            with self.writerLock:
+                with self.lock:
+                    lines, snapshotSeq = self.takePendingWithoutLock()
+                self.writeWithoutLock(lines, snapshotSeq)
+                self.openSegmentWithoutLock(snapshotSeq + 1)
+            games = listGames()
+        oldSegments = [path for path in self.segmentPaths()
+                       if int(os.path.basename(path)[len('journal-'):-len('.log')]) <= snapshotSeq]
+
+        gameSnapshots = []
+        for game in games:
+            with game.lock:
+                if not game.closed:
+                    gameSnapshots.append(game.toSnapshotDict())
+
+        path = os.path.join(self.dataDir, 'snapshot-{}.json'.format(snapshotSeq))
+        temporaryPath = path + '.tmp'
+        with open(temporaryPath, 'w', encoding='utf-8') as file:
+            json.dump({'seq': snapshotSeq, 'games': gameSnapshots}, file, separators=(',', ':'))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporaryPath, path)
+
+        for oldPath in oldSegments:
+            os.remove(oldPath)
+        for name in os.listdir(self.dataDir):
+            if name.startswith('snapshot-') and name.endswith('.json') and os.path.join(self.dataDir, name) != path:
+                os.remove(os.path.join(self.dataDir, name))
+        gameLog.logEvent('snapshotWritten', gameCount=len(gameSnapshots), seq=snapshotSeq)
+
+    def startSnapshots(self, registry, intervalSeconds=defaultSnapshotIntervalSeconds):
+        def snapshotLoop():
+            while True:
+                time.sleep(intervalSeconds)
+                self.writeSnapshot(registry.values)
+
+        self.snapshotThread = threading.Thread(target=snapshotLoop, name='game-journal-snapshots', daemon=True)
+        self.snapshotThread.start()
+
+    #
+    # Recovery
+    #
+    def recover(self):
+        # Returns {gameId: GameSession} rebuilt from the latest snapshot and the log after it.
+        # Call before start(); the games come back attached to this journal.
+        games = {}
+        snapshotPath = self.latestSnapshotPath()
+        if snapshotPath is not None:
+            with open(snapshotPath, encoding='utf-8') as file:
+                snapshot = json.load(file)
+            self.seq = snapshot['seq']
+            for gameSnapshot in snapshot['games']:
+                game = GameSession.fromSnapshotDict(gameSnapshot)
+                game.showLog = False
+                game.replaying = True
+                games[game.id] = game
+
+        replayedCount = 0
+        for path in self.segmentPaths():
+            with open(path, encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break # a torn write at the end of the log
+                    self.seq = max(self.seq, record['seq'])
+                    if self.replayRecord(games, record):
+                        replayedCount += 1
+
+        for game in games.values():
+            game.showLog = True
+            game.replaying = False
+            game.journal = self
+            game.scheduleTurnTimer() # a turn that was running at shutdown
+        self.flushedSeq = self.seq
+        gameLog.logEvent('recovered', gameCount=len(games), replayedCount=replayedCount)
+        return games
+
+    def replayRecord(self, games, record):
+        gameId = record['game']
+        op = record['op']
+        if op == 'create':
+            if gameId in games and games[gameId].journalSeq >= record['seq']:
+                return False
+            game = GameSession.fromSnapshotDict(record['args'][0])
+            game.showLog = False
+            game.replaying = True
+            game.journalSeq = record['seq']
+            games[gameId] = game
+            return True
+
+        game = games.get(gameId)
+        if game is None or record['seq'] <= game.journalSeq:
+            return False
+        if op == 'close':
+            del games[gameId]
+            return True
+
+        t = record['t']
+        game.clock = lambda: t
+        try:
+            replayMethods[op](game, *record['args'])
+        except GameError as err:
+            # The original call failed the same way after it was journaled
+            pass
+        finally:
+            game.clock = time.time
+        game.journalSeq = record['seq']
+        return True
@@ -0,0 +1,146 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+import zlib
+
+# Game events are logged as one JSON object per line, e.g.
+#   {"t":1792300000.123,"level":"INFO","game":"abcdefgh","event":"turnStart","player":"matt"}
+# Request threads only put the record on a queue; a listener thread formats and writes it.
+
+logger = logging.getLogger('hatgame')
+
+defaultLevel = logging.INFO
+sampleRate = 1.0 # fraction of games whose INFO and DEBUG events are logged
+gameLevels = {} # per-game overrides of defaultLevel, which also bypass sampling
+queueListener = None
+
+levelNames = {'DEBUG': logging.DEBUG, 'INFO': logging.INFO, 'WARNING': logging.WARNING,
+              'ERROR': logging.ERROR, 'OFF': logging.CRITICAL + 1}
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'t': round(record.created, 3), 'level': record.levelname}
+        gameId = getattr(record, 'gameId', None)
+        if gameId is not None:
+            entry['game'] = gameId
+        entry['event'] = record.getMessage()
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['traceback'] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(',', ':'), default=str)
+
+class InProcessQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # The listener is in this process, so the record is queued as it is and all the
+        # formatting, traceback included, happens on the listener thread
+        return record
+
+def parseLevel(name):
+    return levelNames[name.upper()]
+
+def configure(level=None, rate=None, stream=None, asynchronous=True):
+    # Sets up the handlers, by default from HATGAME_LOG_LEVEL (DEBUG, INFO, WARNING, ERROR
+    # or OFF) and HATGAME_LOG_SAMPLE (0 to 1). With asynchronous off, records are written
+    # on the calling thread, which is only useful for comparison.
+    global defaultLevel, sampleRate, queueListener
+    if level is None:
+        level = parseLevel(os.environ.get('HATGAME_LOG_LEVEL', 'INFO'))
+    if rate is None:
+        rate = float(os.environ.get('HATGAME_LOG_SAMPLE', '1.0'))
+    defaultLevel = level
+    sampleRate = rate
+
+    if queueListener is not None:
+        queueListener.stop()
+        queueListener = None
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+    streamHandler = logging.StreamHandler(stream if stream is not None else sys.stdout)
+    streamHandler.setFormatter(JsonLinesFormatter())
+    if asynchronous:
+        recordQueue = queue.SimpleQueue()
+        logger.addHandler(InProcessQueueHandler(recordQueue))
+        queueListener = logging.handlers.QueueListener(recordQueue, streamHandler)
+        queueListener.start()
+    else:
+        logger.addHandler(streamHandler)
+    logger.setLevel(logging.DEBUG) # levels are decided per game, before a record is made
+    logger.propagate = False
+
+def flush():
+    # Writes out everything queued so far
+    if queueListener is not None:
+        queueListener.stop()
+        queueListener.start()
+
+@atexit.register
+def stopListener():
+    if queueListener is not None:
+        queueListener.stop()
+
+def setGameLevel(gameId, level):
+    # level None returns the game to the default level and sampling
+    if level is None:
+        gameLevels.pop(gameId, None)
+    else:
+        gameLevels[gameId] = level
+
+def gameLevel(gameId):
+    level = gameLevels.get(gameId)
+    if level is not None:
+        return level
+    if sampleRate < 1.0 and zlib.crc32(gameId.encode('utf-8')) % 10000 >= sampleRate * 10000:
+        # Games outside the sample still log warnings and errors
+        return max(defaultLevel, logging.WARNING)
+    return defaultLevel
+
+def logGameEvent(gameId, event, level=logging.INFO, **fields):
+    if level < gameLevel(gameId):
+        return
+    logger.log(level, event, extra={'gameId': gameId, 'fields': fields})
+
+def logEvent(event, level=logging.INFO, **fields):
+    if level < defaultLevel:
+        return
+    logger.log(level, event, extra={'gameId': None, 'fields': fields})
+
+class ErrorReporter:
+    """Logs errors at most once per intervalSeconds for each place and error type; the
+    next report says how many were dropped in between. Expected errors, such as a player
+    acting out of turn, are warnings without a traceback."""
+    def __init__(self, intervalSeconds=10.0):
+        self.intervalSeconds = intervalSeconds
+        self.lock = threading.Lock()
+        self.lastReportTimes = {}
+        self.suppressedCounts = {}
+
+    def report(self, where, err, gameId=None, expected=False):
+        key = (where, type(err).__name__)
+        now = time.time()
+        with self.lock:
+            if now - self.lastReportTimes.get(key, 0.0) < self.intervalSeconds:
+                self.suppressedCounts[key] = self.suppressedCounts.get(key, 0) + 1
+                return
+            self.lastReportTimes[key] = now
+            suppressed = self.suppressedCounts.pop(key, 0)
+
+        level = logging.WARNING if expected else logging.ERROR
+        if gameId is not None and level < gameLevel(gameId):
+            return
+        fields = {'where': where, 'error': '{}: {}'.format(type(err).__name__, err)}
+        if suppressed > 0:
+            fields['suppressed'] = suppressed
+        logger.log(level, 'error', exc_info=None if expected else err,
+                   extra={'gameId': gameId, 'fields': fields})
+
+errorReporter = ErrorReporter()
+
+def reportError(where, err, gameId=None, expected=False):
+    errorReporter.report(where, err, gameId, expected)
@@ -0,0 +1,122 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from python.gameSession import GameMainPhase
+from python import gameLog
+
+# How long a game may sit untouched in each main phase before it is dropped. Finished games
+# go quickly; a game still collecting phrases may be waiting on slow writers.
+defaultPhaseTTLSeconds = {
+    GameMainPhase.Write: 24 * 60 * 60,
+    GameMainPhase.MultiWord: 6 * 60 * 60,
+    GameMainPhase.SingleWord: 6 * 60 * 60,
+    GameMainPhase.Charade: 6 * 60 * 60,
+    GameMainPhase.Done: 15 * 60,
+}
+defaultMaxGames = 10000
+defaultMaxPhrases = 2000000 # phrases across all resident games, as a proxy for memory use
+defaultSweepIntervalSeconds = 60.0
+
+class GameRegistry:
+    """Holds the active GameSessions by ID. Looks like the dict it replaced, but records the
+    last time each game was used, keeps games in least-recently-used order so the oldest can
+    be evicted when a cap is reached, and can run a background sweeper that drops games
+    that have been idle longer than their phase allows. Evicted games are closed, which ends
+    their event streams."""
+    def __init__(self, maxGames=defaultMaxGames, maxPhrases=defaultMaxPhrases, phaseTTLSeconds=None):
+        self.maxGames = maxGames
+        self.maxPhrases = maxPhrases
+        self.phaseTTLSeconds = dict(defaultPhaseTTLSeconds)
+        if phaseTTLSeconds is not None:
+            self.phaseTTLSeconds.update(phaseTTLSeconds)
+
+        self.lock = threading.Lock()
+        self.games = OrderedDict() # least recently used first
+        self.lastActivity = {}
+        self.evictedCount = 0
+        self.expiredCount = 0
+        self.sweeperThread = None
+
+    def __getitem__(self, gameId):
+        with self.lock:
+            game = self.games[gameId]
+            self.games.move_to_end(gameId)
+            self.lastActivity[gameId] = time.time()
+            return game
+
+    def __setitem__(self, gameId, game):
+        with self.lock:
+            self.games[gameId] = game
+            self.games.move_to_end(gameId)
+            self.lastActivity[gameId] = time.time()
+            evictedGames = self.evictOverCapWithoutLock()
+        for evictedGame in evictedGames:
+            evictedGame.close()
+
+    def __contains__(self, gameId):
+        return gameId in self.games
+
+    def __len__(self):
+        return len(self.games)
+
+    def keys(self):
+        with self.lock:
+            return list(self.games.keys())
+
+    def values(self):
+        with self.lock:
+            return list(self.games.values())
+
+    def remove(self, gameId):
+        with self.lock:
+            game = self.removeWithoutLock(gameId)
+        if game is not None:
+            game.close()
+
+    def removeWithoutLock(self, gameId):
+        self.lastActivity.pop(gameId, None)
+        gameLog.setGameLevel(gameId, None)
+        return self.games.pop(gameId, None)
+
+    def evictOverCapWithoutLock(self):
+        # Returns the games that were evicted, for the caller to close outside the lock
+        evictedGames = []
+        phraseCount = sum(len(game.phraseTexts) for game in self.games.values())
+        while len(self.games) > 1 and (len(self.games) > self.maxGames or phraseCount > self.maxPhrases):
+            gameId, game = next(iter(self.games.items()))
+            self.removeWithoutLock(gameId)
+            phraseCount -= len(game.phraseTexts)
+            evictedGames.append(game)
+            self.evictedCount += 1
+            gameLog.logGameEvent(gameId, 'evicted', logging.WARNING, gameCount=len(self.games))
+        return evictedGames
+
+    def expireIdleGames(self, now=None):
+        if now is None:
+            now = time.time()
+        expiredGames = []
+        with self.lock:
+            for gameId, game in list(self.games.items()):
+                ttl = self.phaseTTLSeconds.get(game.mainPhase)
+                if ttl is not None and now - self.lastActivity[gameId] > ttl:
+                    self.removeWithoutLock(gameId)
+                    expiredGames.append(game)
+                    self.expiredCount += 1
+                    gameLog.logGameEvent(gameId, 'expired', phase=game.mainPhase.name)
+        for game in expiredGames:
+            game.close()
+        return len(expiredGames)
+
+    def startSweeper(self, intervalSeconds=defaultSweepIntervalSeconds):
+        if self.sweeperThread is not None:
+            return
+
+        def sweep():
+            while True:
+                time.sleep(intervalSeconds)
+                self.expireIdleGames()
+
+        self.sweeperThread = threading.Thread(target=sweep, name='game-registry-sweeper', daemon=True)
+        self.sweeperThread.start()
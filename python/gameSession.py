@@ -2,17 +2,36 @@ import os
 import sys
 import random
 import threading
+import logging
 import copy
-from datetime import datetime
+import time
+from dataclasses import dataclass, field
 from enum import Enum
 from collections.abc import Iterable
 
+from python.stateDelta import makePatch
+from python.phraseHat import PhraseHat
+from python import notificationBus
+from python import gameLog
+from python import metrics
+from python import fastJson
+from python import compression
+from python.refreshCoalescer import refreshCoalescer
+from python.scheduler import scheduler
+
 
 minContinuationTurnSeconds = 5.0
+recentEventCount = 64 # delta events kept so a subscriber that falls behind can catch up
 
 class GameError(Exception):
     pass
 
+class BatchError(GameError):
+    # Raised by applyBatch for the operation at index; none of the batch was applied
+    def __init__(self, index, err):
+        super().__init__('operation {}: {}'.format(index, err))
+        self.index = index
+
 class GameMainPhase(Enum):
     Write = 1,
     MultiWord = 2,
@@ -26,26 +45,109 @@ class GameSubPhase(Enum):
     Started = 2,
     ConfirmingPhrases = 3,
     
+# Player, Team and GameSession use __slots__: a server holds many idle games, and an
+# instance dict costs more than most of their fields
+
 class Player:
+    __slots__ = ('id', 'phrases')
+
     def __init__(self, id):
         self.id = id
-        self.refreshEvent = threading.Event()
         self.phrases = []
 
 class Team:
+    __slots__ = ('teamIdx', 'activePlayerIdx', 'players', 'score')
+
     def __init__(self, teamIdx, players):
         self.teamIdx = teamIdx
         self.activePlayerIdx = 0
         self.players = players
         self.score = 0
 
+def formatEvent(eventType, version, data):
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(version, eventType, data)
+
+# Sent when a game is closed, so clients stop reconnecting to a stream that no longer exists
+closedEvent = 'event: closed\ndata: {}\n\n'
+
+# Every player gets one of two projections of the state. The hat holder, whose turn it is,
+# gets the full state; teammates, opponents and spectators get the public one, without the
+# contents of the hat. The order of the hat gives away the phrases still to come, and in a
+# large game it is most of the state.
+def publicStateDict(state):
+    if state['hat'] is None:
+        return state
+    result = dict(state)
+    result['hat'] = None
+    return result
+
+def publicPatch(patch):
+    # The part of a patch between two full states that applies to their public states
+    return [operation for operation in patch if operation['path'] != '/hat']
+
+@dataclass(frozen=True, slots=True)
+class PublishedState:
+    """One version of a game as clients see it: the full state dict, whose lists are
+    tuples, plus the delta events of the versions before it. Made under the game lock at the
+    end of a mutation and replaced, not modified, by the next one, so readers take it with a
+    single attribute load and never see a half-applied mutation. Being frozen only stops the
+    fields being reassigned: state and its playerWritingStatus are plain dicts, shared with
+    every reader and with publicStateDict copies, and nothing enforces that they are only
+    read."""
+    version: int
+    state: dict
+    # (version, delta event text, the same for the public state, hat holder at the version
+    # before, hat holder), oldest first
+    events: tuple
+    etag: str
+    hatHolderId: str = None
+    serialized: dict = field(default=None, compare=False) # (projection, encoding) -> bytes, filled in by readers
+
+    def projectionFor(self, playerId):
+        # 'full' or 'public'; playerId is None for a spectator
+        return 'full' if playerId is not None and playerId == self.hatHolderId else 'public'
+
+    def getState(self, projection):
+        return self.state if projection == 'full' else publicStateDict(self.state)
+
+    def getETag(self, projection):
+        return self.etag if projection == 'full' else self.etag + '-public'
+
+    def getSerialized(self, projection='full', encoding=None):
+        # The JSON of a projection, compressed if an encoding is given. This cache is the only
+        # write after publishing. Two readers may both build the bytes; they are identical and
+        # either one is kept.
+        serialized = self.serialized
+        if serialized is None:
+            serialized = {}
+            object.__setattr__(self, 'serialized', serialized)
+        body = serialized.get((projection, encoding))
+        if body is None:
+            if encoding is None:
+                result = dict(self.getState(projection))
+                result['stateVersion'] = self.version
+                body = fastJson.dumps(result)
+            else:
+                body = compression.compress(self.getSerialized(projection), encoding)
+            serialized[(projection, encoding)] = body
+        return body
+
 class GameSession:
+    __slots__ = ('id', 'phrasesPerPlayer', 'secondsPerTurn', 'videoURL', 'playersByID', 'teams',
+                 'phraseTexts', 'mainPhase', 'subPhase', 'phrasesInHat', 'turnStartTime',
+                 'activeTeamIdx', 'previousRoundPhrases', 'clickedPhrases', 'broadcastPhrase',
+                 'continuationTurnSeconds', 'leftoverTurnTime',
+                 # runtime state, see initRuntimeState
+                 'showLog', 'lock', 'clock', 'journal', 'journalSeq', 'replaying', 'closed',
+                 'turnTimer', 'lastRefreshTime', 'refreshPending', 'publishedPhase',
+                 'stateVersion', 'published', 'serializedPhraseTexts', 'cacheToken', 'spectatorFeed',
+                 'batchRecords', 'batchChanged')
+
     def __init__(self, id, teamPlayerLists, phrasesPerPlayer, secondsPerTurn, videoURL):
-        self.showLog = True
         self.id = id
-        self.lock = threading.Lock() # Used to prevent mutation APIs from interleaving
+        self.initRuntimeState()
         
-        print('game start', id, phrasesPerPlayer, secondsPerTurn, teamPlayerLists)
+        self.log('gameStart', phrasesPerPlayer=phrasesPerPlayer, secondsPerTurn=secondsPerTurn, teams=teamPlayerLists)
         self.phrasesPerPlayer = phrasesPerPlayer
         self.secondsPerTurn = secondsPerTurn
         self.videoURL = videoURL
@@ -81,7 +183,9 @@ class GameSession:
             team = Team(teamIdx, teamPlayers)
             self.teams.append(team)
 
-        self.allPhrases = []
+        # Phrases are stored once and referred to everywhere else, including by clients, by
+        # their index in phraseTexts. Clients fetch the text table once after writing ends.
+        self.phraseTexts = []
         self.mainPhase = GameMainPhase.Write
         self.subPhase = GameSubPhase.Invalid
         
@@ -93,9 +197,118 @@ class GameSession:
         self.activeTeamIdx = -1
         #self.previousRoundPhrasesPlayerName = ''
         self.previousRoundPhrases = []
-        self.clickedPhrases = []
+        self.clickedPhrases = PhraseHat()
         self.broadcastPhrase = None
         self.continuationTurnSeconds = 0.0
+        self.leftoverTurnTime = 0.0
+
+    def initRuntimeState(self):
+        # Everything that is not part of the game itself, shared by __init__ and fromSnapshotDict
+        self.showLog = True
+        self.lock = metrics.InstrumentedLock() # Used to prevent mutation APIs from interleaving
+        self.clock = time.time # replaced while replaying the journal, so turns see their original times
+
+        # When set, every successful mutation is appended to this GameJournal. journalSeq is
+        # the sequence number of the last record for this game.
+        self.journal = None
+        self.journalSeq = 0
+        self.replaying = False # skips building deltas nobody is subscribed to yet
+
+        self.closed = False # set once the game is dropped from the registry; streams then end
+        self.turnTimer = None # ScheduledCall that ends the running turn when its time is up
+
+        # Used by refreshCoalescer to batch the refreshes of a burst of mutations
+        self.lastRefreshTime = 0.0
+        self.refreshPending = False
+        self.publishedPhase = None
+
+        # Every committed mutation advances stateVersion and publishes a new PublishedState.
+        # The event stream sends a snapshot on connect followed by the deltas between
+        # versions, and /api/gamestate serves the published JSON with its version as ETag.
+        # Mutations hold the lock; reads only load self.published, which also keeps the
+        # last recentEventCount deltas.
+        self.stateVersion = 0
+        self.published = None
+        self.serializedPhraseTexts = None
+        self.cacheToken = '%08x' % random.getrandbits(32) # keeps ETags distinct across games that reuse an id
+        self.spectatorFeed = None # see python/spectators.py
+
+        # While applyBatch runs, the journal records of its operations, written as one record
+        # when the batch commits, and whether any of them changed the state
+        self.batchRecords = None
+        self.batchChanged = False
+
+    def toSnapshotDict(self):
+        # Everything needed to rebuild the game with fromSnapshotDict; call with the lock held
+        return {
+            'id': self.id,
+            'phrasesPerPlayer': self.phrasesPerPlayer,
+            'secondsPerTurn': self.secondsPerTurn,
+            'videoURL': self.videoURL,
+            'players': {player.id: list(player.phrases) for player in self.playersByID.values()},
+            'teams': [{'players': [player.id for player in team.players],
+                       'activePlayerIdx': team.activePlayerIdx,
+                       'score': team.score} for team in self.teams],
+            'phraseTexts': list(self.phraseTexts),
+            'mainPhase': self.mainPhase.name,
+            'subPhase': self.subPhase.name,
+            'phrasesInHat': None if self.phrasesInHat is None else self.phrasesInHat.toList(),
+            'turnStartTime': self.turnStartTime,
+            'activeTeamIdx': self.activeTeamIdx,
+            'previousRoundPhrases': list(self.previousRoundPhrases),
+            'clickedPhrases': self.clickedPhrases.toList(),
+            'broadcastPhrase': self.broadcastPhrase,
+            'continuationTurnSeconds': self.continuationTurnSeconds,
+            'leftoverTurnTime': self.leftoverTurnTime,
+            'stateVersion': self.stateVersion,
+            'journalSeq': self.journalSeq,
+        }
+
+    @classmethod
+    def fromSnapshotDict(cls, snapshot):
+        game = cls.__new__(cls)
+        game.id = snapshot['id']
+        game.initRuntimeState()
+        game.loadSnapshotDictWithoutLock(snapshot)
+        return game
+
+    def loadSnapshotDictWithoutLock(self, snapshot):
+        # Replaces the game state, but not the runtime state, with that of a snapshot
+        self.phrasesPerPlayer = snapshot['phrasesPerPlayer']
+        self.secondsPerTurn = snapshot['secondsPerTurn']
+        self.videoURL = snapshot['videoURL']
+
+        self.playersByID = {}
+        for playerID, phrases in snapshot['players'].items():
+            player = Player(playerID)
+            player.phrases = list(phrases)
+            self.playersByID[playerID] = player
+        self.teams = []
+        for teamIdx, teamSnapshot in enumerate(snapshot['teams']):
+            team = Team(teamIdx, [self.playersByID[playerID] for playerID in teamSnapshot['players']])
+            team.activePlayerIdx = teamSnapshot['activePlayerIdx']
+            team.score = teamSnapshot['score']
+            self.teams.append(team)
+
+        self.phraseTexts = list(snapshot['phraseTexts'])
+        self.mainPhase = GameMainPhase[snapshot['mainPhase']]
+        self.subPhase = GameSubPhase[snapshot['subPhase']]
+        self.phrasesInHat = None if snapshot['phrasesInHat'] is None else PhraseHat(snapshot['phrasesInHat'])
+        self.turnStartTime = snapshot['turnStartTime']
+        self.activeTeamIdx = snapshot['activeTeamIdx']
+        self.previousRoundPhrases = list(snapshot['previousRoundPhrases'])
+        self.clickedPhrases = PhraseHat(snapshot['clickedPhrases'])
+        self.broadcastPhrase = snapshot['broadcastPhrase']
+        self.continuationTurnSeconds = snapshot['continuationTurnSeconds']
+        self.leftoverTurnTime = snapshot['leftoverTurnTime']
+        self.stateVersion = snapshot['stateVersion']
+        self.journalSeq = snapshot['journalSeq']
+
+    def journalWithoutLock(self, op, args, now=None):
+        if self.batchRecords is not None:
+            self.batchRecords.append([op, args, self.clock() if now is None else now])
+        elif self.journal is not None:
+            self.journalSeq = self.journal.append(self.id, op, args, self.clock() if now is None else now)
     
     def getStateDict(self):
         result = {}
@@ -108,7 +321,7 @@ class GameSession:
             for player in team.players:
                 teamPlayerList.append(player.id)
                 #allPlayersList.append(player.id)
-            teamList.append(teamPlayerList)
+            teamList.append(tuple(teamPlayerList))
             teamScores.append(team.score)
             if self.mainPhase in [GameMainPhase.Write, GameMainPhase.Done]:
                 # In this case, don't display an active player
@@ -121,47 +334,240 @@ class GameSession:
             for player in team.players:
                 playerWritingStatus[player.id] = (len(player.phrases) == self.phrasesPerPlayer)
 
-        secondsRemaining = -1.0
-        #if self.turnStartTime is not None:
-        if self.subPhase == GameSubPhase.WaitForStart or \
-           self.subPhase == GameSubPhase.Started:
-
-            elapsedSeconds = 0.0
-            if self.subPhase == GameSubPhase.Started:
-                elapsedSeconds = (datetime.now() - self.turnStartTime).total_seconds()
-
-            if self.continuationTurnSeconds == 0.0:
-                secondsRemaining = max(0.0, self.secondsPerTurn - elapsedSeconds)
-            else:
-                secondsRemaining = max(0.0, self.continuationTurnSeconds - elapsedSeconds)
-        result['secondsRemaining'] = secondsRemaining
+        # Clients count down from these instead of being sent a remaining time, so the state
+        # only changes when a turn starts or ends
+        result['turnSeconds'] = self.turnSeconds()
+        result['turnEndTime'] = self.turnEndTime()
 
         result['phrasesPerPlayer'] = self.phrasesPerPlayer
         result['secondsPerTurn'] = self.secondsPerTurn
         result['videoURL'] = str(self.videoURL)
 
-        result['teams'] = teamList
+        # Sequences are tuples so a published state cannot be changed by later mutations
+        result['teams'] = tuple(teamList)
         result['playerWritingStatus'] = playerWritingStatus
-        result['scores'] = teamScores
+        result['scores'] = tuple(teamScores)
         
-        result['hat'] = self.phrasesInHat
+        result['hat'] = None if self.phrasesInHat is None else self.phrasesInHat.toTuple()
+        result['hatSize'] = None if self.phrasesInHat is None else len(self.phrasesInHat)
         result['mainPhase'] = str(self.mainPhase)
         result['subPhase'] = str(self.subPhase)
         result['activeTeamIndex'] = self.activeTeamIdx
-        result['activePlayerIndexPerTeam'] = activePlayerIndexPerTeam
+        result['activePlayerIndexPerTeam'] = tuple(activePlayerIndexPerTeam)
         #result['previousRoundPhrasesPlayerName'] = self.previousRoundPhrasesPlayerName
-        result['previousRoundPhrases'] = self.previousRoundPhrases
-        result['clickedPhrases'] = self.clickedPhrases
+        result['previousRoundPhrases'] = tuple(self.previousRoundPhrases)
+        result['clickedPhrases'] = self.clickedPhrases.toTuple()
         result['prevPhrase'] = self.broadcastPhrase
+        result['phraseTableSize'] = self.phraseTableSize()
+        return result
+
+    def hatHolderId(self):
+        # The player who may see the hat: whoever's turn it is, while a round is being played
+        if self.mainPhase in [GameMainPhase.Write, GameMainPhase.Done]:
+            return None
+        return self.activePlayer().id
+
+    def phraseTextList(self, phraseIds):
+        phraseTexts = self.phraseTexts
+        return [phraseTexts[phraseId] for phraseId in phraseIds]
+
+    def phraseTableSize(self):
+        # The phrase text stays private until everyone has finished writing
+        if self.mainPhase == GameMainPhase.Write:
+            return 0
+        return len(self.phraseTexts)
+
+    def getSerializedPhraseTexts(self, encoding=None):
+        # Returns the ETag and JSON bytes of the phrase ID -> text table, compressed if an
+        # encoding is given. It cannot change once writing is over, so each form is only
+        # built once.
+        # phraseTableSize is only nonzero once no more phrases can be added, so this reads the
+        # table without the lock.
+        phraseCount = self.getPublishedState().state['phraseTableSize']
+        if phraseCount == 0:
+            return '{}-phrases-0'.format(self.cacheToken), b'{"phrases":[]}'
+        serializedByEncoding = self.serializedPhraseTexts
+        if serializedByEncoding is None:
+            serializedByEncoding = {None: fastJson.dumps({'phrases': self.phraseTexts[:phraseCount]})}
+            self.serializedPhraseTexts = serializedByEncoding
+        serialized = serializedByEncoding.get(encoding)
+        if serialized is None:
+            serialized = compression.compress(serializedByEncoding[None], encoding)
+            serializedByEncoding[encoding] = serialized
+        return '{}-phrases-{}'.format(self.cacheToken, phraseCount), serialized
+
+    def turnSeconds(self):
+        # Length of the current or next turn, or -1 when no turn is being played
+        if self.subPhase != GameSubPhase.WaitForStart and \
+           self.subPhase != GameSubPhase.Started:
+            return -1.0
+        if self.continuationTurnSeconds == 0.0:
+            return float(self.secondsPerTurn)
+        else:
+            return self.continuationTurnSeconds
+
+    def turnEndTime(self):
+        # Server timestamp (seconds since the epoch) when the running turn runs out of time
+        if self.subPhase != GameSubPhase.Started:
+            return None
+        return self.turnStartTime + self.turnSeconds()
+
+    def markChanged(self):
+        with self.lock:
+            self.markChangedWithoutLock()
+
+    def markChangedWithoutLock(self):
+        # Called at the end of every mutation: advances the version and records the delta
+        # from the previous version for event stream subscribers
+        if self.batchRecords is not None:
+            self.batchChanged = True # a batch is published once, after its last operation
+            return
+        self.stateVersion += 1
+        if self.replaying:
+            self.published = None
+            return
+        state = self.getStateDict()
+        hatHolderId = self.hatHolderId()
+        events = ()
+        if self.published is not None:
+            delta = {
+                'version': self.stateVersion,
+                'baseVersion': self.published.version,
+                'patch': makePatch(self.published.state, state)
+            }
+            text = formatEvent('delta', self.stateVersion, fastJson.dumpsText(delta))
+            publicText = text
+            if any(operation['path'] == '/hat' for operation in delta['patch']):
+                delta['patch'] = publicPatch(delta['patch'])
+                publicText = formatEvent('delta', self.stateVersion, fastJson.dumpsText(delta))
+            event = (self.stateVersion, text, publicText, self.published.hatHolderId, hatHolderId)
+            events = self.published.events[-(recentEventCount - 1):] + (event,)
+        self.published = PublishedState(self.stateVersion, state, events,
+                                        '{}-{}'.format(self.cacheToken, self.stateVersion), hatHolderId)
+
+    def getPublishedState(self):
+        # The newest PublishedState. Only the first read after creation or journal replay
+        # takes the lock, to publish the current version.
+        published = self.published
+        if published is None:
+            with self.lock:
+                if self.published is None:
+                    self.published = PublishedState(self.stateVersion, self.getStateDict(), (),
+                                                    '{}-{}'.format(self.cacheToken, self.stateVersion),
+                                                    self.hatHolderId())
+                published = self.published
+        return published
+
+    @metrics.timedGameMethod
+    def getSerializedState(self, encoding=None):
+        # Returns the version, ETag and JSON bytes of the current full state, compressed if an
+        # encoding is given; each form is built at most once per version
+        published = self.getPublishedState()
+        return published.version, published.etag, published.getSerialized('full', encoding)
+
+    @metrics.timedGameMethod
+    def getSerializedStateFor(self, playerId, encoding=None):
+        # As getSerializedState, for the projection playerId may see; None for a spectator
+        published = self.getPublishedState()
+        projection = published.projectionFor(playerId)
+        return published.version, published.getETag(projection), published.getSerialized(projection, encoding)
+
+    def getSnapshotEvent(self, playerId=None):
+        published = self.getPublishedState()
+        serializedState = published.getSerialized(published.projectionFor(playerId))
+        payload = '{{"version":{},"serverTime":{},"state":{}}}'.format(published.version, time.time(), serializedState.decode('utf-8'))
+        return published.version, formatEvent('snapshot', published.version, payload)
+
+    def getEventsSince(self, version, playerId=None):
+        # Returns the (version, pre-serialized event) pairs after version, for the projection
+        # playerId sees. Returns None if some have already fallen out of the published events,
+        # or if the player took or handed on the hat in between: either way the subscriber
+        # needs a new snapshot.
+        published = self.getPublishedState()
+        if version >= published.version:
+            return []
+        events = published.events
+        if len(events) == 0 or events[0][0] > version + 1:
+            return None
+        result = []
+        for eventVersion, text, publicText, baseHatHolderId, hatHolderId in events:
+            if eventVersion <= version:
+                continue
+            holdsHat = playerId is not None and playerId == hatHolderId
+            if holdsHat != (playerId is not None and playerId == baseHatHolderId):
+                return None
+            result.append((eventVersion, text if holdsHat else publicText))
         return result
 
+    @metrics.timedGameMethod
+    def getCatchUpEvents(self, version, playerId=None):
+        # Returns the newest version and the event text a subscriber at version should be sent
+        events = self.getEventsSince(version, playerId)
+        if events is None:
+            newVersion, snapshot = self.getSnapshotEvent(playerId)
+            return newVersion, [snapshot]
+        if len(events) == 0:
+            return version, []
+        return events[-1][0], [text for eventVersion, text in events]
+
     def signalRefresh(self):
-        for player in self.playersByID.values():
-            player.refreshEvent.set()
+        # Wakes every event stream for this game, in this process or, with a socket bus,
+        # in any other. Refreshes within the same phase may be batched; a phase change is
+        # sent right away.
+        state = self.getPublishedState().state
+        phase = (state['mainPhase'], state['subPhase'])
+        immediate = self.closed or phase != self.publishedPhase
+        self.publishedPhase = phase
+        refreshCoalescer.signal(self, immediate)
+
+    def close(self):
+        # Wakes every subscriber so event streams notice the game is gone and finish
+        with self.lock:
+            self.closed = True
+            self.cancelTurnTimerWithoutLock()
+            self.journalWithoutLock('close', [])
+        self.signalRefresh()
+
+    def scheduleTurnTimer(self):
+        with self.lock:
+            self.scheduleTurnTimerWithoutLock()
+
+    def scheduleTurnTimerWithoutLock(self):
+        # The server, not the active player's browser, ends a turn whose time is up. Not
+        # armed during replay; recovery arms the timer of a turn still running afterwards.
+        self.cancelTurnTimerWithoutLock()
+        if self.replaying or self.subPhase != GameSubPhase.Started:
+            return
+        timer = None
+        def expire():
+            self.expireTurn(timer)
+        timer = scheduler.callAt(self.turnEndTime(), expire)
+        self.turnTimer = timer
+
+    def cancelTurnTimerWithoutLock(self):
+        if self.turnTimer is not None:
+            scheduler.cancel(self.turnTimer)
+            self.turnTimer = None
+
+    @metrics.timedGameMethod
+    def expireTurn(self, timer):
+        # Runs on the scheduler thread. The turn may have ended or been skipped since the
+        # timer was set, in which case it is no longer this game's turnTimer.
+        with self.lock:
+            if timer is not self.turnTimer or self.closed or self.subPhase != GameSubPhase.Started:
+                return
+            self.endAndJournalPlayerTurnWithoutLock(self.activePlayer().id)
+        self.signalRefresh()
+
+    def addRefreshListener(self, listener):
+        notificationBus.getBus().subscribe(self.id, listener)
+
+    def removeRefreshListener(self, listener):
+        notificationBus.getBus().unsubscribe(self.id, listener)
 
-    def log(self, text):
+    def log(self, event, level=logging.INFO, **fields):
         if self.showLog:
-            print(text)
+            gameLog.logGameEvent(self.id, event, level, **fields)
 
     def activePlayer(self):
         activeTeam = self.teams[self.activeTeamIdx]
@@ -176,10 +582,10 @@ class GameSession:
     def assertMainPhase(self, validPhases):
         if isinstance(validPhases, Iterable):
             if self.mainPhase not in validPhases:
-                raise GameError('invalid main phase: ' + self.mainPhase)
+                raise GameError('invalid main phase: ' + str(self.mainPhase))
         else:
             if self.mainPhase != validPhases:
-                raise GameError('invalid main phase: ' + self.mainPhase)
+                raise GameError('invalid main phase: ' + str(self.mainPhase))
 
     def assertSubPhase(self, validPhases):
         if isinstance(validPhases, Iterable):
@@ -190,179 +596,284 @@ class GameSession:
                 raise GameError('invalid subphase: ' + str(self.subPhase))
 
     def newMainPhase(self, newMainPhase):
-        self.log('new main phase: ' + str(newMainPhase))
+        self.log('newMainPhase', phase=newMainPhase.name)
         self.mainPhase = newMainPhase
         self.subPhase = GameSubPhase.WaitForStart
-        self.phrasesInHat = list(self.allPhrases)
+        self.phrasesInHat = PhraseHat(range(len(self.phraseTexts)))
 
+    @metrics.timedGameMethod
     def recordPlayerPhrases(self, playerID, phrases):
         with self.lock:
-            self.log(playerID + ' phrases: ' + str(phrases))
+            self.recordPlayerPhrasesWithoutLock(playerID, phrases)
 
-            if playerID not in self.playersByID:
-                print('playersByID:', self.playersByID.keys())
-                raise GameError(playerID + ' is not a valid player')
+    def recordPlayerPhrasesWithoutLock(self, playerID, phrases):
+        self.log('recordPhrases', player=playerID, phraseCount=len(phrases))
 
-            player = self.playersByID[playerID]
-            
-            if len(player.phrases) > 0:
-                raise GameError(playerID + ' has already recorded phrases')
-
-            if len(phrases) != self.phrasesPerPlayer:
-                raise GameError('invalid number of phrases recorded: ' + str(len(phrases)))
-
-            for phrase in phrases:
-                if len(phrase) < 1 or phrase == ' ':
-                    raise GameError('phrases must contain at least 1 character') 
-
-            for phrase in phrases:
-                # If the phrase is already in the list (two players had the same idea) add trailing " " as a hack
-                # to make it unique
-                if phrase in self.allPhrases:
-                    original_phrase = phrase
-                    while phrase in self.allPhrases:
-                        phrase = phrase + " "
-                    self.log(f"Phrase '{original_phrase}' was already in the hat; adding '{phrase}' instead")
-                player.phrases.append(phrase)
-                self.allPhrases.append(phrase)
-
-            if self.allPhrasesAdded():
-                self.log('all phrases completed, starting multiword round')
-                self.newMainPhase(GameMainPhase.MultiWord)
-                #self.activeTeamIdx = random.randint(0, len(self.teams) - 1)
-                self.activeTeamIdx = 0
+        if playerID not in self.playersByID:
+            raise GameError(playerID + ' is not a valid player')
+
+        player = self.playersByID[playerID]
+        
+        if len(player.phrases) > 0:
+            raise GameError(playerID + ' has already recorded phrases')
+
+        if len(phrases) != self.phrasesPerPlayer:
+            raise GameError('invalid number of phrases recorded: ' + str(len(phrases)))
+
+        for phrase in phrases:
+            if len(phrase) < 1 or phrase == ' ':
+                raise GameError('phrases must contain at least 1 character') 
+
+        for phrase in phrases:
+            # Every phrase gets its own ID, so two players having the same idea needs no special handling
+            player.phrases.append(len(self.phraseTexts))
+            self.phraseTexts.append(phrase)
+        self.journalWithoutLock('recordPlayerPhrases', [playerID, phrases])
+
+        if self.allPhrasesAdded():
+            self.log('allPhrasesAdded')
+            self.newMainPhase(GameMainPhase.MultiWord)
+            #self.activeTeamIdx = random.randint(0, len(self.teams) - 1)
+            self.activeTeamIdx = 0
+        self.markChangedWithoutLock()
 
     def allPhrasesAdded(self):
-        for id, player in self.playersByID.items():
-            if len(player.phrases) < self.phrasesPerPlayer:
-                return False
-        return True
+        # Players record all of their phrases at once, so this is the same as checking that
+        # every player has written
+        return len(self.phraseTexts) >= len(self.playersByID) * self.phrasesPerPlayer
 
-    def startPlayerTurn(self, playerID):
+    @metrics.timedGameMethod
+    def startPlayerTurn(self, playerID, shuffleSeed=None):
+        # shuffleSeed is only passed when replaying the journal, to reproduce the same hat order
         with self.lock:
-            self.log(playerID + ' turn starting')
-
-            activePlayer = self.assertActivePlayer(playerID)
-            self.assertMainPhase([GameMainPhase.MultiWord, GameMainPhase.SingleWord, GameMainPhase.Charade])
-            self.assertSubPhase(GameSubPhase.WaitForStart)
-            
-            self.subPhase = GameSubPhase.Started
-            self.turnStartTime = datetime.now()
+            self.startPlayerTurnWithoutLock(playerID, shuffleSeed)
 
-            random.shuffle(self.phrasesInHat)
-            #for idx in range(0, min(self.phrasesPerTurn, len(self.phrasesInHat))):
-            #    self.activePhrases.append(self.phrasesInHat[idx])
+    def startPlayerTurnWithoutLock(self, playerID, shuffleSeed=None):
+        self.log('turnStart', player=playerID)
 
+        activePlayer = self.assertActivePlayer(playerID)
+        self.assertMainPhase([GameMainPhase.MultiWord, GameMainPhase.SingleWord, GameMainPhase.Charade])
+        self.assertSubPhase(GameSubPhase.WaitForStart)
+        
+        self.subPhase = GameSubPhase.Started
+        self.turnStartTime = self.clock()
+
+        if shuffleSeed is None:
+            shuffleSeed = random.getrandbits(32)
+        self.phrasesInHat.shuffle(random.Random(shuffleSeed))
+        #for idx in range(0, min(self.phrasesPerTurn, len(self.phrasesInHat))):
+        #    self.activePhrases.append(self.phrasesInHat[idx])
+        self.journalWithoutLock('startPlayerTurn', [playerID, shuffleSeed], self.turnStartTime)
+        self.scheduleTurnTimerWithoutLock()
+        self.markChangedWithoutLock()
+
+    @metrics.timedGameMethod
     def endPlayerTurn(self, playerID):
         with self.lock:
-            self.endPlayerTurnWithoutLock(playerID)
+            self.endAndJournalPlayerTurnWithoutLock(playerID)
+
+    def endAndJournalPlayerTurnWithoutLock(self, playerID):
+        # endPlayerTurnWithoutLock alone is also how a turn ends when its last phrase is
+        # guessed, which is journaled as the guess
+        now = self.clock()
+        self.endPlayerTurnWithoutLock(playerID, now)
+        self.journalWithoutLock('endPlayerTurn', [playerID], now)
             
-    def endPlayerTurnWithoutLock(self, playerID):
-        self.log(playerID + ' turn time complete')
+    def endPlayerTurnWithoutLock(self, playerID, now=None):
+        self.log('turnEnd', player=playerID)
         
         activePlayer = self.assertActivePlayer(playerID)
         self.assertMainPhase([GameMainPhase.MultiWord, GameMainPhase.SingleWord, GameMainPhase.Charade])
         self.assertSubPhase(GameSubPhase.Started)
         
-        turnTimeTaken = min((datetime.now() - self.turnStartTime).total_seconds(), self.secondsPerTurn)
+        if now is None:
+            now = self.clock()
+        turnTimeTaken = min(now - self.turnStartTime, self.secondsPerTurn)
         self.leftoverTurnTime = self.secondsPerTurn - turnTimeTaken
         self.continuationTurnSeconds = 0.0
         self.turnStartTime = None
+        self.cancelTurnTimerWithoutLock()
 
         self.subPhase = GameSubPhase.ConfirmingPhrases
+        self.markChangedWithoutLock()
 
-    def recordPrevPhrase(self, prevPhrase):
+    @metrics.timedGameMethod
+    def recordPrevPhrase(self, phraseId):
         with self.lock:
-            self.broadcastPhrase = prevPhrase
-            # sometimes a client notifies the server twice to record the same phrase, so check if we already have it
-            if prevPhrase not in self.clickedPhrases: 
-                self.clickedPhrases.append(prevPhrase)
-                if len(self.clickedPhrases) >= len(self.phrasesInHat):
-                    self.endPlayerTurnWithoutLock(self.activePlayer().id)
-
-    def confirmPhrases(self, playerID, acceptedPhrases):
+            self.recordPrevPhraseWithoutLock(phraseId)
+
+    def recordPrevPhraseWithoutLock(self, phraseId):
+        if self.subPhase != GameSubPhase.Started:
+            # A click that arrives after the server has ended the turn is a normal race
+            self.log('phraseAfterTurn', logging.DEBUG, phrase=phraseId)
+            return
+        if self.phrasesInHat is None or phraseId not in self.phrasesInHat:
+            self.log('phraseNotInHat', logging.WARNING, phrase=phraseId)
+            return
+        self.log('prevPhrase', logging.DEBUG, phrase=phraseId)
+        now = self.clock()
+        self.journalWithoutLock('recordPrevPhrase', [phraseId], now)
+        self.broadcastPhrase = phraseId
+        # sometimes a client notifies the server twice to record the same phrase; add() ignores repeats
+        if self.clickedPhrases.add(phraseId):
+            if len(self.clickedPhrases) >= len(self.phrasesInHat):
+                self.endPlayerTurnWithoutLock(self.activePlayer().id, now) # marks the change itself
+                return
+        self.markChangedWithoutLock()
+
+    @metrics.timedGameMethod
+    def confirmPhrases(self, playerID, acceptedPhraseIds):
         with self.lock:
-            self.log(playerID + ' assigning phrases')
-            self.log('accepted: ' + str(acceptedPhrases))
+            self.confirmPhrasesWithoutLock(playerID, acceptedPhraseIds)
 
-            activePlayer = self.assertActivePlayer(playerID)
-            self.assertMainPhase([GameMainPhase.MultiWord, GameMainPhase.SingleWord, GameMainPhase.Charade])
-            # The subphase is typically GameSubPhase.ConfirmingPhrases, but to enable the host 
-            # control that skips a player, the subPhase can be anything
+    def confirmPhrasesWithoutLock(self, playerID, acceptedPhraseIds):
+        self.log('confirmPhrases', player=playerID, acceptedCount=len(acceptedPhraseIds))
+
+        activePlayer = self.assertActivePlayer(playerID)
+        self.assertMainPhase([GameMainPhase.MultiWord, GameMainPhase.SingleWord, GameMainPhase.Charade])
+        # The subphase is typically GameSubPhase.ConfirmingPhrases, but to enable the host 
+        # control that skips a player, the subPhase can be anything
+        
+        activeTeam = self.teams[self.activeTeamIdx]
+        acceptedIds = []
+        for phraseId in acceptedPhraseIds:
+            if self.phrasesInHat.remove(phraseId):
+                acceptedIds.append(phraseId)
+                activeTeam.score += 1
+            else:
+                self.log('phraseNotInHat', logging.WARNING, phrase=phraseId)
+                #raise GameError('phrase not in hat: ' + phrase)
             
-            activeTeam = self.teams[self.activeTeamIdx]
-            for phrase in acceptedPhrases:
-                if phrase in self.phrasesInHat:
-                    self.phrasesInHat.remove(phrase)
-                    activeTeam.score += 1
-                else:
-                    self.log('ERROR: phrase not in hat: ' + phrase)
-                    #raise GameError('phrase not in hat: ' + phrase)
-                
-            #self.previousRoundPhrasesPlayerName = activePlayer.id
-            self.previousRoundPhrases = copy.copy(acceptedPhrases)
-            self.broadcastPhrase = None # Don't carry-over broadcastPhrase to next turn
-            self.clickedPhrases = []
-
-
-            shouldAdvancePlayer = True
-            if len(self.phrasesInHat) == 0:
-
-                if self.leftoverTurnTime >= minContinuationTurnSeconds:
-                    shouldAdvancePlayer = False
-
-                if self.mainPhase == GameMainPhase.MultiWord:
-                    self.newMainPhase(GameMainPhase.SingleWord)
-                elif self.mainPhase == GameMainPhase.SingleWord:
-                    self.newMainPhase(GameMainPhase.Charade)
-                else:
-                    self.log('all phrases in charade completed, game complete')
-                    self.mainPhase = GameMainPhase.Done
-
-            if shouldAdvancePlayer:
-                activeTeam.activePlayerIdx = (activeTeam.activePlayerIdx + 1) % len(activeTeam.players)
-                self.activeTeamIdx = (self.activeTeamIdx + 1) % len(self.teams)
+        #self.previousRoundPhrasesPlayerName = activePlayer.id
+        self.previousRoundPhrases = acceptedIds
+        self.broadcastPhrase = None # Don't carry-over broadcastPhrase to next turn
+        self.clickedPhrases.clear()
+
+
+        shouldAdvancePlayer = True
+        if len(self.phrasesInHat) == 0:
+
+            if self.leftoverTurnTime >= minContinuationTurnSeconds:
+                shouldAdvancePlayer = False
+
+            if self.mainPhase == GameMainPhase.MultiWord:
+                self.newMainPhase(GameMainPhase.SingleWord)
+            elif self.mainPhase == GameMainPhase.SingleWord:
+                self.newMainPhase(GameMainPhase.Charade)
             else:
-                self.continuationTurnSeconds = self.leftoverTurnTime
-            self.subPhase = GameSubPhase.WaitForStart
+                self.log('gameComplete')
+                self.mainPhase = GameMainPhase.Done
+
+        if shouldAdvancePlayer:
+            activeTeam.activePlayerIdx = (activeTeam.activePlayerIdx + 1) % len(activeTeam.players)
+            self.activeTeamIdx = (self.activeTeamIdx + 1) % len(self.teams)
+        else:
+            self.continuationTurnSeconds = self.leftoverTurnTime
+        self.subPhase = GameSubPhase.WaitForStart
+        self.journalWithoutLock('confirmPhrases', [playerID, acceptedPhraseIds])
+        self.markChangedWithoutLock()
 
+    @metrics.timedGameMethod
     def addPlayerToTeam(self, teamIndex, newPlayerName):
         with self.lock:
-            if teamIndex < 0 or teamIndex >= len(self.teams):
-                raise GameError('teamIndex out of bounds: ' + str(teamIndex))
-            if len(newPlayerName) == 0:
-                raise GameError('player names cannot be empty')
-            if newPlayerName in self.playersByID:
-                raise GameError('player name already exists')
-
-            print('adding player to team:', teamIndex, newPlayerName)
-
-            newPlayerTeam = self.teams[teamIndex]
-            newPlayer = Player(newPlayerName)
-            self.playersByID[newPlayerName] = newPlayer
-            newPlayerTeam.players.append(newPlayer)
-            
-            # rebuild the player list by reiterating through the teams
-            """self.players = []
-            for team in self.teams:
-                for player in team.players:
-                    self.players.append(player)"""
+            self.addPlayerToTeamWithoutLock(teamIndex, newPlayerName)
+
+    def addPlayerToTeamWithoutLock(self, teamIndex, newPlayerName):
+        if teamIndex < 0 or teamIndex >= len(self.teams):
+            raise GameError('teamIndex out of bounds: ' + str(teamIndex))
+        if len(newPlayerName) == 0:
+            raise GameError('player names cannot be empty')
+        if newPlayerName in self.playersByID:
+            raise GameError('player name already exists')
+
+        self.log('addPlayer', team=teamIndex, player=newPlayerName)
+
+        newPlayerTeam = self.teams[teamIndex]
+        newPlayer = Player(newPlayerName)
+        self.playersByID[newPlayerName] = newPlayer
+        newPlayerTeam.players.append(newPlayer)
+        self.journalWithoutLock('addPlayerToTeam', [teamIndex, newPlayerName])
+        self.markChangedWithoutLock()
+        
+        # rebuild the player list by reiterating through the teams
+        """self.players = []
+        for team in self.teams:
+            for player in team.players:
+                self.players.append(player)"""
 
+    @metrics.timedGameMethod
     def removePlayer(self, playerName):
         with self.lock:
-            print('removing player:', playerName)
+            return self.removePlayerWithoutLock(playerName)
 
-            if playerName not in self.playersByID:
-                raise GameError('player name not found in player list')
+    def removePlayerWithoutLock(self, playerName):
+        self.log('removePlayer', player=playerName)
 
-            for team in self.teams:
-                filteredPlayers = list(filter(lambda player: player.id == playerName, team.players))
-                if len(filteredPlayers) == 1:
-                    playerIdx = team.players.index(filteredPlayers[0])
-                    del team.players[playerIdx]
-                    return 'player removed'
+        if playerName not in self.playersByID:
+            raise GameError('player name not found in player list')
 
-            raise GameError('player name not found in teams')
+        for team in self.teams:
+            filteredPlayers = list(filter(lambda player: player.id == playerName, team.players))
+            if len(filteredPlayers) == 1:
+                playerIdx = team.players.index(filteredPlayers[0])
+                del team.players[playerIdx]
+                self.journalWithoutLock('removePlayer', [playerName])
+                self.markChangedWithoutLock()
+                return 'player removed'
+
+        raise GameError('player name not found in teams')
+
+    @metrics.timedGameMethod
+    def applyBatch(self, operations):
+        # Applies [method name, args] operations in order under one acquisition of the lock,
+        # all or none: when one raises GameError, the game is put back as it was and a
+        # BatchError names that operation. A batch that changes anything publishes one new
+        # version and is journaled as one record. Returns the result of each operation.
+        # An operation may carry a third element, the time it was first applied; replaying a
+        # journaled batch passes it.
+        with self.lock:
+            snapshot = self.toSnapshotDict()
+            clock = self.clock
+            self.batchRecords = []
+            self.batchChanged = False
+            results = []
+            try:
+                for idx, operation in enumerate(operations):
+                    method = self.batchMethods.get(operation[0])
+                    if method is None:
+                        raise BatchError(idx, 'unknown operation ' + str(operation[0]))
+                    if len(operation) > 2:
+                        self.clock = lambda t=operation[2]: t
+                    try:
+                        results.append(method(self, *operation[1]))
+                    except GameError as err:
+                        raise BatchError(idx, err)
+            except Exception:
+                self.log('batchRolledBack', logging.WARNING, operationCount=len(operations))
+                self.loadSnapshotDictWithoutLock(snapshot)
+                self.scheduleTurnTimerWithoutLock() # as the restored turn had it
+                raise
+            finally:
+                self.clock = clock
+                records = self.batchRecords
+                changed = self.batchChanged
+                self.batchRecords = None
+            if len(records) > 0:
+                self.journalWithoutLock('applyBatch', [records])
+            if changed:
+                self.markChangedWithoutLock()
+            return results
+
+    # The mutations a batch may contain, by the name each is journaled under
+    batchMethods = {
+        'recordPlayerPhrases': recordPlayerPhrasesWithoutLock,
+        'startPlayerTurn': startPlayerTurnWithoutLock,
+        'endPlayerTurn': endAndJournalPlayerTurnWithoutLock,
+        'recordPrevPhrase': recordPrevPhraseWithoutLock,
+        'confirmPhrases': confirmPhrasesWithoutLock,
+        'addPlayerToTeam': addPlayerToTeamWithoutLock,
+        'removePlayer': removePlayerWithoutLock,
+    }
         
 if __name__ == "__main__":
     print('hi!')
@@ -404,7 +915,7 @@ if __name__ == "__main__":
                 print('ending failed', err)
 
             successfulWordCount = min(len(game.phrasesInHat), random.randint(0, 5))
-            randomSuccessfulPhrases = random.sample(game.phrasesInHat, successfulWordCount)
+            randomSuccessfulPhrases = random.sample(game.phrasesInHat.toList(), successfulWordCount)
 
             try:
                 game.confirmPhrases(playerID, randomSuccessfulPhrases)
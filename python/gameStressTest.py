@@ -0,0 +1,147 @@
+
+# Plays games from many threads at once and checks every state a reader sees. Writers race
+# each other to take whatever action the published state allows (losing the race is a
+# GameError) while readers check that:
+#   - scores plus the phrases left in the hat add up to the phrases played so far
+#   - clicked phrases are still in the hat
+#   - versions never go backwards, and the JSON has the version it was served as
+#   - the deltas a reader applies rebuild exactly the published state
+#
+#   python python/gameStressTest.py --threads 64 --games 5
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from python import gameLog
+from python.gameSession import GameSession, GameError
+from python.stateDelta import applyPatch
+
+phaseIndexes = {'GameMainPhase.MultiWord': 0, 'GameMainPhase.SingleWord': 1, 'GameMainPhase.Charade': 2, 'GameMainPhase.Done': 2}
+
+def newGame(gameIdx, phrasesPerPlayer):
+    teams = [['a{}'.format(i) for i in range(4)], ['b{}'.format(i) for i in range(4)]]
+    game = GameSession('stress-{}'.format(gameIdx), teams, phrasesPerPlayer, 200, 'vid')
+    game.showLog = False
+    for team in teams:
+        for playerId in team:
+            game.recordPlayerPhrases(playerId, ['{} {}'.format(playerId, i) for i in range(phrasesPerPlayer)])
+    return game
+
+def checkState(state, version, phraseCount):
+    if state['mainPhase'] == 'GameMainPhase.Write':
+        return
+    phaseIndex = phaseIndexes[state['mainPhase']]
+    if state['mainPhase'] == 'GameMainPhase.Done':
+        assert len(state['hat']) == 0 and sum(state['scores']) == 3 * phraseCount, (version, state)
+        return
+    assert sum(state['scores']) + len(state['hat']) == phraseCount * (phaseIndex + 1), (version, state)
+    assert set(state['clickedPhrases']) <= set(state['hat']), (version, state)
+
+def play(game, stats, done, barrier):
+    # One writer: takes the next legal action for whoever's turn it is
+    rng = random.Random()
+    barrier.wait()
+    while not done.is_set():
+        state = game.getPublishedState().state
+        playerId = state['teams'][state['activeTeamIndex']][state['activePlayerIndexPerTeam'][state['activeTeamIndex']]] \
+            if state['mainPhase'] != 'GameMainPhase.Done' else None
+        try:
+            if playerId is None:
+                done.set()
+            elif state['subPhase'] == 'GameSubPhase.WaitForStart':
+                game.startPlayerTurn(playerId)
+            elif state['subPhase'] == 'GameSubPhase.Started':
+                unclicked = [phraseId for phraseId in state['hat'] if phraseId not in state['clickedPhrases']]
+                if len(unclicked) > 0 and rng.random() < 0.8:
+                    game.recordPrevPhrase(rng.choice(unclicked))
+                else:
+                    game.endPlayerTurn(playerId)
+            else:
+                game.confirmPhrases(playerId, state['clickedPhrases'])
+            stats['mutations'] += 1
+        except GameError:
+            stats['rejected'] += 1
+
+def read(game, stats, done, barrier, phraseCount):
+    # One reader: alternates full fetches with following the deltas like the event stream of
+    # player a0, who holds the hat on some turns and sees the public state on the rest
+    barrier.wait()
+    lastVersion = -1
+    followed = None # (version, state) rebuilt from deltas
+    while not done.is_set():
+        version, etag, serialized = game.getSerializedState()
+        state = json.loads(serialized)
+        assert state.pop('stateVersion') == version and version >= lastVersion, (version, lastVersion)
+        lastVersion = version
+        checkState(state, version, phraseCount)
+
+        published = game.getPublishedState()
+        expectedState = published.getState(published.projectionFor('a0'))
+        events = None if followed is None else game.getEventsSince(followed[0], 'a0')
+        if events is None:
+            followed = (published.version, expectedState)
+        else:
+            followedState = followed[1]
+            for eventVersion, text in events:
+                if eventVersion > published.version:
+                    break
+                delta = json.loads(text.split('data: ', 1)[1])
+                followedState = applyPatch(followedState, delta['patch'])
+                followed = (eventVersion, followedState)
+            # Published states hold tuples where the JSON has lists
+            if followed[0] == published.version:
+                assert json.dumps(followed[1], sort_keys=True) == json.dumps(expectedState, sort_keys=True), published.version
+        stats['reads'] += 1
+
+def runGame(gameIdx, args):
+    phraseCount = 8 * args.phrases
+    game = newGame(gameIdx, args.phrases)
+    done = threading.Event()
+    barrier = threading.Barrier(args.threads)
+    writerCount = max(1, args.threads // 4)
+    threadStats = [{'mutations': 0, 'rejected': 0, 'reads': 0} for i in range(args.threads)]
+    threads = []
+    for threadIdx in range(args.threads):
+        if threadIdx < writerCount:
+            target, targetArgs = play, (game, threadStats[threadIdx], done, barrier)
+        else:
+            target, targetArgs = read, (game, threadStats[threadIdx], done, barrier, phraseCount)
+        threads.append(threading.Thread(target=target, args=targetArgs))
+
+    failures = []
+    def recordFailure(hookArgs):
+        failures.append(hookArgs.exc_value)
+        done.set()
+    threading.excepthook = recordFailure
+
+    startTime = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - startTime
+    if len(failures) > 0:
+        raise failures[0]
+
+    checkState(game.getPublishedState().state, game.stateVersion, phraseCount)
+    totals = {key: sum(stats[key] for stats in threadStats) for key in threadStats[0]}
+    print('game {}: {} versions, {:.0f} mutations/s ({} rejected), {:.0f} reads/s over {:.2f} s'.format(
+        gameIdx, game.stateVersion, totals['mutations'] / seconds, totals['rejected'],
+        totals['reads'] / seconds, seconds))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=64, help='a quarter of them write, the rest read')
+    parser.add_argument('--games', type=int, default=5, help='games played one after another')
+    parser.add_argument('--phrases', type=int, default=25, help='phrases per player (8 players)')
+    args = parser.parse_args()
+    gameLog.configure(level=gameLog.parseLevel('OFF'))
+    for gameIdx in range(args.games):
+        runGame(gameIdx, args)
+    print('all invariants held')
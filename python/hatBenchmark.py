@@ -0,0 +1,102 @@
+
+# Times hat operations at the largest allowed game size (30 teams x 20 players x 30 phrases),
+# comparing PhraseHat with the plain-list scans GameSession used before, and then plays a
+# full round of GameSession turns at that size.
+#
+#   python python/hatBenchmark.py
+
+import os
+import sys
+import random
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from python.phraseHat import PhraseHat
+from python.gameSession import GameSession, GameMainPhase, GameSubPhase
+
+teamCount = 30
+playersPerTeam = 20
+phrasesPerPlayer = 30
+phrasesPerTurn = 5
+
+def timeIt(label, function, count):
+    startTime = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - startTime
+    print('{:40} {:10.3f} ms total {:10.3f} us/op'.format(label, elapsed * 1000.0, elapsed * 1e6 / count))
+
+def benchmarkHat(phraseCount):
+    print('hat with', phraseCount, 'phrases')
+    phrases = ['phrase ' + str(i) for i in range(phraseCount)]
+    removalOrder = list(phrases)
+    random.shuffle(removalOrder)
+
+    def listRecord():
+        allPhrases = []
+        for phrase in phrases:
+            if phrase not in allPhrases:
+                allPhrases.append(phrase)
+
+    def idRecord():
+        phraseTexts = []
+        for phrase in phrases:
+            phraseTexts.append(phrase)
+
+    def listRemove():
+        hat = list(phrases)
+        for phrase in removalOrder:
+            if phrase in hat:
+                hat.remove(phrase)
+
+    def hatRemove():
+        hat = PhraseHat(range(phraseCount))
+        for phraseId in range(phraseCount):
+            hat.remove(phraseId)
+
+    hat = PhraseHat(range(phraseCount))
+    timeIt('record, list duplicate scan', listRecord, phraseCount)
+    timeIt('record, ID assignment', idRecord, phraseCount)
+    timeIt('confirm, list scan + remove', listRemove, phraseCount)
+    timeIt('confirm, PhraseHat.remove', hatRemove, phraseCount)
+    timeIt('PhraseHat.draw', lambda: [hat.draw() for i in range(phraseCount)], phraseCount)
+    timeIt('PhraseHat.shuffle', hat.shuffle, 1)
+
+def benchmarkGame():
+    teams = [['player{}_{}'.format(teamIdx, playerIdx) for playerIdx in range(playersPerTeam)] for teamIdx in range(teamCount)]
+    game = GameSession('benchmark', teams, phrasesPerPlayer, 60, 'http://video')
+    game.showLog = False
+    # A small vocabulary so that plenty of phrases are duplicates
+    vocabulary = ['word' + str(i) for i in range(2000)]
+
+    def recordAll():
+        for team in teams:
+            for playerId in team:
+                game.recordPlayerPhrases(playerId, random.sample(vocabulary, phrasesPerPlayer))
+
+    phraseCount = teamCount * playersPerTeam * phrasesPerPlayer
+    print('game with', phraseCount, 'phrases')
+    timeIt('recordPlayerPhrases (per phrase)', recordAll, phraseCount)
+
+    turnCount = [0]
+    def playRound():
+        while game.mainPhase == GameMainPhase.MultiWord:
+            playerId = game.activePlayer().id
+            game.startPlayerTurn(playerId)
+            clicked = game.phrasesInHat.toList()[0:phrasesPerTurn]
+            for phraseId in clicked:
+                game.recordPrevPhrase(phraseId)
+            if game.subPhase == GameSubPhase.Started:
+                game.endPlayerTurn(playerId)
+            game.confirmPhrases(playerId, clicked)
+            turnCount[0] += 1
+
+    startTime = time.perf_counter()
+    playRound()
+    elapsed = time.perf_counter() - startTime
+    print('{:40} {:10.3f} ms total {:10.3f} us/turn'.format('MultiWord round, ' + str(turnCount[0]) + ' turns', elapsed * 1000.0, elapsed * 1e6 / turnCount[0]))
+
+if __name__ == '__main__':
+    random.seed(0)
+    benchmarkHat(teamCount * playersPerTeam * phrasesPerPlayer)
+    print('')
+    benchmarkGame()
@@ -0,0 +1,95 @@
+
+# Measures what the game journal costs per mutation and how long recovery takes. Plays a
+# number of small games with the journal on, snapshots halfway, plays on, then recovers
+# everything from disk.
+#
+#   python python/journalBenchmark.py --games 10000
+
+import argparse
+import os
+import sys
+import random
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from python.gameSession import GameSession, GameMainPhase, GameSubPhase
+from python.gameJournal import GameJournal
+
+def makeGame(gameId):
+    game = GameSession(gameId, [['a', 'b', 'c'], ['d', 'e', 'f']], 3, 60, 'http://video')
+    game.showLog = False
+    return game
+
+def playStep(game):
+    # Takes one legal action, as a player would
+    if game.mainPhase == GameMainPhase.Write:
+        for playerID, player in game.playersByID.items():
+            if len(player.phrases) == 0:
+                game.recordPlayerPhrases(playerID, ['phrase {}'.format(random.randint(0, 999)) for i in range(game.phrasesPerPlayer)])
+                return
+    elif game.mainPhase == GameMainPhase.Done:
+        return
+    elif game.subPhase == GameSubPhase.WaitForStart:
+        game.startPlayerTurn(game.activePlayer().id)
+    elif game.subPhase == GameSubPhase.Started:
+        if random.random() < 0.7:
+            game.recordPrevPhrase(game.phrasesInHat.toList()[len(game.clickedPhrases)])
+        else:
+            game.endPlayerTurn(game.activePlayer().id)
+    else:
+        game.confirmPhrases(game.activePlayer().id, game.clickedPhrases.toList())
+
+def playAll(games, stepsPerGame):
+    startTime = time.perf_counter()
+    for step in range(stepsPerGame):
+        for game in games:
+            playStep(game)
+    return time.perf_counter() - startTime
+
+def run(args):
+    random.seed(args.seed)
+    dataDir = tempfile.mkdtemp(prefix='hatgame-journal-')
+    try:
+        # Baseline: the same games with no journal
+        games = [makeGame('baseline{}'.format(i)) for i in range(args.games)]
+        baselineSeconds = playAll(games, args.steps)
+
+        journal = GameJournal(dataDir, syncToDisk=not args.noSync)
+        journal.start()
+        games = [makeGame('game{}'.format(i)) for i in range(args.games)]
+        for game in games:
+            journal.attach(game)
+        journaledSeconds = playAll(games, args.steps)
+        mutationCount = journal.seq - args.games # not counting the create records
+
+        startTime = time.perf_counter()
+        journal.writeSnapshot(lambda: games)
+        snapshotSeconds = time.perf_counter() - startTime
+
+        playAll(games, args.steps)
+        journal.flush()
+        tailRecords = journal.seq - mutationCount - args.games
+
+        startTime = time.perf_counter()
+        recovered = GameJournal(dataDir).recover()
+        recoverySeconds = time.perf_counter() - startTime
+
+        matching = sum(1 for game in games if recovered[game.id].toSnapshotDict() == game.toSnapshotDict())
+        print('games:', args.games)
+        print('mutation time without journal: {:.2f} us'.format(baselineSeconds * 1e6 / mutationCount))
+        print('mutation time with journal:    {:.2f} us'.format(journaledSeconds * 1e6 / mutationCount))
+        print('snapshot write: {:.1f} ms'.format(snapshotSeconds * 1000.0))
+        print('recovery (snapshot + {} log records): {:.1f} ms'.format(tailRecords, recoverySeconds * 1000.0))
+        print('recovered games identical:', matching, 'of', len(games))
+    finally:
+        shutil.rmtree(dataDir)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--games', type=int, default=10000)
+    parser.add_argument('--steps', type=int, default=10, help='actions per game before and after the snapshot')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--noSync', action='store_true', help='skip fsync on each group commit')
+    run(parser.parse_args())
@@ -0,0 +1,321 @@
+
+# Load generator: plays whole games against a server, many at once, the way browsers would.
+# Every player has a keep-alive connection for its requests and holds the game's event
+# stream open from the start. Each game writes its phrases (taken from /api/randomwords),
+# then plays turns through MultiWord, SingleWord and Charade until it is Done. Reports
+# requests/s, latency percentiles per request type and the lag from sending a mutation to
+# every stream receiving its event.
+#
+#   python python/loadTest.py --server asgi --games 200 --concurrency 20 --seed 1
+#   python python/loadTest.py --server none --port 5000       (a server that is already up)
+#
+# The same seed plays the same games: teams, phrases, guesses and think times.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import zlib
+
+rootDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class HttpConnection:
+    """One keep-alive HTTP/1.1 connection, reopened when the server closes it."""
+    def __init__(self, host, port, acceptGzip):
+        self.host = host
+        self.port = port
+        self.acceptGzip = acceptGzip
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, body=None):
+        # Returns the status and the decoded body. A request on a reused connection that the
+        # server has already closed is sent again on a new one.
+        payload = b'' if body is None else json.dumps(body).encode('utf-8')
+        head = '{} {} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n{}\r\n'.format(
+            method, path, self.host, len(payload), 'Accept-Encoding: gzip\r\n' if self.acceptGzip else '')
+        for attempt in range(2):
+            reused = self.writer is not None
+            if not reused:
+                self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                self.writer.write(head.encode('latin-1') + payload)
+                await self.writer.drain()
+                status, headers = await readHead(self.reader)
+                responseBody = await readBody(self.reader, headers)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            if headers.get('connection', '').lower() == 'close' or 'content-length' not in headers and 'transfer-encoding' not in headers:
+                self.close()
+            if headers.get('content-encoding') == 'gzip':
+                responseBody = zlib.decompress(responseBody, 31)
+            return status, responseBody
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+async def readHead(reader):
+    statusLine = await reader.readuntil(b'\r\n')
+    status = int(statusLine.split(b' ', 2)[1])
+    headers = {}
+    while True:
+        line = await reader.readuntil(b'\r\n')
+        if line == b'\r\n':
+            return status, headers
+        name, value = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+
+async def readChunks(reader):
+    # Yields the chunks of a chunked body
+    while True:
+        size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+        if size == 0:
+            await reader.readuntil(b'\r\n')
+            return
+        chunk = await reader.readexactly(size)
+        await reader.readexactly(2)
+        yield chunk
+
+async def readBody(reader, headers):
+    if 'content-length' in headers:
+        return await reader.readexactly(int(headers['content-length']))
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        return b''.join([chunk async for chunk in readChunks(reader)])
+    return await reader.read()
+
+class Stats:
+    def __init__(self):
+        self.latencies = {} # request type -> seconds
+        self.errors = {} # request type -> count
+        self.eventLags = []
+        self.gamesDone = 0
+        self.versionMismatches = 0
+
+    def record(self, requestType, seconds, failed):
+        self.latencies.setdefault(requestType, []).append(seconds)
+        if failed:
+            self.errors[requestType] = self.errors.get(requestType, 0) + 1
+
+def percentile(sortedValues, q):
+    return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * q))]
+
+class SimulatedGame:
+    def __init__(self, gameIdx, args, stats):
+        self.args = args
+        self.stats = stats
+        self.rng = random.Random('{}-{}'.format(args.seed, gameIdx))
+        self.gameId = 'load{}x{}'.format(args.seed, gameIdx)
+        self.teams = [['t{}p{}'.format(teamIdx, playerIdx) for playerIdx in range(args.players)] for teamIdx in range(args.teams)]
+        self.connections = {playerId: HttpConnection(args.host, args.port, args.gzip) for team in self.teams for playerId in team}
+        self.version = 0 # version the server is at after the last successful mutation
+        self.sentTimes = {} # version -> when the mutation that makes it was sent
+        self.streamTasks = []
+
+    async def call(self, requestType, playerId, method, path, body=None, mutation=False):
+        # Mutations are sent one at a time per game and each makes exactly one new version
+        startTime = time.perf_counter()
+        if mutation:
+            self.sentTimes[self.version + 1] = startTime
+        status, responseBody = await self.connections[playerId].request(method, path, body)
+        failed = status != 200 or responseBody.startswith(b'{"error"')
+        self.stats.record(requestType, time.perf_counter() - startTime, failed)
+        if mutation and not failed:
+            self.version += 1
+        return None if failed else responseBody
+
+    async def think(self):
+        await asyncio.sleep(self.rng.uniform(0.5, 1.5) * self.args.thinkMs / 1000.0)
+
+    async def stream(self, playerId, ready):
+        # Reads the event stream like an EventSource; records the lag of each delta
+        reader, writer = await asyncio.open_connection(self.args.host, self.args.port)
+        try:
+            writer.write('GET /api/stream/{}/{}/events HTTP/1.1\r\nHost: {}\r\nAccept: text/event-stream\r\n{}\r\n'.format(
+                self.gameId, playerId, self.args.host, 'Accept-Encoding: gzip\r\n' if self.args.gzip else '').encode('latin-1'))
+            await writer.drain()
+            status, headers = await readHead(reader)
+            decompressor = zlib.decompressobj(31) if headers.get('content-encoding') == 'gzip' else None
+            chunks = readChunks(reader) if headers.get('transfer-encoding', '').lower() == 'chunked' else rawChunks(reader)
+            ready.set()
+            pending = b''
+            async for chunk in chunks:
+                pending += chunk if decompressor is None else decompressor.decompress(chunk)
+                arrivalTime = time.perf_counter()
+                *events, pending = pending.split(b'\n\n')
+                for event in events:
+                    fields = dict(line.split(b': ', 1) for line in event.split(b'\n') if b': ' in line)
+                    if fields.get(b'event') == b'closed':
+                        return
+                    sentTime = self.sentTimes.get(int(fields.get(b'id', b'-1')))
+                    if fields.get(b'event') == b'delta' and sentTime is not None:
+                        self.stats.eventLags.append(arrivalTime - sentTime)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            ready.set()
+            writer.close()
+
+    async def play(self):
+        args = self.args
+        hostId = self.teams[0][0]
+        body = await self.call('newgame', hostId, 'POST', '/api/newgame',
+                               {'id': self.gameId, 'teams': self.teams, 'phrasesPerPlayer': args.phrases,
+                                'secondsPerTurn': args.turnSeconds, 'videoURL': 'https://meet.example.com/' + self.gameId})
+        if body is None:
+            return
+        for team in self.teams:
+            for playerId in team:
+                ready = asyncio.Event()
+                self.streamTasks.append(asyncio.ensure_future(self.stream(playerId, ready)))
+                await ready.wait()
+
+        try:
+            for team in self.teams:
+                for playerId in team:
+                    wordsBody = await self.call('randomwords', playerId, 'GET', '/api/randomwords?count={}'.format(args.phrases))
+                    words = json.loads(wordsBody)['words'] if wordsBody is not None else []
+                    words += ['{} {}'.format(playerId, i) for i in range(args.phrases - len(words))]
+                    await self.think()
+                    await self.call('recordphrases', playerId, 'POST',
+                                    '/games/{}/{}/recordphrases'.format(self.gameId, playerId), {'phrases': words}, mutation=True)
+            await self.call('phrases', hostId, 'GET', '/api/phrases/{}'.format(self.gameId))
+
+            while True:
+                stateBody = await self.call('gamestate', hostId, 'GET', '/api/gamestate/{}'.format(self.gameId))
+                state = json.loads(stateBody)
+                if state['stateVersion'] != self.version:
+                    self.stats.versionMismatches += 1
+                    self.version = state['stateVersion']
+                if state['mainPhase'] == 'GameMainPhase.Done':
+                    break
+                teamIdx = state['activeTeamIndex']
+                playerId = state['teams'][teamIdx][state['activePlayerIndexPerTeam'][teamIdx]]
+                await self.playTurn(playerId, state)
+            self.stats.gamesDone += 1
+        finally:
+            for task in self.streamTasks:
+                task.cancel()
+            await asyncio.gather(*self.streamTasks, return_exceptions=True)
+            for connection in self.connections.values():
+                connection.close()
+
+    async def playTurn(self, playerId, state):
+        gamePath = '/games/{}/{}/'.format(self.gameId, playerId)
+        if state['subPhase'] == 'GameSubPhase.WaitForStart':
+            await self.think()
+            await self.call('startturn', playerId, 'POST', gamePath + 'startturn', mutation=True)
+            # The team guesses some of the hat, in the order it was shuffled into
+            stateBody = await self.call('gamestate', playerId, 'GET', '/api/gamestate/{}?player={}'.format(self.gameId, playerId))
+            hat = json.loads(stateBody)['hat']
+            guessCount = min(len(hat), self.rng.randint(1, self.args.guessesPerTurn))
+            for phraseId in hat[:guessCount]:
+                await self.think()
+                await self.call('prevphrase', playerId, 'POST', '/games/{}/prevphrase/{}'.format(self.gameId, phraseId), mutation=True)
+            if guessCount < len(hat):
+                await self.call('endturn', playerId, 'POST', gamePath + 'endturn', mutation=True)
+            clicked = hat[:guessCount]
+        else:
+            clicked = state['clickedPhrases']
+            if state['subPhase'] == 'GameSubPhase.Started':
+                await self.call('endturn', playerId, 'POST', gamePath + 'endturn', mutation=True)
+        await self.think()
+        await self.call('confirmphrases', playerId, 'POST', gamePath + 'confirmphrases', {'acceptedPhrases': clicked}, mutation=True)
+
+async def rawChunks(reader):
+    while True:
+        data = await reader.read(65536)
+        if not data:
+            return
+        yield data
+
+async def waitForServer(host, port, timeoutSeconds=60.0):
+    deadline = time.time() + timeoutSeconds
+    while time.time() < deadline:
+        connection = HttpConnection(host, port, False)
+        try:
+            status, body = await connection.request('GET', '/api/gamelist')
+            if status == 200:
+                return
+        except OSError:
+            pass
+        finally:
+            connection.close()
+        await asyncio.sleep(0.2)
+    raise RuntimeError('server did not start')
+
+async def run(args):
+    await waitForServer(args.host, args.port)
+    stats = Stats()
+    nextGame = iter(range(args.games))
+
+    async def runGames():
+        for gameIdx in nextGame:
+            await SimulatedGame(gameIdx, args, stats).play()
+
+    startTime = time.perf_counter()
+    await asyncio.gather(*[runGames() for i in range(args.concurrency)])
+    seconds = time.perf_counter() - startTime
+
+    requestCount = sum(len(latencies) for latencies in stats.latencies.values())
+    print('{} games done in {:.1f} s: {:.0f} requests/s, {:.2f} games/s'.format(
+        stats.gamesDone, seconds, requestCount / seconds, stats.gamesDone / seconds))
+    print('{:<15}{:>8}{:>8}{:>10}{:>10}{:>10}'.format('request', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for requestType, latencies in sorted(stats.latencies.items()):
+        latencies.sort()
+        print('{:<15}{:>8}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}'.format(
+            requestType, len(latencies), stats.errors.get(requestType, 0), percentile(latencies, 0.5) * 1000.0,
+            percentile(latencies, 0.95) * 1000.0, percentile(latencies, 0.99) * 1000.0))
+    if len(stats.eventLags) > 0:
+        stats.eventLags.sort()
+        print('event lag over {} deliveries: p50 {:.2f} ms, p95 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms'.format(
+            len(stats.eventLags), percentile(stats.eventLags, 0.5) * 1000.0, percentile(stats.eventLags, 0.95) * 1000.0,
+            percentile(stats.eventLags, 0.99) * 1000.0, stats.eventLags[-1] * 1000.0))
+    if stats.versionMismatches > 0:
+        print('state versions out of step with the mutations sent:', stats.versionMismatches)
+
+def startServer(args):
+    env = dict(os.environ, HATGAME_LOG_LEVEL='WARNING')
+    if args.server == 'asgi':
+        command = [sys.executable, '-m', 'uvicorn', 'asgiServer:asgiApp', '--port', str(args.port), '--log-level', 'warning']
+    elif args.server == 'flask':
+        command = [sys.executable, '-m', 'flask', '--app', 'flaskServer', 'run', '--port', str(args.port), '--with-threads']
+    else:
+        command = [sys.executable, 'shardedServer.py', '--workers', str(args.workers), '--port', str(args.port)]
+    return subprocess.Popen(command, cwd=rootDir, env=env, stdout=subprocess.DEVNULL)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--server', choices=['asgi', 'flask', 'sharded', 'none'], default='asgi',
+                        help='server to start for the test, or none to use one already running')
+    parser.add_argument('--workers', type=int, default=2, help='worker processes for --server sharded')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5200)
+    parser.add_argument('--games', type=int, default=50, help='games to play in all')
+    parser.add_argument('--concurrency', type=int, default=10, help='games played at the same time')
+    parser.add_argument('--teams', type=int, default=2)
+    parser.add_argument('--players', type=int, default=3, help='players per team')
+    parser.add_argument('--phrases', type=int, default=5, help='phrases per player')
+    parser.add_argument('--turnSeconds', type=int, default=200, help='long enough that turns end by the players')
+    parser.add_argument('--guessesPerTurn', type=int, default=6)
+    parser.add_argument('--thinkMs', type=float, default=20.0, help='mean pause before each player action')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--noGzip', dest='gzip', action='store_false', help='do not accept compressed responses')
+    args = parser.parse_args()
+
+    server = None if args.server == 'none' else startServer(args)
+    try:
+        asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
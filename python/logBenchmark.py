@@ -0,0 +1,78 @@
+
+# Measures request latency with game logging off, queued (the default) and written on the
+# request thread, which is what the old print statements did. Several threads play games
+# through Flask's test client while the log goes to a file.
+#
+#   python python/logBenchmark.py --threads 16 --games 200
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from flaskServer import app, activeGames
+from python import gameLog
+from python.gameSession import GameSubPhase
+
+def playGame(client, gameId, latencies):
+    def timed(method, path, body=None):
+        startTime = time.perf_counter()
+        response = method(path, json=body)
+        latencies.append(time.perf_counter() - startTime)
+        return response
+
+    teams = [['a', 'b', 'c'], ['d', 'e', 'f']]
+    timed(client.post, '/api/newgame', {'id': gameId, 'teams': teams, 'phrasesPerPlayer': 4,
+                                        'secondsPerTurn': 60, 'videoURL': 'vid'})
+    for team in teams:
+        for playerId in team:
+            timed(client.post, '/games/{}/{}/recordphrases'.format(gameId, playerId),
+                  {'phrases': ['{} phrase {}'.format(playerId, i) for i in range(4)]})
+    game = activeGames[gameId]
+    for turn in range(6):
+        playerId = game.activePlayer().id
+        timed(client.post, '/games/{}/{}/startturn'.format(gameId, playerId))
+        for phraseId in game.phrasesInHat.toList()[:3]:
+            timed(client.post, '/games/{}/prevphrase/{}'.format(gameId, phraseId))
+        if game.subPhase == GameSubPhase.Started:
+            timed(client.post, '/games/{}/{}/endturn'.format(gameId, playerId))
+        timed(client.post, '/games/{}/{}/confirmphrases'.format(gameId, playerId),
+              {'acceptedPhrases': game.clickedPhrases.toList()})
+        timed(client.get, '/api/gamestate/{}'.format(gameId))
+
+def measure(name, args, **configureArgs):
+    with tempfile.TemporaryFile('w') as logFile:
+        gameLog.configure(stream=logFile, **configureArgs)
+        latencies = []
+        def worker(threadIdx):
+            client = app.test_client()
+            for gameIdx in range(args.games):
+                playGame(client, '{}-{}-{}'.format(name, threadIdx, gameIdx), latencies)
+
+        startTime = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(threadIdx,)) for threadIdx in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - startTime
+        gameLog.flush()
+
+    latencies.sort()
+    print('{:>12}: median {:.3f} ms, p99 {:.3f} ms, {:.0f} requests/s'.format(
+        name, latencies[len(latencies) // 2] * 1000.0, latencies[int(len(latencies) * 0.99)] * 1000.0,
+        len(latencies) / seconds))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--games', type=int, default=100, help='games per thread')
+    args = parser.parse_args()
+    measure('off', args, level=gameLog.parseLevel('OFF'))
+    measure('queued', args, level=logging.DEBUG)
+    measure('synchronous', args, level=logging.DEBUG, asynchronous=False)
+    measure('off', args, level=gameLog.parseLevel('OFF'))
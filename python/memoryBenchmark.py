@@ -0,0 +1,50 @@
+
+# Reports the memory held by idle games: games are created the way /api/newgame does and
+# left in the writing phase. The cost of a player is taken from the difference between
+# games with the fewest and the most players.
+#
+#   python python/memoryBenchmark.py --games 10000
+
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from python import gameLog
+from python.gameSession import GameSession
+
+def bytesPerGame(gameCount, playersPerTeam, phrasesPerPlayer):
+    gc.collect()
+    startBytes = tracemalloc.get_traced_memory()[0]
+    games = []
+    for gameIdx in range(gameCount):
+        teams = [['{}-{}-{}'.format(gameIdx, teamIdx, playerIdx) for playerIdx in range(playersPerTeam)]
+                 for teamIdx in range(2)]
+        game = GameSession('g{}'.format(gameIdx), teams, 5, 60, 'vid')
+        if phrasesPerPlayer > 0:
+            # Every player but one has written, so the game stays in the writing phase
+            for team in teams:
+                for playerId in team[1:]:
+                    game.recordPlayerPhrases(playerId, ['phrase {}'.format(i) for i in range(phrasesPerPlayer)])
+        game.getPublishedState()
+        games.append(game)
+    gc.collect()
+    return (tracemalloc.get_traced_memory()[0] - startBytes) / gameCount
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--games', type=int, default=10000)
+    args = parser.parse_args()
+    gameLog.configure(level=gameLog.parseLevel('OFF'))
+    tracemalloc.start()
+
+    smallGame = bytesPerGame(args.games, 1, 0)
+    largeGame = bytesPerGame(args.games, 10, 0)
+    perPlayer = (largeGame - smallGame) / 18
+    print('idle game, 2 players:  {:.0f} bytes'.format(smallGame))
+    print('idle game, 20 players: {:.0f} bytes'.format(largeGame))
+    print('per player:            {:.0f} bytes'.format(perPlayer))
+    print('per player with 5 phrases written: {:.0f} bytes'.format(
+        (bytesPerGame(args.games, 10, 5) - bytesPerGame(args.games, 1, 5)) / 18))
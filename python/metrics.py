@@ -0,0 +1,188 @@
+import bisect
+import functools
+import threading
+import time
+
+# Bucket upper bounds in seconds
+latencyBuckets = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+lockBuckets = [0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+               0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 1.0]
+reportedQuantiles = [0.5, 0.95, 0.99]
+
+class Histogram:
+    def __init__(self, buckets):
+        self.bounds = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one counts values above every bound
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[idx] += 1
+            self.total += value
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.total
+
+    def quantile(self, q, counts):
+        # Estimated by linear interpolation inside the bucket holding the q-th value
+        count = sum(counts)
+        if count == 0:
+            return None
+        rank = q * count
+        cumulative = 0
+        for idx, bucketCount in enumerate(counts):
+            if cumulative + bucketCount >= rank and bucketCount > 0:
+                if idx == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[idx - 1] if idx > 0 else 0.0
+                return lower + (self.bounds[idx] - lower) * (rank - cumulative) / bucketCount
+            cumulative += bucketCount
+        return self.bounds[-1]
+
+class HistogramFamily:
+    def __init__(self, name, help, labelName, buckets):
+        self.name = name
+        self.help = help
+        self.labelName = labelName
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def labels(self, labelValue):
+        histogram = self.histograms.get(labelValue)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(labelValue, Histogram(self.buckets))
+        return histogram
+
+class MetricsRegistry:
+    """Histograms plus gauges and counters read from callbacks when /metrics is scraped,
+    rendered in the Prometheus text format. Recording an observation is a bisect and two
+    additions under a per-histogram lock."""
+    def __init__(self):
+        self.histogramFamilies = []
+        self.callbackMetrics = []
+
+    def histogramFamily(self, name, help, labelName=None, buckets=latencyBuckets):
+        family = HistogramFamily(name, help, labelName, buckets)
+        self.histogramFamilies.append(family)
+        return family
+
+    def addCallback(self, name, help, kind, getValue, labels=None):
+        # kind is 'gauge' or 'counter'; getValue is called on every scrape
+        self.callbackMetrics.append((name, help, kind, getValue, labels))
+
+    def render(self):
+        lines = []
+        declared = set()
+        for name, help, kind, getValue, labels in self.callbackMetrics:
+            if name not in declared:
+                declared.add(name)
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} {}'.format(name, kind))
+            lines.append('{}{} {}'.format(name, formatLabels(labels), getValue()))
+
+        for family in self.histogramFamilies:
+            lines.append('# HELP {} {}'.format(family.name, family.help))
+            lines.append('# TYPE {} histogram'.format(family.name))
+            quantileLines = []
+            for labelValue, histogram in sorted(family.histograms.items(), key=lambda item: str(item[0])):
+                labels = {} if family.labelName is None else {family.labelName: labelValue}
+                counts, total = histogram.snapshot()
+                cumulative = 0
+                for bound, count in zip(histogram.bounds, counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(family.name, formatLabels(dict(labels, le=repr(bound))), cumulative))
+                cumulative += counts[-1]
+                lines.append('{}_bucket{} {}'.format(family.name, formatLabels(dict(labels, le='+Inf')), cumulative))
+                lines.append('{}_sum{} {}'.format(family.name, formatLabels(labels), repr(total)))
+                lines.append('{}_count{} {}'.format(family.name, formatLabels(labels), cumulative))
+                for q in reportedQuantiles:
+                    value = histogram.quantile(q, counts)
+                    if value is not None:
+                        quantileLines.append('{}_quantile{} {}'.format(family.name, formatLabels(dict(labels, quantile=repr(q))), repr(value)))
+            if len(quantileLines) > 0:
+                # Estimates from the buckets, for reading the endpoint without a Prometheus server
+                lines.append('# HELP {}_quantile Estimated {} quantiles'.format(family.name, family.name))
+                lines.append('# TYPE {}_quantile gauge'.format(family.name))
+                lines.extend(quantileLines)
+        return '\n'.join(lines) + '\n'
+
+def formatLabels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels.items()) + '}'
+
+registry = MetricsRegistry()
+requestDurations = registry.histogramFamily('hatgame_request_duration_seconds',
+                                            'Time spent in each Flask route', 'route')
+gameMethodDurations = registry.histogramFamily('hatgame_game_method_duration_seconds',
+                                               'Time spent in GameSession methods, lock wait included', 'method')
+lockWaits = registry.histogramFamily('hatgame_game_lock_wait_seconds',
+                                     'Time spent waiting to acquire a GameSession lock', buckets=lockBuckets).labels(None)
+lockHolds = registry.histogramFamily('hatgame_game_lock_hold_seconds',
+                                     'Time a GameSession lock is held', buckets=lockBuckets).labels(None)
+
+def timedGameMethod(method):
+    # Decorator for GameSession methods
+    histogram = gameMethodDurations.labels(method.__name__)
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        startTime = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - startTime)
+    return wrapper
+
+def instrumentFlaskApp(app):
+    # Wraps every view function registered so far with a timer labelled by its route
+    routesByEndpoint = {rule.endpoint: rule.rule for rule in app.url_map.iter_rules()}
+    for endpoint, view in list(app.view_functions.items()):
+        histogram = requestDurations.labels(routesByEndpoint.get(endpoint, endpoint))
+        app.view_functions[endpoint] = timedView(view, histogram)
+
+def timedView(view, histogram):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        startTime = time.perf_counter()
+        try:
+            return view(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - startTime)
+    return wrapper
+
+class InstrumentedLock:
+    """threading.Lock that records how long callers wait for it and how long it is held."""
+    __slots__ = ('lock', 'acquiredTime')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.acquiredTime = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        startTime = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        if acquired:
+            self.acquiredTime = time.perf_counter()
+            lockWaits.observe(self.acquiredTime - startTime)
+        return acquired
+
+    def release(self):
+        holdSeconds = time.perf_counter() - self.acquiredTime
+        self.lock.release()
+        lockHolds.observe(holdSeconds)
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return True
+
+    def __exit__(self, excType, excValue, traceback):
+        self.release()
@@ -0,0 +1,45 @@
+
+# Measures what the metrics instrumentation adds to a request: the route timer, a timed
+# GameSession method and one acquire/release of an InstrumentedLock, each compared with
+# the same call uninstrumented.
+#
+#   python python/metricsBenchmark.py
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from python import metrics
+
+iterations = 1000000
+
+def timePerCall(function):
+    startTime = time.perf_counter()
+    for i in range(iterations):
+        function()
+    return (time.perf_counter() - startTime) / iterations
+
+def view():
+    return 'ok'
+
+def plainLocking(lock=threading.Lock()):
+    with lock:
+        pass
+
+def instrumentedLocking(lock=metrics.InstrumentedLock()):
+    with lock:
+        pass
+
+if __name__ == '__main__':
+    timedView = metrics.timedView(view, metrics.requestDurations.labels('benchmark'))
+    timedMethod = metrics.timedGameMethod(view)
+
+    routeOverhead = timePerCall(timedView) - timePerCall(view)
+    methodOverhead = timePerCall(timedMethod) - timePerCall(view)
+    lockOverhead = timePerCall(instrumentedLocking) - timePerCall(plainLocking)
+    print('route timer:       {:.2f} us'.format(routeOverhead * 1e6))
+    print('method timer:      {:.2f} us'.format(methodOverhead * 1e6))
+    print('instrumented lock: {:.2f} us'.format(lockOverhead * 1e6))
+    print('per mutation request (route + method + lock): {:.2f} us'.format((routeOverhead + methodOverhead + lockOverhead) * 1e6))
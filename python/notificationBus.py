@@ -0,0 +1,185 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+
+from python import gameLog
+
+class NotificationBus:
+    """Carries "game changed" notifications from GameSession.signalRefresh to whoever is
+    holding an event stream for that game. Listeners are plain callables taking no
+    arguments; they are called on the publishing thread, or on the bus's reader thread
+    for notifications from other processes, so they must only hand off the wakeup."""
+    def publish(self, gameId):
+        raise NotImplementedError()
+
+    def subscribe(self, gameId, listener):
+        raise NotImplementedError()
+
+    def unsubscribe(self, gameId, listener):
+        raise NotImplementedError()
+
+class LocalNotificationBus(NotificationBus):
+    """In-process bus: a set of listeners per game."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listenersByGame = {}
+
+    def subscribe(self, gameId, listener):
+        # Returns True when this is the first listener for the game
+        with self.lock:
+            listeners = self.listenersByGame.setdefault(gameId, set())
+            listeners.add(listener)
+            return len(listeners) == 1
+
+    def unsubscribe(self, gameId, listener):
+        # Returns True when the game has no listeners left
+        with self.lock:
+            listeners = self.listenersByGame.get(gameId)
+            if listeners is None:
+                return False
+            listeners.discard(listener)
+            if len(listeners) == 0:
+                del self.listenersByGame[gameId]
+                return True
+            return False
+
+    def publish(self, gameId):
+        with self.lock:
+            listeners = list(self.listenersByGame.get(gameId, ()))
+        for listener in listeners:
+            listener()
+
+    def subscribedGames(self):
+        with self.lock:
+            return list(self.listenersByGame.keys())
+
+    def listenerCount(self):
+        with self.lock:
+            return sum(len(listeners) for listeners in self.listenersByGame.values())
+
+class SocketNotificationBus(NotificationBus):
+    """Cross-process bus through a NotificationBroker on a Unix-domain socket. Listeners in
+    this process are called directly, as with the local bus; the broker only carries one
+    line per publish to each other process that has listeners for the game, and that
+    process fans it out to its own listeners. If the broker goes away, notifications stay
+    local until it is back."""
+    def __init__(self, socketPath, reconnectSeconds=1.0):
+        self.socketPath = socketPath
+        self.reconnectSeconds = reconnectSeconds
+        self.localBus = LocalNotificationBus()
+        self.sendLock = threading.Lock()
+        self.connection = None
+        self.readerThread = threading.Thread(target=self.readLoop, name='notification-bus-reader', daemon=True)
+        self.readerThread.start()
+
+    def subscribe(self, gameId, listener):
+        if self.localBus.subscribe(gameId, listener):
+            self.send('S', gameId)
+
+    def unsubscribe(self, gameId, listener):
+        if self.localBus.unsubscribe(gameId, listener):
+            self.send('U', gameId)
+
+    def publish(self, gameId):
+        self.localBus.publish(gameId)
+        self.send('P', gameId)
+
+    def listenerCount(self):
+        return self.localBus.listenerCount()
+
+    def send(self, command, gameId):
+        with self.sendLock:
+            if self.connection is None:
+                return
+            try:
+                self.connection.sendall('{} {}\n'.format(command, gameId).encode('utf-8'))
+            except OSError:
+                self.connection = None
+
+    def connect(self):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(self.socketPath)
+        with self.sendLock:
+            # Subscriptions made while disconnected are sent in the same critical section,
+            # so none can be lost or unsubscribed out of order
+            lines = ''.join('S {}\n'.format(gameId) for gameId in self.localBus.subscribedGames())
+            connection.sendall(lines.encode('utf-8'))
+            self.connection = connection
+        return connection
+
+    def readLoop(self):
+        while True:
+            try:
+                connection = self.connect()
+                with connection.makefile('r', encoding='utf-8') as lines:
+                    for line in lines:
+                        command, gameId = line.rstrip('\n').split(' ', 1)
+                        if command == 'P':
+                            self.localBus.publish(gameId)
+            except OSError as err:
+                gameLog.reportError('notificationBus', err, expected=True)
+            with self.sendLock:
+                self.connection = None
+            time.sleep(self.reconnectSeconds)
+
+class NotificationBroker:
+    """Relays publishes between processes. Each connected process tells the broker which
+    games it has listeners for; a publish is forwarded to every other process subscribed
+    to that game. Runs on an asyncio loop, e.g. inside the shard router."""
+    def __init__(self, socketPath):
+        self.socketPath = socketPath
+        self.writersByGame = {}
+        self.messageCount = 0
+
+    async def start(self):
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
+        return await asyncio.start_unix_server(self.handleConnection, self.socketPath)
+
+    async def handleConnection(self, reader, writer):
+        subscribedGames = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if len(line) == 0:
+                    break
+                command, gameId = line.decode('utf-8').rstrip('\n').split(' ', 1)
+                if command == 'S':
+                    subscribedGames.add(gameId)
+                    self.writersByGame.setdefault(gameId, set()).add(writer)
+                elif command == 'U':
+                    subscribedGames.discard(gameId)
+                    self.removeWriter(gameId, writer)
+                elif command == 'P':
+                    self.messageCount += 1
+                    for otherWriter in self.writersByGame.get(gameId, ()):
+                        if otherWriter is not writer:
+                            otherWriter.write(line)
+        except (ConnectionError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            pass # shutting down
+        finally:
+            for gameId in subscribedGames:
+                self.removeWriter(gameId, writer)
+            writer.close()
+
+    def removeWriter(self, gameId, writer):
+        writers = self.writersByGame.get(gameId)
+        if writers is not None:
+            writers.discard(writer)
+            if len(writers) == 0:
+                del self.writersByGame[gameId]
+
+# The bus GameSession publishes to. Processes that share games with other processes
+# switch it with useBus before serving.
+currentBus = LocalNotificationBus()
+
+def getBus():
+    return currentBus
+
+def useBus(bus):
+    global currentBus
+    currentBus = bus
@@ -0,0 +1,58 @@
+import random
+
+class PhraseHat:
+    """An ordered collection of phrase IDs with a dict index from ID to position, so
+    membership tests, removal and random draws are O(1). Removal swaps the last ID into the
+    removed slot, which is fine because the hat is shuffled at the start of every turn."""
+    __slots__ = ('phraseIds', 'positions')
+
+    def __init__(self, phraseIds=()):
+        self.phraseIds = []
+        self.positions = {}
+        for phraseId in phraseIds:
+            self.add(phraseId)
+
+    def __len__(self):
+        return len(self.phraseIds)
+
+    def __contains__(self, phraseId):
+        return phraseId in self.positions
+
+    def __iter__(self):
+        return iter(self.phraseIds)
+
+    def add(self, phraseId):
+        if phraseId in self.positions:
+            return False
+        self.positions[phraseId] = len(self.phraseIds)
+        self.phraseIds.append(phraseId)
+        return True
+
+    def remove(self, phraseId):
+        position = self.positions.pop(phraseId, None)
+        if position is None:
+            return False
+        lastId = self.phraseIds.pop()
+        if position < len(self.phraseIds):
+            self.phraseIds[position] = lastId
+            self.positions[lastId] = position
+        return True
+
+    def draw(self):
+        # Returns a random phrase ID without removing it
+        return self.phraseIds[random.randrange(len(self.phraseIds))]
+
+    def shuffle(self, rng=random):
+        rng.shuffle(self.phraseIds)
+        for position, phraseId in enumerate(self.phraseIds):
+            self.positions[phraseId] = position
+
+    def clear(self):
+        self.phraseIds = []
+        self.positions = {}
+
+    def toList(self):
+        return list(self.phraseIds)
+
+    def toTuple(self):
+        return tuple(self.phraseIds)
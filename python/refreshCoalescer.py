@@ -0,0 +1,57 @@
+import threading
+import time
+
+from python import notificationBus
+from python.scheduler import scheduler
+
+defaultWindowSeconds = 0.05
+
+class RefreshCoalescer:
+    """Limits how often a game's subscribers are woken. The first refresh after a quiet
+    period is published at once; further refreshes within windowSeconds of it are folded
+    into a single publish at the end of the window. Subscribers always catch up to the
+    newest version when woken, so nothing is lost, only batched. A refresh that comes
+    with a phase change, or for a closed game, is published at once. A window of 0
+    publishes every refresh."""
+    def __init__(self, windowSeconds=defaultWindowSeconds):
+        self.windowSeconds = windowSeconds
+        self.lock = threading.Lock()
+        self.sentCount = 0
+        self.suppressedCount = 0
+
+    def signal(self, game, immediate=False):
+        now = time.time()
+        # Both counts only ever go up, as /metrics exports them as counters: a refresh is
+        # counted as suppressed once it is known to be folded into another publish
+        with self.lock:
+            if immediate or self.windowSeconds <= 0.0 or now - game.lastRefreshTime >= self.windowSeconds:
+                if game.refreshPending:
+                    self.suppressedCount += 1 # the held-back refresh goes out with this one
+                game.refreshPending = False
+                game.lastRefreshTime = now
+                self.sentCount += 1
+            else:
+                if game.refreshPending:
+                    self.suppressedCount += 1
+                    return
+                game.refreshPending = True
+                scheduler.callAt(game.lastRefreshTime + self.windowSeconds, lambda: self.flush(game))
+                return
+        notificationBus.getBus().publish(game.id)
+
+    def flush(self, game):
+        # End of a window with refreshes held back. An immediate publish meanwhile already
+        # covered them.
+        with self.lock:
+            if not game.refreshPending:
+                return
+            game.refreshPending = False
+            game.lastRefreshTime = time.time()
+            self.sentCount += 1
+        notificationBus.getBus().publish(game.id)
+
+    def getStats(self):
+        with self.lock:
+            return {'sent': self.sentCount, 'suppressed': self.suppressedCount}
+
+refreshCoalescer = RefreshCoalescer()
@@ -0,0 +1,64 @@
+import heapq
+import itertools
+import threading
+import time
+
+from python import gameLog
+
+class ScheduledCall:
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+class Scheduler:
+    """One thread running callbacks at given times, from a heap ordered by due time, so
+    many short delays do not each need a threading.Timer. Callbacks run on the scheduler
+    thread and should be quick. Cancelling only marks the entry; it is dropped when it
+    comes due."""
+    def __init__(self, name='scheduler'):
+        self.name = name
+        self.condition = threading.Condition()
+        self.heap = []
+        self.counter = itertools.count() # breaks ties between equal due times
+        self.thread = None
+
+    def callAt(self, when, callback):
+        # when is a time.time() value; returns a ScheduledCall that can be cancelled
+        call = ScheduledCall(when, callback)
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+                self.thread.start()
+            heapq.heappush(self.heap, (when, next(self.counter), call))
+            if self.heap[0][2] is call:
+                self.condition.notify()
+        return call
+
+    def callLater(self, delaySeconds, callback):
+        return self.callAt(time.time() + delaySeconds, callback)
+
+    def cancel(self, call):
+        call.cancelled = True
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if len(self.heap) == 0:
+                        self.condition.wait()
+                        continue
+                    delay = self.heap[0][0] - time.time()
+                    if delay <= 0.0:
+                        break
+                    self.condition.wait(delay)
+                when, order, call = heapq.heappop(self.heap)
+            if call.cancelled:
+                continue
+            try:
+                call.callback()
+            except Exception as err:
+                gameLog.reportError(self.name, err)
+
+# Shared by the game server's timers
+scheduler = Scheduler()
@@ -0,0 +1,92 @@
+
+# Measures request throughput of shardedServer.py for several worker counts. For each count
+# it starts the server, has a number of concurrent clients each create games and then
+# alternate between writing phrases and polling game state, and reports requests/second.
+#
+#   python python/shardBenchmark.py --workers 1 2 4 8 --seconds 10
+#
+# Throughput can only grow with the worker count up to the number of CPU cores.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import string
+import subprocess
+import sys
+import time
+
+rootDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def randomString(length=10):
+    letters = string.ascii_lowercase
+    return ''.join(random.choice(letters) for i in range(length))
+
+async def sendRequest(host, port, method, path, body=None):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        payload = b'' if body is None else json.dumps(body).encode('utf-8')
+        head = '{} {} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'
+        writer.write(head.format(method, path, host, len(payload)).encode('latin-1') + payload)
+        await writer.drain()
+        response = await reader.read()
+        return int(response.split(b' ', 2)[1])
+    finally:
+        writer.close()
+
+async def client(host, port, deadline, counts):
+    while time.time() < deadline:
+        gameId = randomString()
+        teams = [['p{}{}'.format(teamIdx, playerIdx) for playerIdx in range(3)] for teamIdx in range(2)]
+        status = await sendRequest(host, port, 'POST', '/api/newgame',
+                                   {'id': gameId, 'teams': teams, 'phrasesPerPlayer': 3, 'secondsPerTurn': 60, 'videoURL': 'vid'})
+        counts[status == 200] += 1
+        for team in teams:
+            for playerId in team:
+                if time.time() >= deadline:
+                    return
+                status = await sendRequest(host, port, 'POST', '/games/{}/{}/recordphrases'.format(gameId, playerId),
+                                           {'phrases': [randomString(6) for i in range(3)]})
+                counts[status == 200] += 1
+                status = await sendRequest(host, port, 'GET', '/api/gamestate/{}'.format(gameId))
+                counts[status == 200] += 1
+
+async def runClients(host, port, clientCount, seconds):
+    counts = [0, 0] # failed, succeeded
+    startTime = time.time()
+    await asyncio.gather(*[client(host, port, startTime + seconds, counts) for i in range(clientCount)])
+    return counts, time.time() - startTime
+
+async def waitForServer(host, port, timeoutSeconds=60.0):
+    deadline = time.time() + timeoutSeconds
+    while time.time() < deadline:
+        try:
+            if await sendRequest(host, port, 'GET', '/api/gamelist') == 200:
+                return
+        except OSError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError('server did not start')
+
+def measure(workerCount, args):
+    server = subprocess.Popen([sys.executable, 'shardedServer.py', '--workers', str(workerCount), '--port', str(args.port)],
+                              cwd=rootDir, stdout=subprocess.DEVNULL)
+    try:
+        asyncio.run(waitForServer('127.0.0.1', args.port))
+        counts, seconds = asyncio.run(runClients('127.0.0.1', args.port, args.clients, args.seconds))
+        print('{} workers: {:.0f} requests/s ({} failed)'.format(workerCount, counts[1] / seconds, counts[0]))
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--clients', type=int, default=64)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--port', type=int, default=5100)
+    args = parser.parse_args()
+    print('cpu cores:', os.cpu_count())
+    for workerCount in args.workers:
+        measure(workerCount, args)
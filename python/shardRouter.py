@@ -0,0 +1,225 @@
+import asyncio
+import json
+import random
+import string
+import urllib.parse
+import zlib
+
+# Routes whose second path segment is a game ID. Everything about one game, including its
+# event streams, has to reach the worker process that owns it.
+gameRoutePrefixes = ['/games/', '/api/gamestate/', '/api/stream/', '/api/phrases/', '/api/refresh/',
+                     '/api/loglevel/', '/api/spectate/', '/api/socket/']
+maxHeadBytes = 65536
+
+def shardForGame(gameId, shardCount):
+    # crc32 rather than hash() so that every process agrees on the owner
+    return zlib.crc32(gameId.encode('utf-8')) % shardCount
+
+def gameIdFromPath(path):
+    # Decoded as the worker's routing decodes it, so 'my%20game' hashes like the 'my game'
+    # that prepareNewGame read from the JSON body
+    for prefix in gameRoutePrefixes:
+        if path.startswith(prefix):
+            gameId = urllib.parse.unquote(path[len(prefix):].split('/')[0])
+            if len(gameId) > 0:
+                return gameId
+    return None
+
+def isLocalPeer(clientWriter):
+    peer = clientWriter.get_extra_info('peername')
+    return peer is not None and peer[0] in ('127.0.0.1', '::1')
+
+def randomGameID():
+    # Same form as the IDs flaskServer.startNewGame makes up
+    letters = string.ascii_lowercase
+    return ''.join(random.choice(letters) for i in range(8))
+
+class HttpRequest:
+    def __init__(self, method, target, version, headers, body):
+        self.method = method
+        self.target = target
+        self.path = target.split('?')[0]
+        self.version = version
+        self.headers = headers # list of (name, value), in order
+        self.body = body
+
+    def header(self, name):
+        name = name.lower()
+        for headerName, value in self.headers:
+            if headerName.lower() == name:
+                return value
+        return None
+
+    def isUpgrade(self):
+        return (self.header('Upgrade') or '').lower() == 'websocket'
+
+    def encode(self):
+        # Re-encodes the request for a worker. The router handles one request per client
+        # connection, so the worker is asked to close when it is done, unless the request
+        # upgrades the connection to a WebSocket.
+        lines = ['{} {} {}'.format(self.method, self.target, self.version)]
+        for name, value in self.headers:
+            if name.lower() not in ('connection', 'content-length', 'keep-alive'):
+                lines.append('{}: {}'.format(name, value))
+        lines.append('Content-Length: {}'.format(len(self.body)))
+        lines.append('Connection: Upgrade' if self.isUpgrade() else 'Connection: close')
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + self.body
+
+async def readRequest(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    if len(head) > maxHeadBytes:
+        raise ValueError('request head too large')
+    lines = head.decode('latin-1').split('\r\n')
+    method, target, version = lines[0].split(' ', 2)
+    headers = []
+    for line in lines[1:]:
+        if len(line) > 0:
+            name, value = line.split(':', 1)
+            headers.append((name.strip(), value.strip()))
+    request = HttpRequest(method, target, version, headers, b'')
+    contentLength = request.header('Content-Length')
+    if contentLength is not None:
+        request.body = await reader.readexactly(int(contentLength))
+    return request
+
+def splitResponse(response):
+    head, body = response.split(b'\r\n\r\n', 1)
+    if b'transfer-encoding: chunked' in head.lower():
+        chunks = []
+        while True:
+            sizeLine, body = body.split(b'\r\n', 1)
+            size = int(sizeLine.split(b';')[0], 16)
+            if size == 0:
+                break
+            chunks.append(body[:size])
+            body = body[size + 2:]
+        body = b''.join(chunks)
+    return head, body
+
+class ShardRouter:
+    """Reverse proxy in front of several worker processes, each running the hat game app
+    on its own Unix socket and owning the games whose ID hashes to it. Game routes go to
+    the owning worker, /api/newgame is routed by the (possibly newly chosen) game ID,
+    /api/gamelist is merged from every worker, and anything else (pages, static files,
+    random words) goes to the workers in turn."""
+    def __init__(self, workerSocketPaths):
+        self.workerSocketPaths = workerSocketPaths
+        self.nextWorker = 0
+
+    def workerForRequest(self, request):
+        gameId = gameIdFromPath(request.path)
+        if gameId is not None:
+            return shardForGame(gameId, len(self.workerSocketPaths))
+        self.nextWorker = (self.nextWorker + 1) % len(self.workerSocketPaths)
+        return self.nextWorker
+
+    async def handleConnection(self, clientReader, clientWriter):
+        try:
+            request = await readRequest(clientReader)
+            if request.path == '/api/gamelist':
+                await self.sendGameList(clientWriter)
+            elif request.path == '/metrics':
+                await self.forwardMetrics(request, clientReader, clientWriter)
+            elif request.path.startswith('/api/loglevel/') and not isLocalPeer(clientWriter):
+                # Workers cannot tell where a request came from, as for /metrics
+                await self.sendResponse(clientWriter, '403 Forbidden', 'text/plain', b'forbidden')
+            else:
+                if request.path == '/api/newgame':
+                    workerIdx = self.prepareNewGame(request)
+                else:
+                    workerIdx = self.workerForRequest(request)
+                await self.forward(request, workerIdx, clientReader, clientWriter)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            pass # shutting down
+        finally:
+            clientWriter.close()
+
+    def prepareNewGame(self, request):
+        # The owner depends on the game ID, so pick one here when the client did not
+        try:
+            gameDict = json.loads(request.body)
+        except ValueError:
+            return 0
+        if not isinstance(gameDict, dict):
+            return 0
+        if 'id' not in gameDict:
+            gameDict['id'] = randomGameID()
+            request.body = json.dumps(gameDict).encode('utf-8')
+        return shardForGame(str(gameDict['id']), len(self.workerSocketPaths))
+
+    async def forwardMetrics(self, request, clientReader, clientWriter):
+        # Workers see every request as coming over their Unix socket, so the router keeps
+        # /metrics local. Each worker has its own metrics; ?shard=<index> picks one.
+        if not isLocalPeer(clientWriter):
+            await self.sendResponse(clientWriter, '403 Forbidden', 'text/plain', b'forbidden')
+            return
+        query = urllib.parse.parse_qs(request.target.partition('?')[2])
+        try:
+            workerIdx = int(query.get('shard', ['0'])[0])
+        except ValueError:
+            workerIdx = -1
+        if workerIdx < 0 or workerIdx >= len(self.workerSocketPaths):
+            await self.sendResponse(clientWriter, '404 Not Found', 'text/plain', b'no such shard')
+            return
+        await self.forward(request, workerIdx, clientReader, clientWriter)
+
+    async def sendResponse(self, clientWriter, status, contentType, body):
+        clientWriter.write('HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'
+                           .format(status, contentType, len(body)).encode('latin-1') + body)
+        await clientWriter.drain()
+
+    async def forward(self, request, workerIdx, clientReader, clientWriter):
+        workerReader, workerWriter = await asyncio.open_unix_connection(self.workerSocketPaths[workerIdx])
+        try:
+            workerWriter.write(request.encode())
+            await workerWriter.drain()
+            # Copy the response until the worker closes, or until the client goes away,
+            # which for an event stream is the only way it ends. A WebSocket is copied both ways.
+            copyTask = asyncio.ensure_future(self.copy(workerReader, clientWriter))
+            if request.isUpgrade():
+                hangupTask = asyncio.ensure_future(self.copy(clientReader, workerWriter))
+            else:
+                hangupTask = asyncio.ensure_future(clientReader.read())
+            done, pending = await asyncio.wait([copyTask, hangupTask], return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+        finally:
+            workerWriter.close()
+
+    async def copy(self, reader, writer):
+        while True:
+            data = await reader.read(65536)
+            if len(data) == 0:
+                return
+            writer.write(data)
+            await writer.drain()
+
+    async def fetchFromWorker(self, workerIdx, path):
+        reader, writer = await asyncio.open_unix_connection(self.workerSocketPaths[workerIdx])
+        try:
+            writer.write('GET {} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n'.format(path).encode('latin-1'))
+            await writer.drain()
+            head, body = splitResponse(await reader.read())
+            return json.loads(body)
+        finally:
+            writer.close()
+
+    async def sendGameList(self, clientWriter):
+        results = await asyncio.gather(*[self.fetchFromWorker(workerIdx, '/api/gamelist')
+                                         for workerIdx in range(len(self.workerSocketPaths))])
+        # Every worker creates the debug games at startup, so drop repeated IDs
+        games = []
+        seenIds = set()
+        for result in results:
+            for gameId in result['games']:
+                if gameId not in seenIds:
+                    seenIds.add(gameId)
+                    games.append(gameId)
+        await self.sendResponse(clientWriter, '200 OK', 'application/json', json.dumps({'games': games}).encode('utf-8'))
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handleConnection, host, port, backlog=4096)
+        async with server:
+            await server.serve_forever()
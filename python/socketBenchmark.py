@@ -0,0 +1,188 @@
+
+# Click-to-broadcast latency of the two transports: the game socket, which carries a player's
+# actions and the state events over one WebSocket, against HTTP POSTs plus the event stream.
+# Plays several games at once on an ASGI server; in every turn the active player guesses
+# words, and each guess is timed from sending it until every player of the game has the new
+# state version.
+#
+#   python python/socketBenchmark.py --games 10 --seed 1
+#   python python/socketBenchmark.py --server none --port 5000      (a server that is already up)
+#
+# Needs the websockets module, which uvicorn also needs to serve the game socket.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+try:
+    from websockets.asyncio.client import connect as connectSocket
+except ImportError:
+    connectSocket = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from python.loadTest import HttpConnection, readHead, readChunks, rawChunks, waitForServer, startServer, percentile
+
+def parseEvents(text):
+    # (event type, id) of each event in event stream format text
+    result = []
+    for block in text.split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.split('\n') if ': ' in line and not line.startswith(':'))
+        if 'event' in fields:
+            result.append((fields['event'], int(fields['id']) if 'id' in fields else None))
+    return result
+
+class BenchmarkGame:
+    def __init__(self, gameIdx, transport, args, clickLatencies):
+        self.args = args
+        self.transport = transport
+        self.rng = random.Random('{}-{}'.format(args.seed, gameIdx))
+        self.gameId = 'socket{}x{}x{}'.format(args.seed, transport, gameIdx)
+        self.teams = [['t{}p{}'.format(teamIdx, playerIdx) for playerIdx in range(args.players)] for teamIdx in range(2)]
+        self.playerIds = [playerId for team in self.teams for playerId in team]
+        self.connection = HttpConnection(args.host, args.port, False) # setup requests and HTTP actions
+        self.sockets = {}
+        self.readerTasks = []
+        self.clickLatencies = clickLatencies
+        self.version = 0
+        self.receivedCounts = {} # version -> players that have it
+        self.versionEvents = {} # version -> asyncio.Event set when every player has it
+        self.actionCount = 0
+
+    def received(self, version):
+        # Every player's connection records each version it gets, from a delta or a snapshot
+        count = self.receivedCounts.get(version, 0) + 1
+        self.receivedCounts[version] = count
+        if count == len(self.playerIds):
+            self.versionEvents.setdefault(version, asyncio.Event()).set()
+
+    async def readStream(self, playerId, ready):
+        reader, writer = await asyncio.open_connection(self.args.host, self.args.port)
+        try:
+            writer.write('GET /api/stream/{}/{}/events HTTP/1.1\r\nHost: {}\r\n\r\n'.format(
+                self.gameId, playerId, self.args.host).encode('latin-1'))
+            await writer.drain()
+            status, headers = await readHead(reader)
+            chunks = readChunks(reader) if headers.get('transfer-encoding', '').lower() == 'chunked' else rawChunks(reader)
+            pending = ''
+            async for chunk in chunks:
+                pending += chunk.decode('utf-8')
+                text, separator, pending = pending.rpartition('\n\n')
+                for eventType, version in parseEvents(text):
+                    if version is not None:
+                        self.received(version)
+                ready.set()
+        finally:
+            ready.set()
+            writer.close()
+
+    async def readSocket(self, playerId, ready):
+        socket = await connectSocket('ws://{}:{}/api/socket/{}/{}'.format(self.args.host, self.args.port, self.gameId, playerId))
+        self.sockets[playerId] = socket
+        try:
+            async for text in socket:
+                for eventType, version in parseEvents(text):
+                    if version is not None:
+                        self.received(version)
+                ready.set()
+        finally:
+            ready.set()
+
+    async def action(self, playerId, action, params, path, body=None):
+        # Sends one action and waits until every player has the version it makes
+        self.version += 1
+        done = self.versionEvents.setdefault(self.version, asyncio.Event())
+        startTime = time.perf_counter()
+        if self.transport == 'socket':
+            self.actionCount += 1
+            message = dict(params, id=self.actionCount, action=action)
+            await self.sockets[playerId].send(json.dumps(message))
+        else:
+            await self.connection.request('POST', path, body)
+        await asyncio.wait_for(done.wait(), 10.0)
+        if action == 'prevphrase':
+            self.clickLatencies.append(time.perf_counter() - startTime)
+
+    async def play(self):
+        args = self.args
+        await self.connection.request('POST', '/api/newgame', {'id': self.gameId, 'teams': self.teams, 'phrasesPerPlayer': args.phrases,
+                                                               'secondsPerTurn': 200, 'videoURL': 'https://meet.example.com/abc'})
+        for playerId in self.playerIds:
+            await self.connection.request('POST', '/games/{}/{}/recordphrases'.format(self.gameId, playerId),
+                                          {'phrases': ['{} phrase {}'.format(playerId, i) for i in range(args.phrases)]})
+        status, body = await self.connection.request('GET', '/api/gamestate/{}'.format(self.gameId))
+        self.version = json.loads(body)['stateVersion']
+        for playerId in self.playerIds:
+            ready = asyncio.Event()
+            read = self.readSocket if self.transport == 'socket' else self.readStream
+            self.readerTasks.append(asyncio.ensure_future(read(playerId, ready)))
+            await ready.wait()
+
+        try:
+            for turn in range(args.turns):
+                status, body = await self.connection.request('GET', '/api/gamestate/{}'.format(self.gameId))
+                state = json.loads(body)
+                if state['mainPhase'] == 'GameMainPhase.Done':
+                    break
+                teamIdx = state['activeTeamIndex']
+                playerId = state['teams'][teamIdx][state['activePlayerIndexPerTeam'][teamIdx]]
+                gamePath = '/games/{}/{}/'.format(self.gameId, playerId)
+                await self.action(playerId, 'startturn', {}, gamePath + 'startturn')
+                status, body = await self.connection.request('GET', '/api/gamestate/{}?player={}'.format(self.gameId, playerId))
+                hat = json.loads(body)['hat']
+                guessCount = min(len(hat), self.rng.randint(1, args.guessesPerTurn))
+                for phraseId in hat[:guessCount]:
+                    await asyncio.sleep(self.rng.uniform(0.5, 1.5) * args.thinkMs / 1000.0)
+                    await self.action(playerId, 'prevphrase', {'phraseId': phraseId}, '/games/{}/prevphrase/{}'.format(self.gameId, phraseId))
+                if guessCount < len(hat):
+                    await self.action(playerId, 'endturn', {}, gamePath + 'endturn')
+                await self.action(playerId, 'confirmphrases', {'acceptedPhrases': hat[:guessCount]}, gamePath + 'confirmphrases',
+                                  {'acceptedPhrases': hat[:guessCount]})
+        finally:
+            for socket in self.sockets.values():
+                await socket.close()
+            for task in self.readerTasks:
+                task.cancel()
+            await asyncio.gather(*self.readerTasks, return_exceptions=True)
+            self.connection.close()
+
+async def run(args):
+    await waitForServer(args.host, args.port)
+    for transport in ['http', 'socket']:
+        clickLatencies = []
+        startTime = time.perf_counter()
+        await asyncio.gather(*[BenchmarkGame(gameIdx, transport, args, clickLatencies).play() for gameIdx in range(args.games)])
+        seconds = time.perf_counter() - startTime
+        clickLatencies.sort()
+        print('{:<7} {} clicks in {:.1f} s, click to every player: p50 {:.2f} ms, p95 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms'.format(
+            transport, len(clickLatencies), seconds, percentile(clickLatencies, 0.5) * 1000.0, percentile(clickLatencies, 0.95) * 1000.0,
+            percentile(clickLatencies, 0.99) * 1000.0, clickLatencies[-1] * 1000.0))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--server', choices=['asgi', 'sharded', 'none'], default='asgi',
+                        help='server to start for the test, or none to use one already running')
+    parser.add_argument('--workers', type=int, default=2, help='worker processes for --server sharded')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5220)
+    parser.add_argument('--games', type=int, default=10, help='games played at the same time')
+    parser.add_argument('--players', type=int, default=3, help='players per team')
+    parser.add_argument('--phrases', type=int, default=5, help='phrases per player')
+    parser.add_argument('--turns', type=int, default=10)
+    parser.add_argument('--guessesPerTurn', type=int, default=6)
+    parser.add_argument('--thinkMs', type=float, default=20.0, help='mean pause before each guess')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    if connectSocket is None:
+        sys.exit('socketBenchmark.py needs the websockets module')
+
+    server = None if args.server == 'none' else startServer(args)
+    try:
+        asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
@@ -0,0 +1,202 @@
+
+# One game watched by many spectators. First, in process: the work per state change with
+# the shared SpectatorFeed, against projecting and serializing the state for every
+# spectator. Then over HTTP: opens the spectator streams of one game on a server, plays
+# turns and reports how long each delta took to reach every spectator.
+#
+#   python python/spectatorBenchmark.py --spectators 1000
+#   python python/spectatorBenchmark.py --server none --port 5000      (a server that is already up)
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from python import gameLog
+from python import fastJson
+from python.gameSession import GameSession
+from python.gameSession import publicStateDict
+from python.spectators import getSpectatorFeed
+from python.loadTest import HttpConnection, readHead, readChunks, rawChunks, waitForServer, startServer, percentile
+
+def newGame(gameId):
+    teams = [['t0p0', 't0p1', 't0p2'], ['t1p0', 't1p1', 't1p2']]
+    game = GameSession(gameId, teams, 5, 200, 'https://meet.example.com/abc-defg-hij')
+    game.showLog = False
+    for team in teams:
+        for playerId in team:
+            game.recordPlayerPhrases(playerId, ['{} phrase {}'.format(playerId, i) for i in range(5)])
+    return game
+
+def inProcess(spectatorCount, rounds):
+    # Every spectator wakes, catches up and keeps what it would send
+    game = newGame('bench')
+    feed = getSpectatorFeed(game)
+    versions = [feed.getPublishedState().version] * spectatorCount
+    sent = [None] * spectatorCount
+    for idx in range(spectatorCount):
+        feed.addRefreshListener(lambda: None)
+
+    sharedSeconds = 0.0
+    for round in range(rounds):
+        if game.subPhase.name == 'WaitForStart':
+            game.startPlayerTurn(game.activePlayer().id)
+        else:
+            game.recordPrevPhrase(game.phrasesInHat.toList()[0])
+        startTime = time.perf_counter()
+        feed.refresh()
+        for idx in range(spectatorCount):
+            versions[idx], events = feed.getCatchUpEvents(versions[idx])
+            sent[idx] = events[0]
+        sharedSeconds += time.perf_counter() - startTime
+        assert all(body is sent[0] for body in sent)
+
+    # As if every spectator were a player fetching the whole state on each change
+    startTime = time.perf_counter()
+    for round in range(rounds):
+        for idx in range(spectatorCount):
+            with game.lock:
+                state = game.getStateDict()
+            fastJson.dumps(publicStateDict(state))
+    perSpectatorSeconds = time.perf_counter() - startTime
+    print('in process, {} spectators: {:.2f} ms per change with a shared feed, {:.2f} ms with a state fetch per spectator'.format(
+        spectatorCount, sharedSeconds / rounds * 1000.0, perSpectatorSeconds / rounds * 1000.0))
+
+class Spectators:
+    def __init__(self, args, gameId):
+        self.args = args
+        self.gameId = gameId
+        self.sentTimes = {} # version -> when the mutation that makes it was sent
+        self.lags = []
+        self.deltaCounts = []
+        self.hatsSeen = 0
+
+    async def watch(self, ready):
+        reader, writer = await asyncio.open_connection(self.args.host, self.args.port)
+        deltaCount = 0
+        try:
+            writer.write('GET /api/spectate/{}/events HTTP/1.1\r\nHost: {}\r\nAccept: text/event-stream\r\n\r\n'.format(
+                self.gameId, self.args.host).encode('latin-1'))
+            await writer.drain()
+            status, headers = await readHead(reader)
+            chunks = readChunks(reader) if headers.get('transfer-encoding', '').lower() == 'chunked' else rawChunks(reader)
+            pending = b''
+            async for chunk in chunks:
+                pending += chunk
+                arrivalTime = time.perf_counter()
+                *events, pending = pending.split(b'\n\n')
+                for event in events:
+                    fields = dict(line.split(b': ', 1) for line in event.split(b'\n') if b': ' in line)
+                    if fields.get(b'event') == b'snapshot':
+                        if json.loads(fields[b'data'])['state']['hat'] is not None:
+                            self.hatsSeen += 1
+                        ready.set()
+                    elif fields.get(b'event') == b'delta':
+                        deltaCount += 1
+                        sentTime = self.sentTimes.get(int(fields[b'id']))
+                        if sentTime is not None:
+                            self.lags.append(arrivalTime - sentTime)
+                    elif fields.get(b'event') == b'closed':
+                        return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.deltaCounts.append(deltaCount)
+            ready.set()
+            writer.close()
+
+async def play(args):
+    await waitForServer(args.host, args.port)
+    gameId = 'spectate{}'.format(args.seed)
+    teams = [['t0p0', 't0p1', 't0p2'], ['t1p0', 't1p1', 't1p2']]
+    connection = HttpConnection(args.host, args.port, False)
+    await connection.request('POST', '/api/newgame', {'id': gameId, 'teams': teams, 'phrasesPerPlayer': 5,
+                                                      'secondsPerTurn': 200, 'videoURL': 'https://meet.example.com/abc'})
+    for team in teams:
+        for playerId in team:
+            await connection.request('POST', '/games/{}/{}/recordphrases'.format(gameId, playerId),
+                                     {'phrases': ['{} phrase {}'.format(playerId, i) for i in range(5)]})
+
+    spectators = Spectators(args, gameId)
+    tasks = []
+    startTime = time.perf_counter()
+    for idx in range(args.spectators):
+        ready = asyncio.Event()
+        tasks.append(asyncio.ensure_future(spectators.watch(ready)))
+        await ready.wait()
+    print('{} spectator streams open in {:.1f} s'.format(args.spectators, time.perf_counter() - startTime))
+
+    status, body = await connection.request('GET', '/api/gamestate/{}'.format(gameId))
+    version = json.loads(body)['stateVersion']
+    mutationCount = 0
+
+    async def mutate(method, path, body=None):
+        nonlocal version, mutationCount
+        spectators.sentTimes[version + 1] = time.perf_counter()
+        await connection.request(method, path, body)
+        version += 1
+        mutationCount += 1
+        await asyncio.sleep(args.pauseMs / 1000.0)
+
+    startTime = time.perf_counter()
+    for turn in range(args.turns):
+        status, body = await connection.request('GET', '/api/gamestate/{}'.format(gameId))
+        state = json.loads(body)
+        if state['mainPhase'] == 'GameMainPhase.Done':
+            break
+        teamIdx = state['activeTeamIndex']
+        playerId = state['teams'][teamIdx][state['activePlayerIndexPerTeam'][teamIdx]]
+        gamePath = '/games/{}/{}/'.format(gameId, playerId)
+        await mutate('POST', gamePath + 'startturn')
+        status, body = await connection.request('GET', '/api/gamestate/{}?player={}'.format(gameId, playerId))
+        hat = json.loads(body)['hat']
+        for phraseId in hat[:3]:
+            await mutate('POST', '/games/{}/prevphrase/{}'.format(gameId, phraseId))
+        if len(hat) > 3:
+            await mutate('POST', gamePath + 'endturn')
+        await mutate('POST', gamePath + 'confirmphrases', {'acceptedPhrases': hat[:3]})
+    seconds = time.perf_counter() - startTime
+
+    # Give the last delta time to arrive everywhere, then end the streams
+    await asyncio.sleep(1.0)
+    status, body = await connection.request('GET', '/api/stats')
+    stats = json.loads(body)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    connection.close()
+
+    spectators.lags.sort()
+    print('{} mutations in {:.1f} s, server reports {} spectator streams'.format(
+        mutationCount, seconds, stats.get('spectatorStreams')))
+    print('deltas per spectator: min {}, max {}; snapshots with hat contents: {}'.format(
+        min(spectators.deltaCounts), max(spectators.deltaCounts), spectators.hatsSeen))
+    if len(spectators.lags) > 0:
+        print('event lag over {} deliveries: p50 {:.2f} ms, p95 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms'.format(
+            len(spectators.lags), percentile(spectators.lags, 0.5) * 1000.0, percentile(spectators.lags, 0.95) * 1000.0,
+            percentile(spectators.lags, 0.99) * 1000.0, spectators.lags[-1] * 1000.0))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--server', choices=['asgi', 'flask', 'none'], default='asgi',
+                        help='server to start for the test, or none to use one already running')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5210)
+    parser.add_argument('--spectators', type=int, default=1000)
+    parser.add_argument('--turns', type=int, default=8)
+    parser.add_argument('--pauseMs', type=float, default=50.0, help='pause after each mutation')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    gameLog.configure(level=gameLog.parseLevel('OFF'))
+    inProcess(args.spectators, 20)
+    server = None if args.server == 'none' else startServer(args)
+    try:
+        asyncio.run(play(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
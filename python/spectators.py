@@ -0,0 +1,124 @@
+import threading
+import time
+from dataclasses import dataclass
+
+from python.gameSession import formatEvent, recentEventCount
+from python.stateDelta import makePatch
+from python import fastJson
+
+@dataclass(frozen=True, slots=True)
+class SpectatorView:
+    """The public projection of one published version (see publicStateDict in
+    python/gameSession.py), with the delta events of the versions before it. Events are
+    UTF-8 bytes, built once and sent as they are to every spectator. A feed only builds a
+    view for the versions it is woken for, so each delta names the version it applies to."""
+    version: int
+    state: dict
+    serialized: bytes # the state as JSON, with stateVersion
+    events: tuple # (baseVersion, version, delta event bytes), oldest first
+
+class SpectatorFeed:
+    """Every spectator of one game. The feed is the game's only refresh listener on their
+    behalf, and stands in for the game in the event stream code: spectators subscribe to it,
+    and it hands them the same pre-serialized events, so a refresh costs one projection and
+    one delta however many are watching. Its stream methods take a playerId, as a
+    GameSession's do, which is always None here."""
+    __slots__ = ('game', 'id', 'lock', 'view', 'listeners')
+
+    def __init__(self, game):
+        self.game = game
+        self.id = game.id
+        self.lock = threading.Lock()
+        self.view = None
+        self.listeners = () # replaced, never changed, so refresh iterates it without the lock
+
+    @property
+    def closed(self):
+        return self.game.closed
+
+    def getPublishedState(self):
+        # The view of the game's newest version. The first spectator to ask after a change
+        # builds it under the feed lock; everyone else reuses it.
+        published = self.game.getPublishedState()
+        view = self.view
+        if view is not None and view.version >= published.version:
+            return view
+        with self.lock:
+            view = self.view
+            if view is None or view.version < published.version:
+                view = self.buildView(view, published)
+                self.view = view
+            return view
+
+    def buildView(self, previous, published):
+        state = published.getState('public')
+        events = ()
+        if previous is not None:
+            delta = {
+                'version': published.version,
+                'baseVersion': previous.version,
+                'patch': makePatch(previous.state, state)
+            }
+            event = (previous.version, published.version,
+                     formatEvent('delta', published.version, fastJson.dumpsText(delta)).encode('utf-8'))
+            events = previous.events[-(recentEventCount - 1):] + (event,)
+        return SpectatorView(published.version, state, published.getSerialized('public'), events)
+
+    def getSnapshotEvent(self, playerId=None):
+        # The state bytes are shared; only the server time is added per spectator
+        view = self.getPublishedState()
+        head = 'id: {}\nevent: snapshot\ndata: {{"version":{},"serverTime":{},"state":'.format(
+            view.version, view.version, time.time())
+        return view.version, head.encode('utf-8') + view.serialized + b'}\n\n'
+
+    def getEventsSince(self, version, playerId=None):
+        # As GameSession.getEventsSince, for a spectator whose last event was version
+        view = self.getPublishedState()
+        if version >= view.version:
+            return []
+        # Searched from the newest, where a spectator that is keeping up finds its event
+        events = view.events
+        for idx in range(len(events) - 1, -1, -1):
+            if events[idx][0] == version:
+                return [(eventVersion, body) for baseVersion, eventVersion, body in events[idx:]]
+        return None
+
+    def getCatchUpEvents(self, version, playerId=None):
+        events = self.getEventsSince(version)
+        if events is None:
+            newVersion, snapshot = self.getSnapshotEvent()
+            return newVersion, [snapshot]
+        if len(events) == 0:
+            return version, []
+        return events[-1][0], [body for eventVersion, body in events]
+
+    def addRefreshListener(self, listener):
+        with self.lock:
+            if len(self.listeners) == 0:
+                self.game.addRefreshListener(self.refresh)
+            self.listeners += (listener,)
+
+    def removeRefreshListener(self, listener):
+        with self.lock:
+            if listener not in self.listeners:
+                return
+            self.listeners = tuple(other for other in self.listeners if other is not listener)
+            if len(self.listeners) == 0:
+                self.game.removeRefreshListener(self.refresh)
+
+    def refresh(self):
+        # Called by the notification bus; only hands the wakeup on, as bus listeners must
+        for listener in self.listeners:
+            listener()
+
+feedLock = threading.Lock()
+
+def getSpectatorFeed(game):
+    # A game's feed is made by its first spectator and kept with the game
+    feed = game.spectatorFeed
+    if feed is None:
+        with feedLock:
+            if game.spectatorFeed is None:
+                game.spectatorFeed = SpectatorFeed(game)
+            feed = game.spectatorFeed
+    return feed
@@ -0,0 +1,43 @@
+
+# JSON-patch style (RFC 6902 subset) diffs between two state dicts. Dicts are diffed key by
+# key; any other value that changed, including lists, is replaced whole.
+
+def escapePathToken(key):
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+def makePatch(oldValue, newValue, path=''):
+    patch = []
+    if isinstance(oldValue, dict) and isinstance(newValue, dict):
+        for key, value in newValue.items():
+            keyPath = path + '/' + escapePathToken(key)
+            if key not in oldValue:
+                patch.append({'op': 'add', 'path': keyPath, 'value': value})
+            else:
+                patch.extend(makePatch(oldValue[key], value, keyPath))
+        for key in oldValue:
+            if key not in newValue:
+                patch.append({'op': 'remove', 'path': path + '/' + escapePathToken(key)})
+    elif oldValue != newValue:
+        patch.append({'op': 'replace', 'path': path, 'value': newValue})
+    return patch
+
+def unescapePathToken(token):
+    return token.replace('~1', '/').replace('~0', '~')
+
+def applyPatch(value, patch):
+    # Returns value with a patch from makePatch applied; value itself is not changed
+    for operation in patch:
+        tokens = [unescapePathToken(token) for token in operation['path'].split('/')[1:]]
+        if len(tokens) == 0:
+            value = operation['value']
+            continue
+        value = dict(value)
+        parent = value
+        for token in tokens[:-1]:
+            parent[token] = dict(parent[token])
+            parent = parent[token]
+        if operation['op'] == 'remove':
+            del parent[tokens[-1]]
+        else:
+            parent[tokens[-1]] = operation['value']
+    return value
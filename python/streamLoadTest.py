@@ -0,0 +1,96 @@
+
+# Opens as many event-stream connections as a server will hold and reports how many it
+# accepted, plus the server's thread count when its pid is given. Compare:
+#
+#   python flaskServer.py                  (one thread per stream; with debug on, pass the
+#                                           pid of the reloader's child process)
+#   python asgiServer.py                   (one coroutine per stream)
+#   python python/streamLoadTest.py --connections 5000 --pid <server pid>
+
+import argparse
+import asyncio
+import time
+
+def readThreadCount(pid):
+    try:
+        with open('/proc/{}/status'.format(pid)) as file:
+            for line in file:
+                if line.startswith('Threads:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def readResidentKB(pid):
+    try:
+        with open('/proc/{}/status'.format(pid)) as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+async def openStream(host, port, path, timeout):
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    request = 'GET {} HTTP/1.1\r\nHost: {}\r\nAccept: text/event-stream\r\n\r\n'.format(path, host)
+    writer.write(request.encode('ascii'))
+    await writer.drain()
+    # The threaded Flask server only sends headers along with the first event, so a stream
+    # that is still open when the timeout hits counts as held
+    try:
+        statusLine = await asyncio.wait_for(reader.readline(), timeout)
+    except asyncio.TimeoutError:
+        return reader, writer, False
+    if b' 200 ' not in statusLine:
+        writer.close()
+        raise ConnectionError(statusLine)
+    return reader, writer, True
+
+async def run(args):
+    path = '/api/stream/{}/{}/events'.format(args.game, args.player)
+    streams = []
+    headersReceived = 0
+    failures = 0
+    startTime = time.time()
+    for batchStart in range(0, args.connections, args.batch):
+        batchSize = min(args.batch, args.connections - batchStart)
+        results = await asyncio.gather(
+            *[openStream(args.host, args.port, path, args.timeout) for i in range(batchSize)],
+            return_exceptions=True)
+        for result in results:
+            if isinstance(result, tuple):
+                streams.append(result)
+                if result[2]:
+                    headersReceived += 1
+            else:
+                failures += 1
+        if failures > 0 and args.stopOnFailure:
+            break
+    elapsed = time.time() - startTime
+
+    print('connections held:', len(streams))
+    print('connections with headers:', headersReceived)
+    print('connections failed:', failures)
+    print('seconds to open:', round(elapsed, 2))
+    if args.pid is not None:
+        print('server threads:', readThreadCount(args.pid))
+        print('server RSS (KB):', readResidentKB(args.pid))
+
+    await asyncio.sleep(args.hold)
+    for reader, writer, gotHeaders in streams:
+        writer.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--game', default='debug_write_phase')
+    parser.add_argument('--player', default='peter')
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--batch', type=int, default=100)
+    parser.add_argument('--timeout', type=float, default=2.0)
+    parser.add_argument('--hold', type=float, default=1.0, help='seconds to keep the streams open after reporting')
+    parser.add_argument('--pid', type=int, default=None, help='server process id, for thread and memory counts')
+    parser.add_argument('--stopOnFailure', action='store_true')
+    asyncio.run(run(parser.parse_args()))
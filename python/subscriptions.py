@@ -0,0 +1,107 @@
+import itertools
+import os
+import threading
+import time
+
+# Event streams send a comment line this often when nothing else has been sent, so a
+# connection whose client has gone away fails on the write and is closed
+defaultHeartbeatSeconds = float(os.environ.get('HATGAME_HEARTBEAT_SECONDS', '15'))
+heartbeatComment = ': heartbeat\n\n'
+
+class Subscription:
+    """One event-stream connection. wake is called from any thread when the game changes;
+    each stream supplies its own, feeding its own one-slot queue, so two streams for the
+    same player never take each other's wakeups."""
+    __slots__ = ('id', 'gameId', 'playerId', 'wake', 'openedTime', 'lastSendTime', 'sentCount')
+
+    def __init__(self, subscriptionId, gameId, playerId, wake):
+        self.id = subscriptionId
+        self.gameId = gameId
+        self.playerId = playerId
+        self.wake = wake
+        self.openedTime = time.time()
+        self.lastSendTime = self.openedTime
+        self.sentCount = 0
+
+    def markSent(self):
+        self.lastSendTime = time.time()
+        self.sentCount += 1
+
+class SubscriptionManager:
+    """Every open event stream, by ID. A stream ends in one of three ways, each counted:
+    the game closed ('closed'), the client went away and a write or disconnect showed it
+    ('reaped'), or the server shut the stream down. Streams that have sent nothing, not even
+    a heartbeat, for several heartbeat intervals should already have been reaped; they are
+    reported as leaked."""
+    def __init__(self, heartbeatSeconds=defaultHeartbeatSeconds):
+        self.heartbeatSeconds = heartbeatSeconds
+        self.lock = threading.Lock()
+        self.subscriptionsById = {}
+        self.ids = itertools.count(1)
+        self.closedCount = 0
+        self.reapedCount = 0
+
+    def subscribe(self, game, playerId, wake):
+        # Registers the stream for the game's refreshes; call unsubscribe when it ends. For a
+        # spectator, game is the game's SpectatorFeed and playerId is None.
+        with self.lock:
+            subscription = Subscription(next(self.ids), game.id, playerId, wake)
+            self.subscriptionsById[subscription.id] = subscription
+        game.addRefreshListener(wake)
+        return subscription
+
+    def unsubscribe(self, game, subscription, reason):
+        # reason is 'closed', 'reaped' or None for any other end
+        game.removeRefreshListener(subscription.wake)
+        with self.lock:
+            if self.subscriptionsById.pop(subscription.id, None) is None:
+                return
+            if reason == 'closed':
+                self.closedCount += 1
+            elif reason == 'reaped':
+                self.reapedCount += 1
+
+    def leakedCount(self):
+        cutoff = time.time() - 3 * self.heartbeatSeconds
+        with self.lock:
+            return sum(1 for subscription in self.subscriptionsById.values() if subscription.lastSendTime < cutoff)
+
+    def getStats(self):
+        with self.lock:
+            live = len(self.subscriptionsById)
+            spectators = sum(1 for subscription in self.subscriptionsById.values() if subscription.playerId is None)
+            closed = self.closedCount
+            reaped = self.reapedCount
+        return {'live': live, 'spectators': spectators, 'closed': closed, 'reaped': reaped, 'leaked': self.leakedCount()}
+
+def parseLastEventId(value):
+    # The version in a reconnecting EventSource's Last-Event-ID header, or None
+    if value is None:
+        return None
+    try:
+        version = int(value)
+    except ValueError:
+        return None
+    return version if version >= 0 else None
+
+def startEvents(game, lastEventId, playerId):
+    # Returns the version a new stream starts at and the events to send it first: only what
+    # it missed when it is resuming from a version the game still has deltas for, else a
+    # snapshot
+    if lastEventId is not None and lastEventId <= game.getPublishedState().version:
+        events = game.getEventsSince(lastEventId, playerId)
+        if events is not None:
+            if len(events) == 0:
+                return lastEventId, []
+            return events[-1][0], [text for eventVersion, text in events]
+    version, snapshot = game.getSnapshotEvent(playerId)
+    return version, [snapshot]
+
+def joinEvents(events):
+    # Game events are str and spectator events bytes; a lone event is sent as it is, so every
+    # spectator is handed the same bytes object
+    if len(events) == 1:
+        return events[0]
+    return events[0][:0].join(events)
+
+subscriptions = SubscriptionManager()
@@ -0,0 +1,66 @@
+
+# Measures how accurately the server ends turns on time. Starts a turn in each of many
+# games, with deadlines spread over a few seconds, and records how late after its
+# deadline each turn's refresh arrives.
+#
+#   python python/turnTimerBenchmark.py --games 10000
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from python.gameSession import GameSession, GameSubPhase
+from python.refreshCoalescer import refreshCoalescer
+
+def makeStartedGame(gameId, turnSeconds):
+    game = GameSession(gameId, [['a', 'b'], ['c', 'd']], 2, 60, 'http://video')
+    game.showLog = False
+    for playerID in game.playersByID:
+        game.recordPlayerPhrases(playerID, [playerID + ' one', playerID + ' two'])
+    game.secondsPerTurn = turnSeconds
+    return game
+
+def run(args):
+    random.seed(args.seed)
+    refreshCoalescer.windowSeconds = 0.0
+    games = [makeStartedGame('game{}'.format(i), random.uniform(args.minSeconds, args.maxSeconds))
+             for i in range(args.games)]
+
+    lateness = []
+    lock = threading.Lock()
+    allEnded = threading.Event()
+    def makeListener(game, deadline):
+        def listener():
+            if game.subPhase == GameSubPhase.ConfirmingPhrases:
+                with lock:
+                    lateness.append(time.time() - deadline)
+                    if len(lateness) == len(games):
+                        allEnded.set()
+        return listener
+
+    startTime = time.perf_counter()
+    for game in games:
+        game.startPlayerTurn(game.activePlayer().id)
+        game.addRefreshListener(makeListener(game, game.turnEndTime()))
+    scheduleSeconds = time.perf_counter() - startTime
+
+    allEnded.wait(args.maxSeconds + 30.0)
+    lateness.sort()
+    print('turns:', len(games), 'ended:', len(lateness))
+    print('start + schedule: {:.1f} us per turn'.format(scheduleSeconds * 1e6 / len(games)))
+    print('lateness median {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms'.format(
+        lateness[len(lateness) // 2] * 1000.0,
+        lateness[int(len(lateness) * 0.99)] * 1000.0,
+        lateness[-1] * 1000.0))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--games', type=int, default=10000)
+    parser.add_argument('--minSeconds', type=float, default=3.0)
+    parser.add_argument('--maxSeconds', type=float, default=8.0)
+    parser.add_argument('--seed', type=int, default=0)
+    run(parser.parse_args())
@@ -0,0 +1,97 @@
+import array
+import mmap
+import os
+import random
+
+# Word lists are text files with one word or phrase per line. A line of the form
+# "[category]" starts a category, which runs until the next one; words before the first
+# category header are in no category. Blank lines and repeated words are skipped.
+
+class WordList:
+    """A word list file mapped into memory, with the byte offsets of each word in two
+    arrays. Sampling picks indexes and only decodes the words it returns, so the list costs
+    8 bytes per word on top of the file's pages, which the OS can share and drop."""
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.starts = array.array('I')
+        self.ends = array.array('I')
+        self.categories = {} # category name -> (first index, index after the last)
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                self.data = b''
+            else:
+                self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index()
+
+    def index(self):
+        data = self.data
+        seen = set() # only kept while loading
+        category = None
+        categoryStart = 0
+        pos = 0
+        while pos < len(data):
+            end = data.find(b'\n', pos)
+            if end < 0:
+                end = len(data)
+            rawLine = data[pos:end]
+            line = rawLine.strip()
+            if line.startswith(b'[') and line.endswith(b']'):
+                if category is not None:
+                    self.categories[category] = (categoryStart, len(self.starts))
+                category = line[1:-1].strip().decode('utf-8').lower()
+                categoryStart = len(self.starts)
+            elif len(line) > 0 and (category, line) not in seen:
+                seen.add((category, line))
+                # Keep the stripped bounds so reading a word is a single slice
+                start = pos + len(rawLine) - len(rawLine.lstrip())
+                self.starts.append(start)
+                self.ends.append(start + len(line))
+            pos = end + 1
+        if category is not None:
+            self.categories[category] = (categoryStart, len(self.starts))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def word(self, idx):
+        return self.data[self.starts[idx]:self.ends[idx]].decode('utf-8')
+
+    def sample(self, count, category=None, rng=random):
+        # Returns up to count distinct words, from one category if given
+        if category is None:
+            first, last = 0, len(self.starts)
+        else:
+            first, last = self.categories[category.lower()]
+        # random.sample on a range picks indexes without building the range
+        indexes = rng.sample(range(first, last), min(count, last - first))
+        return [self.word(idx) for idx in indexes]
+
+class WordBank:
+    """Named word lists, loaded when the server starts. Lists are named after their file,
+    e.g. wordListA.txt is 'wordListA'; the first one loaded is the default."""
+    def __init__(self):
+        self.lists = {}
+        self.defaultName = None
+
+    def load(self, path, name=None):
+        if name is None:
+            name = os.path.splitext(os.path.basename(path))[0]
+        wordList = WordList(name, path)
+        self.lists[name] = wordList
+        if self.defaultName is None:
+            self.defaultName = name
+        return wordList
+
+    def get(self, name=None):
+        # Raises KeyError for a list that was not loaded
+        return self.lists[self.defaultName if name is None else name]
+
+    def sample(self, count, listName=None, category=None, rng=random):
+        return self.get(listName).sample(count, category, rng)
+
+    def describe(self):
+        return [{'name': wordList.name, 'wordCount': len(wordList), 'categories': sorted(wordList.categories)}
+                for wordList in self.lists.values()]
+
+wordBank = WordBank()
@@ -0,0 +1,83 @@
+
+# Runs the hat game as several worker processes behind a router, so one Python process is
+# no longer the throughput ceiling. Each worker is asgiServer.py on its own Unix socket and
+# owns the games whose ID hashes to it (see python/shardRouter.py); a game's state,
+# streams and journal never leave its worker.
+#
+#   python shardedServer.py --workers 4
+#
+# With HATGAME_DATA_DIR set, worker i journals to HATGAME_DATA_DIR/shard-i. The worker
+# count decides which shard owns a game, so keep it fixed for a given data directory.
+#
+# The router process also runs the notification broker, and every worker publishes game
+# changes through it (HATGAME_BUS_SOCKET), so a change made in one worker wakes event
+# streams held by any other.
+
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from python.shardRouter import ShardRouter
+from python.notificationBus import NotificationBroker
+
+def workerSocketPath(socketDir, workerIdx):
+    return os.path.join(socketDir, 'hatgame-worker-{}.sock'.format(workerIdx))
+
+def startWorkers(workerCount, socketDir, busSocketPath):
+    rootDir = os.path.dirname(os.path.abspath(__file__))
+    workers = []
+    for workerIdx in range(workerCount):
+        socketPath = workerSocketPath(socketDir, workerIdx)
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+        env = dict(os.environ)
+        env['HATGAME_BUS_SOCKET'] = busSocketPath
+        if 'HATGAME_DATA_DIR' in os.environ:
+            env['HATGAME_DATA_DIR'] = os.path.join(os.environ['HATGAME_DATA_DIR'], 'shard-{}'.format(workerIdx))
+        workers.append(subprocess.Popen([sys.executable, '-m', 'uvicorn', 'asgiServer:asgiApp',
+                                         '--uds', socketPath, '--log-level', 'warning'],
+                                        cwd=rootDir, env=env))
+    return workers
+
+async def waitForWorkers(socketPaths, timeoutSeconds=60.0):
+    deadline = time.time() + timeoutSeconds
+    for socketPath in socketPaths:
+        while not os.path.exists(socketPath):
+            if time.time() > deadline:
+                raise RuntimeError('worker did not start: ' + socketPath)
+            await asyncio.sleep(0.1)
+
+async def serve(args, workers):
+    # The broker is listening before the workers start, so they connect on the first try
+    busSocketPath = os.path.join(args.socketDir, 'hatgame-bus.sock')
+    await NotificationBroker(busSocketPath).start()
+    workers.extend(startWorkers(args.workers, args.socketDir, busSocketPath))
+    socketPaths = [workerSocketPath(args.socketDir, workerIdx) for workerIdx in range(args.workers)]
+    await waitForWorkers(socketPaths)
+    print('routing http://{}:{} to {} workers'.format(args.host, args.port, args.workers))
+    await ShardRouter(socketPaths).serve(args.host, args.port)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--socketDir', default='/tmp')
+    args = parser.parse_args()
+
+    # Stop the workers along with the router on a plain kill too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    workers = []
+    try:
+        asyncio.run(serve(args, workers))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait()
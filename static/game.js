@@ -165,20 +165,20 @@ class PhraseListCreator extends React.Component {
 
 // Used to display the two words the current player is getting others to guess
 // props:
-//   words - the words to display
-//   onWordClicked -  function that takes a word, to be called when a word is clicked
+//   words - the words to display, as a list of {id, text} objects
+//   onWordClicked -  function that takes a word ID, to be called when a word is clicked
 function ClickableWordDisplay(props) {
   return e(
     'div',
     null, 
     props.words.map(word => (
       e('div',
-	{key: word},
+	{key: word.id},
 	e('button',
           {className: "word_being_guessed",
-           onClick: () => props.onWordClicked(word)
+           onClick: () => props.onWordClicked(word.id)
           },
-          word
+          word.text
 	 )
        )
     ))
@@ -189,7 +189,7 @@ function ClickableWordDisplay(props) {
 class CountdownTimer extends React.Component {
   // props:
   // -- initialSeconds - number of seconds to count down from
-  // -- timerExpirationCallback -- function to call when timer is done
+  // The server ends the turn when time runs out; this only displays the countdown.
   constructor(props) {
     super(props);
     this.state = {
@@ -209,13 +209,9 @@ class CountdownTimer extends React.Component {
   }
 
   decrementSecondsRemaining() {
-    if (this.state.secondsRemaining < 1.0) {
-      this.props.timerExpirationCallback();
-    } else {
-      this.setState((state, props) => ({
-        secondsRemaining: state.secondsRemaining - 1
-      }))
-    }
+    this.setState((state, props) => ({
+      secondsRemaining: Math.max(0, state.secondsRemaining - 1)
+    }))
   }
   
   render() {
@@ -230,9 +226,9 @@ class CountdownTimer extends React.Component {
 // Lets the current player confirm the list of words they got
 class WordListConfirmer extends React.Component {
   // props:
-  //   wordsDefaultingToChecked - default checked list of words to confirm
-  //   wordsDefaultingToUnchecked - default checked list of words to confirm
-  //   callbackAfterConfirmation - function that takes confirmedWords
+  //   wordsDefaultingToChecked - default checked list of words to confirm, as {id, text} objects
+  //   wordsDefaultingToUnchecked - default checked list of words to confirm, as {id, text} objects
+  //   callbackAfterConfirmation - function that takes the confirmed word IDs
   constructor(props) {
     super(props);
     this.words = props.wordsDefaultingToChecked.concat(props.wordsDefaultingToUnchecked);
@@ -248,7 +244,7 @@ class WordListConfirmer extends React.Component {
       (word, i) => {
         const checkbox = this.wordCheckboxRefs[i].current;
         if (checkbox.checked) {
-          confirmedWords.push(word);
+          confirmedWords.push(word.id);
         }
       }
     );
@@ -264,18 +260,18 @@ class WordListConfirmer extends React.Component {
       this.words.map(
         (word, i) =>
           e('div',
-            { key: word },
+            { key: word.id },
             e('input',
               {
                 type: "checkbox",
                 defaultChecked: (i < countDefaultingChecked),
                 ref: this.wordCheckboxRefs[i],
-                id: "checkbox " + word
+                id: "checkbox " + word.id
               }
             ),
             e('label',
-              {htmlFor: "checkbox " + word},
-              word)
+              {htmlFor: "checkbox " + word.id},
+              word.text)
           )
       ),
       e('button',
@@ -285,6 +281,28 @@ class WordListConfirmer extends React.Component {
   }
 }
 
+// Applies a JSON-patch style list of operations (add/replace/remove) from the server to a
+// copy of state, and returns the copy
+function applyStatePatch(state, patch) {
+  let result = JSON.parse(JSON.stringify(state));
+  patch.forEach(operation => {
+    if (operation.path == '') {
+      result = operation.value;
+      return;
+    }
+    const keys = operation.path.split('/').slice(1).map(
+      key => key.replace(/~1/g, '/').replace(/~0/g, '~'));
+    const lastKey = keys.pop();
+    const parent = keys.reduce((value, key) => value[key], result);
+    if (operation.op == 'remove') {
+      delete parent[lastKey];
+    } else {
+      parent[lastKey] = operation.value;
+    }
+  });
+  return result;
+}
+
 // Main game
 class HatGameApp extends React.Component {
   // props:
@@ -297,32 +315,173 @@ class HatGameApp extends React.Component {
       mainPhase: 'Loading',
       showScores: false, // tracked on client
       showHostControls: false, // tracked on client
+      phraseTexts: [], // phrase text by phrase ID, loaded once writing is over
     }
+    // The last state received from the server and its version, used to apply deltas
+    this.serverState = null;
+    this.stateVersion = 0;
+    // The open game socket, if the server has one; see startListeningForServerUpdates
+    this.socket = null;
+    this.actionCount = 0;
+    this.gameClosed = false;
+    // Server clock minus local clock, in seconds, so turn end times from the server can be
+    // turned into a local countdown
+    this.serverClockOffset = 0;
     console.log("Constructing HatGameApp with props %o", props)
   }
 
   componentDidMount() {
-    this.getStateFromServer();
+    // The stream starts with a full snapshot, so no initial fetch is needed
     this.startListeningForServerUpdates();
   }
 
   getStateFromServer() {
-    fetch('../../../api/gamestate/' + this.props.gameId)
-			.then(response => response.json())
+    fetch('../../../api/gamestate/' + this.props.gameId + '?player=' + encodeURIComponent(this.props.player))
+			.then(response => {
+        this.setServerTime(parseFloat(response.headers.get('X-Server-Time')));
+        return response.json();
+      })
 			.then(data => {
         console.log("got state from server %o", data);
-        // Merge this.state with the server state, to preserve the local-only state
-				this.setState((state, props) => ({...this.state, ...data}));
+        this.receiveServerState(data.stateVersion, data);
+			});
+  }
+
+  setServerTime(serverTime) {
+    if (!isNaN(serverTime)) {
+      this.serverClockOffset = serverTime - Date.now() / 1000;
+    }
+  }
+
+  // force is set for stream snapshots, which are always current even when the server has
+  // restarted and its version numbers went backwards
+  receiveServerState(version, serverState, force) {
+    if (version < this.stateVersion && !force) {
+      return; // the stream already delivered something newer
+    }
+    this.stateVersion = version;
+    this.serverState = serverState;
+    // Merge this.state with the server state, to preserve the local-only state
+    this.setState((state, props) => ({...state, ...serverState}));
+    if (serverState.phraseTableSize > this.state.phraseTexts.length && !this.loadingPhraseTexts) {
+      this.getPhraseTextsFromServer();
+    }
+  }
+
+  // The server refers to phrases by ID; their text is fetched once per game
+  getPhraseTextsFromServer() {
+    this.loadingPhraseTexts = true;
+    fetch('../../../api/phrases/' + this.props.gameId)
+			.then(response => response.json())
+			.then(data => {
+        console.log("got %o phrases from server", data.phrases.length);
+        this.loadingPhraseTexts = false;
+        this.setState({phraseTexts: data.phrases});
 			});
   }
 
+  phraseText(phraseId) {
+    const text = this.state.phraseTexts[phraseId];
+    return (typeof text == 'undefined') ? '' : text;
+  }
+
+  phraseObjects(phraseIds) {
+    return phraseIds.map(phraseId => ({id: phraseId, text: this.phraseText(phraseId)}));
+  }
+
+  // The game socket carries the state events and this player's in-turn actions over one
+  // connection. Servers without one (flaskServer.py) refuse it, and then the event stream
+  // and HTTP POSTs are used instead, as they are if an open socket is lost.
   startListeningForServerUpdates() {
+    if (!window.WebSocket) {
+      this.startEventStream();
+      return;
+    }
+    const scheme = window.location.protocol == 'https:' ? 'wss:' : 'ws:';
+    const socket = new WebSocket(`${scheme}//${window.location.host}/api/socket/${this.props.gameId}/${this.props.player}`);
+    let opened = false;
+    socket.onopen = () => {
+      opened = true;
+      this.socket = socket;
+    };
+    socket.onmessage = event => this.receiveSocketEvents(event.data);
+    socket.onclose = () => {
+      this.socket = null;
+      if (!this.gameClosed) {
+        console.log(opened ? 'Game socket closed, using the event stream' : 'No game socket, using the event stream');
+        this.startEventStream();
+      }
+    };
+  }
+
+  startEventStream() {
     var source = new EventSource(`/api/stream/${this.props.gameId}/${this.props.player}/events`);
-    source.onmessage = (event => {
-      console.log("Server told client to update.  Loading state from server.");
-      this.getStateFromServer();
+    source.addEventListener('snapshot', event => this.receiveSnapshot(event.data));
+    source.addEventListener('closed', event => {
+      source.close();
+      this.receiveClosed();
+    });
+    source.addEventListener('delta', event => this.receiveDelta(event.data));
+  }
+
+  // Socket messages are in event stream format: one or more events, each a block of
+  // "field: value" lines; comment lines, the heartbeats, start with ':'
+  receiveSocketEvents(text) {
+    text.split('\n\n').forEach(block => {
+      let eventType = null;
+      let data = null;
+      block.split('\n').forEach(line => {
+        if (line.startsWith('event: ')) {
+          eventType = line.slice(7);
+        } else if (line.startsWith('data: ')) {
+          data = line.slice(6);
+        }
       });
+      if (eventType == 'snapshot') {
+        this.receiveSnapshot(data);
+      } else if (eventType == 'delta') {
+        this.receiveDelta(data);
+      } else if (eventType == 'closed') {
+        this.receiveClosed();
+      } else if (eventType == 'reply') {
+        console.log(`server response: ${data}`);
+      }
+    });
+  }
+
+  receiveSnapshot(data) {
+    const message = JSON.parse(data);
+    console.log("Got state snapshot %o", message);
+    this.setServerTime(message.serverTime);
+    this.receiveServerState(message.version, message.state, true);
+  }
+
+  receiveDelta(data) {
+    const message = JSON.parse(data);
+    if (message.baseVersion != this.stateVersion) {
+      if (message.version > this.stateVersion) {
+        console.log(`Missed state versions ${this.stateVersion} to ${message.baseVersion}.  Loading state from server.`);
+        this.getStateFromServer();
+      }
+      return;
+    }
+    this.receiveServerState(message.version, applyStatePatch(this.serverState, message.patch));
+  }
+
+  receiveClosed() {
+    console.log("Server closed this game");
+    this.gameClosed = true;
+    this.setState({mainPhase: 'Closed'});
+  }
+
+  // In-turn actions go over the game socket when it is open, else to their HTTP routes
+  sendAction(action, params, endpoint, data) {
+    if (this.socket && this.socket.readyState == WebSocket.OPEN) {
+      this.socket.send(JSON.stringify({id: ++this.actionCount, action: action, ...params}));
+    } else {
+      this.postData(endpoint, data);
     }
+  }
 
     handlePhrasesCreation(phrases) {
       console.log("telling server we created phrases %o", phrases);
@@ -333,27 +492,17 @@ class HatGameApp extends React.Component {
   
     handleTurnStart() {
     const endpoint = `/games/${this.props.gameId}/${this.props.player}/startturn`;
-    this.postData(endpoint, null);
+    this.sendAction('startturn', {}, endpoint, null);
   }
   
-  onWordClicked(word) {
-    const endpoint = `/games/${this.props.gameId}/prevphrase/${word}`;
-    this.postData(endpoint, null);
-  }
-
-  endTurn() {
-    const endpoint = `/games/${this.props.gameId}/${this.props.player}/endturn`;
-    this.postData(endpoint, null);
-  }
-
-  handleTimerExpiration() {
-    console.log("Turn ended due to timer");
-    this.endTurn();
+  onWordClicked(phraseId) {
+    const endpoint = `/games/${this.props.gameId}/prevphrase/${phraseId}`;
+    this.sendAction('prevphrase', {phraseId: phraseId}, endpoint, null);
   }
 
   handlePhraseConfirmation(phrases) {
     console.log("telling server we confirmed words %o", phrases);
-    this.postData(
+    this.sendAction('confirmphrases', {acceptedPhrases: phrases},
       `/games/${this.props.gameId}/${this.props.player}/confirmphrases`,
     {acceptedPhrases: phrases});
   }
@@ -391,6 +540,15 @@ class HatGameApp extends React.Component {
     return activeTeam[relevantIndex];
   }
 
+  // Seconds left in the running turn, or the length of the next turn while waiting for it
+  secondsRemaining() {
+    if (this.state.subPhase == 'GameSubPhase.Started') {
+      const serverNow = Date.now() / 1000 + this.serverClockOffset;
+      return Math.max(0, this.state.turnEndTime - serverNow);
+    }
+    return this.state.turnSeconds;
+  }
+
   isItMyTurn() {
     return this.props.player == this.activePlayer();
   }
@@ -435,10 +593,10 @@ class HatGameApp extends React.Component {
   }
 
   messageAboutContinuationTurn() {
-    console.log('seconds: %o %o', this.state.secondsRemaining, this.state.secondsPerTurn);
-    if (this.state.secondsRemaining < this.state.secondsPerTurn) {
+    console.log('seconds: %o %o', this.state.turnSeconds, this.state.secondsPerTurn);
+    if (this.state.turnSeconds < this.state.secondsPerTurn) {
       return `${this.activePlayer()} gets to continue their turn with ` + 
-      `${Math.round(this.state.secondsRemaining)} seconds remaining`
+      `${Math.round(this.state.turnSeconds)} seconds remaining`
     } else {
       return undefined // empty element
     }
@@ -451,8 +609,8 @@ class HatGameApp extends React.Component {
         'Phrases gotten in previous turn:',
         e('ul',
           null,
-          this.state.previousRoundPhrases.map(phrase =>
-            e('li', { key: phrase }, phrase)
+          this.state.previousRoundPhrases.map(phraseId =>
+            e('li', { key: phraseId }, this.phraseText(phraseId))
           )
         ),
         this.messageAboutContinuationTurn()
@@ -499,13 +657,12 @@ class HatGameApp extends React.Component {
         null,
         e(CountdownTimer,
           {
-            initialSeconds: this.state.secondsRemaining,
-            timerExpirationCallback: this.handleTimerExpiration.bind(this)
+            initialSeconds: this.secondsRemaining()
           }
         ),
         e(ClickableWordDisplay,
           {
-            words: wordsToRender,
+            words: this.phraseObjects(wordsToRender),
             onWordClicked: this.onWordClicked.bind(this)
           }
         )
@@ -514,13 +671,12 @@ class HatGameApp extends React.Component {
       return e('div', null,
         e(CountdownTimer,
           {
-            initialSeconds: this.state.secondsRemaining,
-            timerExpirationCallback: () => {} // It's not our turn, so do nothing on turn end
+            initialSeconds: this.secondsRemaining()
           }
         ),
-        this.state.prevPhrase ? e('div',
+        this.state.prevPhrase !== null ? e('div',
          {className: 'previous_phrase'},
-         this.state.prevPhrase
+         this.phraseText(this.state.prevPhrase)
         )
         : undefined // empty element if no previous phrase
       );
@@ -531,8 +687,8 @@ class HatGameApp extends React.Component {
     if (this.isItMyTurn()) {
       return e(WordListConfirmer,
         {
-          wordsDefaultingToChecked: this.state.clickedPhrases,
-          wordsDefaultingToUnchecked: this.unclickedHatWords().slice(0, 2),
+          wordsDefaultingToChecked: this.phraseObjects(this.state.clickedPhrases),
+          wordsDefaultingToUnchecked: this.phraseObjects(this.unclickedHatWords().slice(0, 2)),
           callbackAfterConfirmation: this.handlePhraseConfirmation.bind(this),
         }
       )
@@ -583,6 +739,12 @@ class HatGameApp extends React.Component {
           { className: "game_done_text" },
           'Thanks for playing!'
         );
+      case 'Closed':
+        return e(
+          'div',
+          { className: "game_done_text" },
+          'This game is no longer available.'
+        );
       default:
         return e(
           'div', null,
@@ -597,8 +759,9 @@ class HatGameApp extends React.Component {
   }
 
   hatSizeMessage() {
-    if (this.state.hat && this.state.teams) {
-      const countInHat = this.state.hat.length;
+    // Only the player whose turn it is is sent the hat itself
+    if (this.state.hatSize != null && this.state.teams) {
+      const countInHat = this.state.hatSize;
       return `Words in hat: ${countInHat} of ${this.totalPhraseCount()}`;
     } else {
       return undefined; // No hat, just create empty div
@@ -650,9 +813,9 @@ class HatGameApp extends React.Component {
       });
     }
     //return responsePromise.then(r => r.json()); // parses JSON response into native JavaScript objects
+    // The resulting state change arrives over the event stream, so there is nothing to fetch here
     responsePromise.then(r => r.text())
-      .then(message => console.log(`server response: ${message}`))
-      .then(x => this.getStateFromServer()); // once server recieves our post message, update our state based on the response
+      .then(message => console.log(`server response: ${message}`));
   }
 }
 
@@ -69,7 +69,8 @@
 	}
 	let startListening = function() {
 		var source = new EventSource('/api/stream/debug/matt/events');
-       	source.onmessage = function (event) { alert(event.data); };
+       	source.addEventListener('snapshot', function (event) { alert(event.data); });
+       	source.addEventListener('delta', function (event) { alert(event.data); });
 	}
 	let signalRefresh = function() {
 		let endpoint = "api/refresh/debug/"